@@ -0,0 +1,131 @@
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+
+from errors import RateLimitError
+from tools.ai_client.factory import get_ai_client
+from tools.ai_client.interface import AiClient
+from tools.ai_codegen.crud_api.generator import CrudApiCodeGen
+from tools.ai_codegen.dag import Artifact
+from tools.ai_codegen.packaging import (PROJECT_NAME_PATTERN, StreamingZip,
+                                        ZipOptions)
+from utils.router import error_handler, get_error_responses
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+def get_codegen_client() -> AiClient:
+    try:
+        return get_ai_client()
+    except ValueError as e:
+        logger.exception(e)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="No AI client is configured")
+
+
+def _event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _progress_events(code_gen: CrudApiCodeGen) -> AsyncIterator[str]:
+    started = time.perf_counter()
+    sizes: Dict[str, int] = {}
+    try:
+        async for component, chunk in code_gen.stream_all():
+            sizes[component] = sizes.get(component, 0) + len(chunk)
+            yield _event("chunk", {
+                "component": component,
+                "text": chunk,
+                "chars": sizes[component]
+            })
+    except Exception as e:
+        # The response has started, so the failure can only be reported as
+        # an event.
+        logger.exception(e)
+        detail = "Generation failed"
+        if isinstance(e, RateLimitError):
+            detail = str(e)
+        yield _event("error", {"detail": detail})
+        return
+    yield _event("done", {
+        "components": sizes,
+        "seconds": round(time.perf_counter() - started, 3)
+    })
+
+
+async def _zip_chunks(first_chunk: bytes,
+                      artifacts: AsyncIterator[Tuple[Artifact, str]],
+                      archive: StreamingZip,
+                      project_name: str) -> AsyncIterator[bytes]:
+    closed = False
+    try:
+        yield first_chunk
+        async for artifact, code in artifacts:
+            yield archive.add(artifact.filename, code)
+        closed = True
+        yield archive.close()
+    except Exception:
+        # The response has started, so the failure can only be reported by
+        # dropping the connection before the archive ends.
+        logger.exception(f"Failed to generate {project_name}")
+        raise
+    finally:
+        if not closed:
+            archive.abort()
+        await artifacts.aclose()  # type: ignore
+
+
+@router.get("/stream", responses=get_error_responses)
+@error_handler
+async def stream_codegen(
+        spec: str = Query(..., min_length=1),
+        ai_client: AiClient = Depends(get_codegen_client),
+):
+    """
+    Generates a CRUD API from the spec and streams the progress as
+    server-sent events: a chunk event for every piece of generated code, then
+    a done event with the size of each component, or an error event.
+    """
+    code_gen = CrudApiCodeGen(spec, ai_client)
+    return StreamingResponse(_progress_events(code_gen),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@router.get("/zip", responses=get_error_responses)
+@error_handler
+async def download_codegen_zip(
+        spec: str = Query(..., min_length=1),
+        project_name: str = Query("project", pattern=PROJECT_NAME_PATTERN),
+        compression_level: Optional[int] = Query(None, ge=0, le=9),
+        store: bool = False,
+        ai_client: AiClient = Depends(get_codegen_client),
+):
+    """
+    Generates a CRUD API from the spec and streams it as a zip archive, each
+    file being added as soon as it is generated. Nothing is written to disk.
+    """
+    code_gen = CrudApiCodeGen(spec, ai_client)
+    archive = StreamingZip(project_name, ZipOptions(compression_level, store))
+    artifacts = code_gen.iter_artifacts()
+    # The first artifact is generated before responding, so that failing to
+    # generate anything gets an error status instead of an empty archive.
+    try:
+        artifact, code = await artifacts.__anext__()
+        first_chunk = archive.add(artifact.filename, code)
+    except BaseException:
+        archive.abort()
+        await artifacts.aclose()  # type: ignore
+        raise
+    headers = {
+        "Content-Disposition": f'attachment; filename="{project_name}.zip"'
+    }
+    chunks = _zip_chunks(first_chunk, artifacts, archive, project_name)
+    return StreamingResponse(chunks,
+                             media_type="application/zip",
+                             headers=headers)
@@ -0,0 +1,61 @@
+import base64
+from datetime import datetime
+import json
+from typing import Any, List, Sequence, Tuple
+import uuid
+from errors import ValidationError
+
+# A keyset is the list of (field, direction) pairs a paginated listing is
+# ordered by, direction being 1 for ascending and -1 for descending. Its last
+# field is always the document id so that every document has a distinct key.
+Keyset = Sequence[Tuple[str, int]]
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, uuid.UUID):
+        return {"$uuid": str(value)}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict) and len(value) == 1:
+        if "$date" in value:
+            return datetime.fromisoformat(value["$date"])
+        if "$uuid" in value:
+            return uuid.UUID(value["$uuid"])
+    return value
+
+
+def encode_cursor(keyset: Keyset, key: Sequence[Any], page: int) -> str:
+    """
+    Returns an opaque cursor resuming a listing ordered by keyset right after
+    the document with the given key, on the given page.
+    """
+    payload = {
+        "s": [[field, direction] for field, direction in keyset],
+        "k": [_encode_value(value) for value in key],
+        "p": page,
+    }
+    data = json.dumps(payload, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, keyset: Keyset) -> Tuple[List[Any], int]:
+    """
+    Returns the key and page number encoded in a cursor, checking that it was
+    issued for a listing ordered by the same keyset.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(data)
+        sort = [tuple(entry) for entry in payload["s"]]
+        key = [_decode_value(value) for value in payload["k"]]
+        page = int(payload["p"])
+    except (ValueError, TypeError, KeyError):
+        raise ValidationError("Invalid pagination cursor")
+    if sort != [tuple(entry) for entry in keyset] or len(key) != len(sort):
+        raise ValidationError(
+            "The pagination cursor was issued for a different sort order")
+    return key, page
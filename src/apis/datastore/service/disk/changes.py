@@ -0,0 +1,133 @@
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional
+import uuid
+from apis.datastore.service.interface import ChangeEvent, ChangeOperation
+
+
+class ChangeStreamLagError(Exception):
+    """
+    Raise when a watcher resumes from, or falls behind to, an event that is
+    no longer in the change history
+    """
+
+
+class ChangeLog:
+    """
+    A bounded, in-process history of the changes made through an
+    OnDiskDatastore. Each watcher reads the history at its own pace from its
+    own position, so a slow watcher costs no more memory than the history
+    itself.
+
+    Writers wait in wait_for_room while the slowest watcher is history_size
+    events behind, which gives it a chance to catch up on a burst of writes.
+    They wait max_wait_seconds at most, so that a stalled watcher can't hold
+    up writes: a watcher still that far behind then loses events and gets a
+    ChangeStreamLagError, and has to resync.
+    """
+
+    def __init__(self,
+                 history_size: int = 10000,
+                 max_wait_seconds: float = 1.0):
+        self.history_size = history_size
+        self.max_wait_seconds = max_wait_seconds
+        # Resume tokens are "<log id>:<sequence>", so that tokens issued by
+        # another process or before a restart are rejected.
+        self.log_id = uuid.uuid4().hex
+        self._events: Deque[ChangeEvent] = deque(maxlen=history_size)
+        self._next_sequence = 0
+        self._appended = asyncio.Event()
+        # The next sequence each active watcher reads.
+        self._readers: Dict[object, int] = {}
+        self._consumed = asyncio.Event()
+        self._waiting_writers = 0
+
+    async def wait_for_room(self):
+        """
+        Waits until the next event won't push one the slowest watcher has
+        yet to read out of the history, or for max_wait_seconds.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait_seconds
+        while self._lag() >= self.history_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            self._waiting_writers += 1
+            try:
+                await asyncio.wait_for(self._consumed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+            finally:
+                self._waiting_writers -= 1
+
+    def append(self, operation: ChangeOperation, collection: str,
+               document_id: str, document: Optional[Dict]):
+        event = ChangeEvent(
+            operation=operation,
+            collection=collection,
+            document_id=document_id,
+            document=document,
+            resume_token=f"{self.log_id}:{self._next_sequence}",
+        )
+        self._events.append(event)
+        self._next_sequence += 1
+        appended, self._appended = self._appended, asyncio.Event()
+        appended.set()
+
+    def clear(self):
+        """
+        Drops the history. Watchers and resume tokens that are caught up
+        carry on with the next event, the others get a ChangeStreamLagError
+        since the events they missed are gone.
+        """
+        self._events.clear()
+
+    async def follow(
+            self,
+            resume_after: Optional[str] = None) -> AsyncIterator[ChangeEvent]:
+        """
+        Yields every event appended after resume_after, or from now on when
+        no token is given, waiting for new ones indefinitely.
+        """
+        sequence = self._next_sequence
+        if resume_after is not None:
+            sequence = self._sequence_of(resume_after) + 1
+        reader = object()
+        self._readers[reader] = sequence
+        try:
+            while True:
+                while sequence < self._next_sequence:
+                    oldest = self._next_sequence - len(self._events)
+                    if sequence < oldest:
+                        raise ChangeStreamLagError(
+                            f"{oldest - sequence} changes were dropped from "
+                            "the history before they could be read")
+                    yield self._events[sequence - oldest]
+                    sequence += 1
+                    self._readers[reader] = sequence
+                    self._notify_writers()
+                await self._appended.wait()
+        finally:
+            del self._readers[reader]
+            self._notify_writers()
+
+    def _lag(self) -> int:
+        """
+        The number of events the slowest active watcher has yet to read.
+        """
+        if not self._readers:
+            return 0
+        return self._next_sequence - min(self._readers.values())
+
+    def _notify_writers(self):
+        if self._waiting_writers:
+            consumed, self._consumed = self._consumed, asyncio.Event()
+            consumed.set()
+
+    def _sequence_of(self, resume_token: str) -> int:
+        log_id, _, sequence = resume_token.partition(":")
+        if log_id != self.log_id or not sequence.isdigit():
+            raise ChangeStreamLagError(
+                f"Resume token {resume_token} is not from this change history")
+        return int(sequence)
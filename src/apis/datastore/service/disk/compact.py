@@ -0,0 +1,407 @@
+from array import array
+from datetime import datetime, timedelta
+import sys
+import typing
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
+import uuid
+from pydantic import BaseModel
+
+# Once a column holds this many distinct strings, new values are no longer
+# interned so that high-cardinality fields (ids, timestamps) don't grow the
+# intern table without any saving.
+MAX_INTERNED_VALUES = 4096
+
+_MISSING = object()
+_ABSENT, _PRESENT, _NONE, _NATIVE = 0, 1, 2, 3
+
+
+class _ObjectColumn:
+    """
+    Column of arbitrary JSON values. Repeated strings share a single object.
+    """
+
+    __slots__ = ("values", "interned")
+
+    def __init__(self, size: int = 0):
+        self.values: List[Any] = [_MISSING] * size
+        self.interned: Dict[str, str] = {}
+
+    def get(self, row: int) -> Any:
+        return self.values[row]
+
+    def set(self, row: int, value: Any) -> bool:
+        if type(value) is str:
+            shared = self.interned.get(value)
+            if shared is not None:
+                value = shared
+            elif len(self.interned) < MAX_INTERNED_VALUES:
+                value = sys.intern(value)
+                self.interned[value] = value
+        self.values[row] = value
+        return True
+
+    def clear(self, row: int):
+        self.values[row] = _MISSING
+
+    def append_row(self):
+        self.values.append(_MISSING)
+
+
+class _IntCodec:
+    typecode = "q"
+    width = 1
+
+    def encode(self, value: Any) -> Optional[Tuple[Tuple, bool]]:
+        if type(value) is not int or not -2**63 <= value < 2**63:
+            return None
+        return (value, ), True
+
+    def decode(self, items: Sequence, native: bool) -> Any:
+        return items[0]
+
+
+class _FloatCodec:
+    typecode = "d"
+    width = 1
+
+    def encode(self, value: Any) -> Optional[Tuple[Tuple, bool]]:
+        if type(value) is float:
+            return (value, ), True
+        if type(value) is int:
+            # The model declares a float, so an integral amount is stored the
+            # way pydantic would coerce it.
+            return (float(value), ), True
+        return None
+
+    def decode(self, items: Sequence, native: bool) -> Any:
+        return items[0]
+
+
+class _UUIDCodec:
+    """
+    Packs UUIDs, or their canonical string form, into two 64 bit integers.
+    """
+
+    typecode = "Q"
+    width = 2
+
+    def encode(self, value: Any) -> Optional[Tuple[Tuple, bool]]:
+        native = isinstance(value, uuid.UUID)
+        if not native:
+            if type(value) is not str or len(value) != 36:
+                return None
+            try:
+                parsed = uuid.UUID(value)
+            except ValueError:
+                return None
+            if str(parsed) != value:
+                return None
+            value = parsed
+        return (value.int >> 64, value.int & (2**64 - 1)), native
+
+    def decode(self, items: Sequence, native: bool) -> Any:
+        value = uuid.UUID(int=(items[0] << 64) | items[1])
+        return value if native else str(value)
+
+
+class _DatetimeCodec:
+    """
+    Packs naive datetimes, or their ISO 8601 form, as microseconds since the
+    epoch.
+    """
+
+    typecode = "q"
+    width = 1
+
+    def encode(self, value: Any) -> Optional[Tuple[Tuple, bool]]:
+        native = isinstance(value, datetime)
+        if not native:
+            if type(value) is not str:
+                return None
+            try:
+                parsed = datetime.fromisoformat(value)
+            except ValueError:
+                return None
+            if parsed.isoformat() != value:
+                return None
+            value = parsed
+        if value.tzinfo is not None:
+            return None
+        return ((value - _EPOCH) // _MICROSECOND, ), native
+
+    def decode(self, items: Sequence, native: bool) -> Any:
+        value = _EPOCH + timedelta(microseconds=items[0])
+        return value if native else value.isoformat()
+
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_CODECS = {
+    int: _IntCodec(),
+    float: _FloatCodec(),
+    uuid.UUID: _UUIDCodec(),
+    datetime: _DatetimeCodec(),
+}
+
+
+class _PackedColumn:
+    """
+    Column of fixed width values packed in an ``array`` by a codec, with a
+    per-row state byte recording whether the value is absent, None, or
+    present in its native or string form.
+    """
+
+    __slots__ = ("codec", "values", "states")
+
+    def __init__(self, codec: Any, size: int = 0):
+        self.codec = codec
+        self.values = array(codec.typecode, bytes(8 * codec.width * size))
+        self.states = bytearray(size)
+
+    def get(self, row: int) -> Any:
+        state = self.states[row]
+        if state == _ABSENT:
+            return _MISSING
+        if state == _NONE:
+            return None
+        width = self.codec.width
+        items = self.values[row * width:(row + 1) * width]
+        return self.codec.decode(items, state == _NATIVE)
+
+    def set(self, row: int, value: Any) -> bool:
+        """
+        Stores the value, returning False when it cannot be represented in
+        this column without loss, e.g. a string in a float column.
+        """
+        if value is None:
+            self.states[row] = _NONE
+            return True
+        encoded = self.codec.encode(value)
+        if encoded is None:
+            return False
+        items, native = encoded
+        width = self.codec.width
+        self.values[row * width:(row + 1) * width] = array(
+            self.codec.typecode, items)
+        self.states[row] = _NATIVE if native else _PRESENT
+        return True
+
+    def clear(self, row: int):
+        self.states[row] = _ABSENT
+
+    def append_row(self):
+        self.values.extend([0] * self.codec.width)
+        self.states.append(_ABSENT)
+
+    def to_object_column(self) -> _ObjectColumn:
+        column = _ObjectColumn(len(self.states))
+        for row in range(len(self.states)):
+            value = self.get(row)
+            if value is not _MISSING:
+                column.set(row, value)
+        return column
+
+
+def _column_codec(annotation: Any) -> Optional[Any]:
+    """
+    Returns the codec packing values of the annotated type (optionally
+    wrapped in Optional), or None when they are stored as objects.
+    """
+    if typing.get_origin(annotation) is typing.Union:
+        args = [
+            arg for arg in typing.get_args(annotation)
+            if arg is not type(None)
+        ]
+        if len(args) != 1:
+            return None
+        annotation = args[0]
+    return _CODECS.get(annotation)
+
+
+class FieldLayout:
+    """
+    The fields of a collection in storage order, with the codec used to pack
+    each one, or None for fields stored as objects.
+    """
+
+    def __init__(self, fields: Mapping[str, Optional[Any]]):
+        self.fields: Tuple[str, ...] = tuple(
+            sys.intern(field) for field in fields)
+        self.codecs: Tuple[Optional[Any], ...] = tuple(fields.values())
+        self.positions: Dict[str, int] = {
+            field: position
+            for position, field in enumerate(self.fields)
+        }
+
+    @classmethod
+    def from_model(cls, model: Type[BaseModel]) -> "FieldLayout":
+        return cls({
+            name: _column_codec(field.annotation)
+            for name, field in model.model_fields.items()
+        })
+
+
+class CompactRecord(Mapping):
+    """
+    A read-through view of one row of a CompactCollection. It behaves like the
+    document dict for predicates and is only turned into a real dict with
+    to_dict() when it leaves the datastore.
+    """
+
+    __slots__ = ("_collection", "_row")
+
+    def __init__(self, collection: "CompactCollection", row: int):
+        self._collection = collection
+        self._row = row
+
+    def __getitem__(self, field: str) -> Any:
+        value = self._collection._get_value(self._row, field)
+        if value is _MISSING:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field: object) -> bool:
+        return self._collection._get_value(self._row, field) is not _MISSING
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.to_dict())
+
+    def __len__(self) -> int:
+        return len(self.to_dict())
+
+    def get(self, field: str, default: Any = None) -> Any:
+        value = self._collection._get_value(self._row, field)
+        return default if value is _MISSING else value
+
+    def update(self, values: Mapping[str, Any]):
+        for field, value in values.items():
+            self._collection._set_value(self._row, field, value)
+
+    def to_dict(self) -> Dict:
+        return self._collection._materialize(self._row)
+
+
+class CompactCollection(MutableMapping):
+    """
+    Stores the documents of a homogeneous collection as rows across parallel
+    columns instead of one dict per document. Field names are stored once per
+    collection, numbers, UUIDs and datetimes are packed into arrays and
+    repeated strings are shared. Fields outside the layout are kept in a per-row overflow dict.
+    """
+
+    def __init__(self, layout: FieldLayout):
+        self.layout = layout
+        self._columns: List[Any] = [
+            _PackedColumn(codec) if codec else _ObjectColumn()
+            for codec in layout.codecs
+        ]
+        self._rows: Dict[str, int] = {}
+        self._free_rows: List[int] = []
+        self._size = 0
+        self._extras: Dict[int, Dict[str, Any]] = {}
+
+    @classmethod
+    def from_documents(cls, layout: FieldLayout,
+                       documents: Mapping[str, Mapping]) -> "CompactCollection":
+        collection = cls(layout)
+        for doc_id, document in documents.items():
+            collection[doc_id] = document
+        return collection
+
+    def __getitem__(self, doc_id: str) -> CompactRecord:
+        return CompactRecord(self, self._rows[doc_id])
+
+    def __setitem__(self, doc_id: str, document: Mapping):
+        row = self._rows.get(doc_id)
+        if row is None:
+            row = self._allocate_row()
+            self._rows[doc_id] = row
+        else:
+            self._clear_row(row)
+        for field, value in document.items():
+            self._set_value(row, field, value)
+
+    def __delitem__(self, doc_id: str):
+        row = self._rows.pop(doc_id)
+        self._clear_row(row)
+        self._free_rows.append(row)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._rows)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, doc_id: object) -> bool:
+        return doc_id in self._rows
+
+    def values(self) -> Iterator[CompactRecord]:  # type: ignore[override]
+        for row in self._rows.values():
+            yield CompactRecord(self, row)
+
+    def items(self) -> Iterator[Tuple[str, CompactRecord]]:  # type: ignore[override]
+        for doc_id, row in self._rows.items():
+            yield doc_id, CompactRecord(self, row)
+
+    def to_dict(self) -> Dict[str, Dict]:
+        return {
+            doc_id: self._materialize(row)
+            for doc_id, row in self._rows.items()
+        }
+
+    def _allocate_row(self) -> int:
+        if self._free_rows:
+            return self._free_rows.pop()
+        for column in self._columns:
+            column.append_row()
+        self._size += 1
+        return self._size - 1
+
+    def _clear_row(self, row: int):
+        for column in self._columns:
+            column.clear(row)
+        self._extras.pop(row, None)
+
+    def _get_value(self, row: int, field: Any) -> Any:
+        position = self.layout.positions.get(field)
+        if position is not None:
+            return self._columns[position].get(row)
+        extras = self._extras.get(row)
+        if extras is None:
+            return _MISSING
+        return extras.get(field, _MISSING)
+
+    def _set_value(self, row: int, field: str, value: Any):
+        position = self.layout.positions.get(field)
+        if position is None:
+            self._extras.setdefault(row, {})[field] = value
+            return
+        column = self._columns[position]
+        if not column.set(row, value):
+            # The value doesn't fit the packed column, fall back to storing
+            # objects for this field from now on.
+            column = column.to_object_column()
+            self._columns[position] = column
+            column.set(row, value)
+
+    def _materialize(self, row: int) -> Dict:
+        document = {}
+        for field, column in zip(self.layout.fields, self._columns):
+            value = column.get(row)
+            if value is not _MISSING:
+                document[field] = value
+        extras = self._extras.get(row)
+        if extras:
+            document.update(extras)
+        return document
@@ -1,76 +1,283 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
 from datetime import datetime
+from functools import cmp_to_key
+import heapq
 import os
 import json
-from typing import Dict, List, Optional
+from typing import (
+    Any,
+    AsyncIterator,
+    ContextManager,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+)
 import uuid
+from pydantic import BaseModel
 from apis.datastore.service.interface import (
+    ChangeEvent,
+    ChangeOperation,
     Datastore,
     GroupSumResult,
     PaginatedResult,
     DatastoreEntityName,
+    SortOrder,
 )
+from apis.datastore.service.cursor import decode_cursor, encode_cursor
+from apis.datastore.service.views import MaterializedView, ViewState
+from .changes import ChangeLog
+from .compact import CompactCollection, FieldLayout
+from .profiling import QueryProfile, profiled
 from .query import OnDiskQuery
-from .helpers import check_query_matches, CustomJSONEncoder
+from apis.datastore.service.text import text_fields
+from .indexes import DiskIndex, SortedIndex, TextIndex
+from .helpers import (
+    check_query_matches,
+    compare_sort_keys,
+    CustomJSONEncoder,
+    InsertionOrder,
+    iter_json_object_items,
+)
+
+# Keyset fields of the relevance of a text search and of the insertion order
+# of a document, see _keyset.
+TEXT_SCORE = "$textScore"
+INSERTION_ORDER = "$insertionOrder"
+
+
+async def _aiter(items: Iterable[Mapping]) -> AsyncIterator[Mapping]:
+    for item in items:
+        yield item
 
 
 class OnDiskDatastore(Datastore):
 
-    def __init__(self):
-        self.collections = {}
+    def __init__(self,
+                 data_dir: str = "ondiskdb_data",
+                 memory_budget: Optional[int] = None,
+                 schemas: Optional[Dict[DatastoreEntityName,
+                                        Type[BaseModel]]] = None,
+                 change_history: int = 10000,
+                 indexes: Optional[List[DiskIndex]] = None,
+                 change_wait_seconds: float = 1.0):
+        """
+        Collections are loaded lazily the first time they are accessed and
+        kept in least-recently-used order.
+
+        :param data_dir: The directory holding one JSON file per collection.
+        :param memory_budget: Approximate number of bytes (measured as the
+            size of the collection files) that may be held in memory at once.
+            Once exceeded, idle collections without unsaved changes are
+            unloaded and reloaded from disk on the next access.
+            ``None`` disables eviction.
+        :param schemas: Optional models for homogeneous collections. Their
+            documents are kept in a CompactCollection laid out from the model
+            fields and only turned back into dicts when returned.
+        :param change_history: The number of changes per collection kept for
+            watchers to catch up on or resume from.
+        :param indexes: Secondary indexes to maintain, see register_index.
+        :param change_wait_seconds: The longest a write waits for the slowest
+            watcher of the collection to catch up when it is change_history
+            events behind, see ChangeLog.
+        """
+        self.collections: "OrderedDict[str, MutableMapping]" = OrderedDict()
         self.default_limit = 32
-        self.data_dir = "ondiskdb_data"
+        self.data_dir = data_dir
+        self.memory_budget = memory_budget
+        self._collection_sizes: Dict[str, int] = {}
+        self._dirty: Set[str] = set()
+        self.layouts: Dict[str, FieldLayout] = {
+            self._collection_name(collection): FieldLayout.from_model(model)
+            for collection, model in (schemas or {}).items()
+        }
+        self.views: Dict[str, List[ViewState]] = {}
+        self.indexes: Dict[str, List[DiskIndex]] = {}
+        self.change_history = change_history
+        self.change_wait_seconds = change_wait_seconds
+        self.change_logs: Dict[str, ChangeLog] = {}
+        # Kept when a collection is unloaded, so that cursors stay valid.
+        self.insertion_orders: Dict[str, InsertionOrder] = {}
+        # The number of documents tested against a query so far.
+        self.documents_scanned = 0
+        # The active profile of the current task, see profile().
+        self._profiles: ContextVar[Optional[QueryProfile]] = ContextVar(
+            "profile", default=None)
         os.makedirs(self.data_dir, exist_ok=True)
-        self._load_collections()
+        for index in indexes or []:
+            self.register_index(index)
 
+    @profiled
     async def add(self, collection: DatastoreEntityName,
                   document: Dict) -> str:
-        if collection not in self.collections:
-            self.collections[collection] = {}
+        await self._wait_for_watchers(collection)
+        documents = self._get_collection(collection)
+        order = self._insertion_order(collection)
         doc_id = str(uuid.uuid4())
-        self.collections[collection][doc_id] = document
+        documents[doc_id] = document
+        order.add(doc_id)
+        self._update_views(collection, [(None, document)])
+        self._update_indexes(collection, documents, [doc_id])
         self._save_collection(collection)
+        self._record_change(collection, ChangeOperation.INSERT, doc_id,
+                            document)
         return doc_id
 
+    @profiled
     async def get_one(self, collection: DatastoreEntityName,
                       query: OnDiskQuery) -> Optional[Dict]:
-        documents = self.collections.get(collection, {}).values()
-        for doc in documents:
+        documents = self._get_collection(collection)
+        for _, doc in self._scan(collection, documents, query, ranked=True):
             if self._matches_query(doc, query):
-                return doc
+                return self._to_dict(doc)
         return None
 
+    @profiled
     async def get_many(self, collection: DatastoreEntityName,
                        query: OnDiskQuery) -> List[Dict]:
-        documents = self.collections.get(collection, {}).values()
-        return [doc for doc in documents if self._matches_query(doc, query)]
+        documents = self._get_collection(collection)
+        return [
+            self._to_dict(doc)
+            for _, doc in self._scan(collection, documents, query, ranked=True)
+            if self._matches_query(doc, query)
+        ]
 
+    @profiled
+    async def iter_many(
+        self,
+        collection: DatastoreEntityName,
+        query: OnDiskQuery,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[Dict]:
+        """
+        Yields matching documents as they are found, honouring the query's
+        sort, offset and limit. The ids of the collection are snapshotted so
+        that writes made while iterating don't invalidate the iterator, but
+        documents are only materialized when they are yielded. A sorted query
+        has to collect, and so materialize, its matches before yielding the
+        first one, a text search has to score the candidates first.
+        """
+        documents = self._get_collection(collection)
+        doc_ids = self._scan_ids(collection, documents, query, ranked=True)
+        if doc_ids is None:
+            doc_ids = list(documents)
+
+        async def scan() -> AsyncIterator[Mapping]:
+            for start in range(0, len(doc_ids), batch_size):
+                batch = doc_ids[start:start + batch_size]
+                for doc in self._iter_matches(documents, batch, query):
+                    yield doc
+                # Let other tasks run, and timeouts fire, between batches,
+                # however few documents match.
+                await asyncio.sleep(0)
+
+        matches = scan()
+        if query.sort_fields:
+            # Compact rows are copied out as they are collected: a row freed
+            # by a delete while iterating is handed to the next insert.
+            docs = [
+                doc if isinstance(doc, dict) else doc.to_dict()
+                async for doc in matches
+            ]
+            with self._phase("sort"):
+                matches = _aiter(self._sort_documents(docs, query))
+
+        offset = query.offset or 0
+        end = offset + query.limit if query.limit is not None else None
+        position = 0
+        async for doc in matches:
+            if end is not None and position >= end:
+                break
+            if position >= offset:
+                yield self._to_dict(doc)
+            position += 1
+
+    @profiled
     async def get_paginated(self, collection: DatastoreEntityName,
                             query: OnDiskQuery) -> PaginatedResult:
-        all_docs = await self.get_many(collection, query)
+        """
+        Pages are ordered by the query's sort fields, then by insertion order.
+        With a cursor, the page is the limit smallest keys after the cursor
+        key, so deep pages cost no more than the first one. When the first
+        sort field has a SortedIndex, only the documents sorting after the
+        cursor are scanned. Unsorted text searches are ordered by relevance
+        instead of the sort fields.
+        """
         limit = query.limit or self.default_limit
+        documents = self._get_collection(collection)
+        scores = self._text_scores(collection, documents, query)
+        keyset = self._keyset(query, ranked=scores is not None)
+        order = self._insertion_order(collection)
+
         offset = query.offset or 0
         page = offset // limit + 1
-        total = len(all_docs)
-        paginated_docs = all_docs[offset:offset + limit]
+        after = None
+        if query.cursor is not None:
+            after, page = decode_cursor(query.cursor, keyset)
+            offset = 0
+        matches = [
+            (self._sort_key(doc_id, doc, keyset, order, scores), doc)
+            for doc_id, doc in self._scan(
+                collection, documents, query, keyset=keyset, after=after)
+            if self._matches_query(doc, query)
+        ]
+        if after is None:
+            total = len(matches)
+        else:
+            total = self._count(collection, query)
+            matches = [
+                match for match in matches
+                if compare_sort_keys(match[0], after, keyset) > 0
+            ]
+        with self._phase("sort"):
+            page_matches = heapq.nsmallest(
+                offset + limit,
+                matches,
+                key=cmp_to_key(
+                    lambda a, b: compare_sort_keys(a[0], b[0], keyset)),
+            )[offset:]
+
+        pages = (total + limit - 1) // limit
+        next_cursor = None
+        if len(page_matches) == limit and page < pages:
+            last_key = page_matches[-1][0]
+            next_cursor = encode_cursor(keyset, last_key, page + 1)
         return PaginatedResult(
             total=total,
-            items=paginated_docs,
+            items=[self._to_dict(doc) for _, doc in page_matches],
             page=page,
-            pages=(total + limit - 1) // limit,
+            pages=pages,
             page_size=limit,
+            next_cursor=next_cursor,
         )
 
+    @profiled
     async def count(self, collection: DatastoreEntityName,
                     query: OnDiskQuery) -> int:
-        documents = self.collections.get(collection, {}).values()
-        return sum(1 for doc in documents if self._matches_query(doc, query))
+        return self._count(collection, query)
 
+    @profiled
     async def sum(self, collection: DatastoreEntityName, field: str,
                   query: OnDiskQuery) -> float:
-        documents = self.collections.get(collection, {}).values()
-        return sum(doc[field] for doc in documents
+        view = self._find_view(collection, query, value_field=field)
+        if view is not None:
+            self._use_index(f"view:{view.view.name}")
+            return view.sum()
+        documents = self._get_collection(collection)
+        return sum(doc[field]
+                   for _, doc in self._scan(collection, documents, query)
                    if self._matches_query(doc, query))
 
+    @profiled
     async def group_sum(
         self,
         collection: DatastoreEntityName,
@@ -78,9 +285,16 @@ class OnDiskDatastore(Datastore):
         value_field: str,
         query: OnDiskQuery,
     ) -> List[GroupSumResult]:
-        documents = self.collections.get(collection, {}).values()
+        view = self._find_view(collection,
+                               query,
+                               group_field=group_field,
+                               value_field=value_field)
+        if view is not None:
+            self._use_index(f"view:{view.view.name}")
+            return view.group_sum()
+        documents = self._get_collection(collection)
         groups = {}
-        for doc in documents:
+        for _, doc in self._scan(collection, documents, query):
             if self._matches_query(doc, query):
                 group = doc[group_field]
                 value = doc[value_field]
@@ -101,90 +315,554 @@ class OnDiskDatastore(Datastore):
                         query: OnDiskQuery, pipeline: List) -> List:
         raise NotImplementedError()
 
+    @profiled
     async def update_one(self, collection: DatastoreEntityName,
                          query: OnDiskQuery,
                          update_values: Dict) -> Optional[Dict]:
-        documents = self.collections.get(collection, {})
-        for doc_id, doc in documents.items():
+        await self._wait_for_watchers(collection)
+        documents = self._get_collection(collection)
+        for doc_id, doc in self._scan(collection, documents, query):
             if self._matches_query(doc, query):
+                self._dirty.add(self._collection_name(collection))
+                before = self._view_snapshot(collection, doc)
                 documents[doc_id].update(update_values)
+                self._update_views(collection, [(before, documents[doc_id])])
+                self._update_indexes(collection, documents, [doc_id])
                 self._save_collection(collection)
-                return documents[doc_id]
+                self._record_change(collection, ChangeOperation.UPDATE, doc_id,
+                                    documents[doc_id])
+                return self._to_dict(documents[doc_id])
         return None
 
+    @profiled
     async def update_many(self, collection: DatastoreEntityName,
                           query: OnDiskQuery,
                           update_values: Dict) -> List[Dict]:
-        documents = self.collections.get(collection, {})
+        await self._wait_for_watchers(collection)
+        documents = self._get_collection(collection)
         updated = []
-        for doc_id, doc in documents.items():
+        updated_ids = []
+        changes = []
+        self._dirty.add(self._collection_name(collection))
+        for doc_id, doc in self._scan(collection, documents, query):
             if self._matches_query(doc, query):
+                before = self._view_snapshot(collection, doc)
                 documents[doc_id].update(update_values)
-                updated.append(documents[doc_id])
+                changes.append((before, documents[doc_id]))
+                updated.append(self._to_dict(documents[doc_id]))
+                updated_ids.append(doc_id)
+        self._update_views(collection, changes)
+        self._update_indexes(collection, documents, updated_ids)
         self._save_collection(collection)
+        for doc_id, doc in zip(updated_ids, updated):
+            self._record_change(collection, ChangeOperation.UPDATE, doc_id,
+                                doc)
         return updated
 
+    @profiled
     async def delete_many(self, collection: DatastoreEntityName,
                           query: OnDiskQuery) -> int:
-        documents = self.collections.get(collection, {})
-        initial_count = len(documents)
-        self.collections[collection] = {
-            doc_id: doc
-            for doc_id, doc in documents.items()
-            if not self._matches_query(doc, query)
-        }
+        await self._wait_for_watchers(collection)
+        documents = self._get_collection(collection)
+        self._dirty.add(self._collection_name(collection))
+        doc_ids = [
+            doc_id for doc_id, doc in self._scan(collection, documents, query)
+            if self._matches_query(doc, query)
+        ]
+        self._update_views(collection,
+                           [(documents[doc_id], None) for doc_id in doc_ids])
+        for doc_id in doc_ids:
+            self._record_change(collection, ChangeOperation.DELETE, doc_id,
+                                documents[doc_id])
+            del documents[doc_id]
+            self._insertion_order(collection).remove(doc_id)
+        self._update_indexes(collection, documents, doc_ids)
         self._save_collection(collection)
-        return initial_count - len(self.collections[collection])
+        return len(doc_ids)
 
+    @profiled
     async def delete_one(self, collection: DatastoreEntityName,
                          query: OnDiskQuery) -> bool:
-        documents = self.collections.get(collection, {})
-        for doc_id, doc in documents.items():
+        await self._wait_for_watchers(collection)
+        documents = self._get_collection(collection)
+        for doc_id, doc in self._scan(collection, documents, query):
             if self._matches_query(doc, query):
+                self._dirty.add(self._collection_name(collection))
+                self._update_views(collection, [(doc, None)])
+                self._record_change(collection, ChangeOperation.DELETE, doc_id,
+                                    doc)
                 del documents[doc_id]
+                self._insertion_order(collection).remove(doc_id)
+                self._update_indexes(collection, documents, [doc_id])
                 self._save_collection(collection)
                 return True
         return False
 
+    async def register_view(self, view: MaterializedView) -> None:
+        state = ViewState(view)
+        documents = self._get_collection(view.collection).values()
+        state.update((None, doc) for doc in documents)
+        self.views.setdefault(self._collection_name(view.collection),
+                              []).append(state)
+
+    def register_index(self, index: DiskIndex):
+        """
+        Adds a secondary index, built from the collection when it is loaded
+        and kept up to date on every write made through this datastore.
+        Reads with a filter the index can serve only test the documents it
+        returns, and are otherwise unaffected:
+
+            datastore.register_index(
+                TrigramIndex(DatastoreEntityName.PRODUCT, "name"))
+
+        Text searches without a TextIndex on their fields scan and tokenize
+        the whole collection to rank the matches.
+        """
+        name = self._collection_name(index.collection)
+        self.indexes.setdefault(name, []).append(index)
+        if name in self.collections:
+            index.build(self.collections[name].items())
+
+    async def watch(
+        self,
+        collection: DatastoreEntityName,
+        query: Optional[OnDiskQuery] = None,
+        resume_after: Optional[Any] = None,
+    ) -> AsyncIterator[ChangeEvent]:
+        """
+        Yields the changes made to the collection through this datastore.
+        Deletes are matched against the deleted document. Writes wait for a
+        watcher that falls behind, up to change_wait_seconds, see ChangeLog.
+        """
+        query_data = query.build() if query is not None else None
+        change_log = self._change_log(collection)
+        async for event in change_log.follow(resume_after):
+            if query_data is not None and not check_query_matches(
+                    event.document, query_data):
+                continue
+            yield event
+
     def get_query_builder(self) -> OnDiskQuery:
         return OnDiskQuery()
 
+    @contextmanager
+    def profile(self) -> Iterator[QueryProfile]:
+        """
+        Profiles every call made on the datastore inside the block:
+
+            with datastore.profile() as profile:
+                await datastore.get_many(collection, query)
+            profile.explain()
+
+        Profiling evaluates queries predicate by predicate and times each
+        phase, so it is noticeably slower than a normal call. Only the calls
+        made by the task that entered the block, and the tasks it starts,
+        are profiled; concurrent requests sharing the datastore aren't.
+        """
+        profile = QueryProfile()
+        token = self._profiles.set(profile)
+        try:
+            yield profile
+        finally:
+            self._profiles.reset(token)
+
+    @property
+    def _profile(self) -> Optional[QueryProfile]:
+        return self._profiles.get()
+
+    def _insertion_order(self,
+                         collection: DatastoreEntityName) -> InsertionOrder:
+        name = self._collection_name(collection)
+        if name not in self.insertion_orders:
+            self.insertion_orders[name] = InsertionOrder(
+                self._get_collection(collection))
+        return self.insertion_orders[name]
+
+    def _count(self, collection: DatastoreEntityName,
+               query: OnDiskQuery) -> int:
+        view = self._find_view(collection, query)
+        if view is not None:
+            self._use_index(f"view:{view.view.name}")
+            return view.count()
+        documents = self._get_collection(collection)
+        return sum(1 for _, doc in self._scan(collection, documents, query)
+                   if self._matches_query(doc, query))
+
+    def _change_log(self, collection: DatastoreEntityName) -> ChangeLog:
+        name = self._collection_name(collection)
+        if name not in self.change_logs:
+            self.change_logs[name] = ChangeLog(self.change_history,
+                                               self.change_wait_seconds)
+        return self.change_logs[name]
+
+    async def _wait_for_watchers(self, collection: DatastoreEntityName):
+        change_log = self.change_logs.get(self._collection_name(collection))
+        if change_log is not None:
+            await change_log.wait_for_room()
+
+    def _record_change(self, collection: DatastoreEntityName,
+                       operation: ChangeOperation, doc_id: str, doc: Mapping):
+        if not self.change_history:
+            return
+        # Events hold a copy, documents are updated in place afterwards.
+        document = dict(doc) if isinstance(doc, dict) else doc.to_dict()
+        self._change_log(collection).append(operation,
+                                            self._collection_name(collection),
+                                            doc_id, document)
+
+    def _find_view(self,
+                   collection: DatastoreEntityName,
+                   query: OnDiskQuery,
+                   group_field: Optional[str] = None,
+                   value_field: Optional[str] = None) -> Optional[ViewState]:
+        for state in self.views.get(self._collection_name(collection), []):
+            if state.serves(query, group_field, value_field):
+                return state
+        return None
+
+    def _view_snapshot(self, collection: DatastoreEntityName,
+                       doc: Mapping) -> Optional[Dict]:
+        """
+        Copies the fields the collection's views depend on, so that the
+        document's contribution can be removed after it is updated in place.
+        """
+        states = self.views.get(self._collection_name(collection))
+        if not states:
+            return None
+        return {
+            field: doc[field]
+            for state in states
+            for field in state.view.fields() if field in doc
+        }
+
+    def _update_views(self, collection: DatastoreEntityName,
+                      changes: Iterable[Tuple[Optional[Mapping],
+                                              Optional[Mapping]]]):
+        states = self.views.get(self._collection_name(collection))
+        if not states:
+            return
+        changes = list(changes)
+        for state in states:
+            state.update(changes)
+
+    def _update_indexes(self, collection: DatastoreEntityName,
+                        documents: Mapping, doc_ids: Iterable[str]):
+        indexes = self.indexes.get(self._collection_name(collection))
+        if not indexes:
+            return
+        for doc_id in doc_ids:
+            doc = documents.get(doc_id)
+            for index in indexes:
+                if doc is None:
+                    index.remove(doc_id)
+                else:
+                    index.update(doc_id, doc)
+
+    def _candidate_ids(self, collection: DatastoreEntityName,
+                       query: OnDiskQuery) -> Optional[List[str]]:
+        """
+        Returns the ids of the documents that may match the query, as given
+        by the index returning the fewest of them, or None when no index can
+        serve one of its filters. Queries with OR filters always scan.
+        """
+        indexes = self.indexes.get(self._collection_name(collection))
+        if not indexes or query.conditions.get("||"):
+            return None
+        best: Optional[Tuple[DiskIndex, List[str]]] = None
+        for spec in query.specs:
+            for index in indexes:
+                if not index.serves(spec.field):
+                    continue
+                doc_ids = index.candidates(spec.op, spec.operand)
+                if doc_ids is not None and (best is None
+                                            or len(doc_ids) < len(best[1])):
+                    best = (index, doc_ids)
+        if best is None:
+            return None
+        self._use_index(best[0].name)
+        return best[1]
+
+    def _text_scores(self, collection: DatastoreEntityName, documents: Mapping,
+                     query: OnDiskQuery) -> Optional[Dict[str, float]]:
+        """
+        Returns the relevance of the documents to the text search of an
+        unsorted query, or None when the query isn't ranked.
+        """
+        if query.sort_fields:
+            return None
+        spec = next((spec for spec in query.specs if spec.op == "text_search"),
+                    None)
+        if spec is None:
+            return None
+        with self._phase("sort"):
+            index = next(
+                (index for index in self.indexes.get(
+                    self._collection_name(collection), [])
+                 if isinstance(index, TextIndex) and index.serves(spec.field)),
+                None)
+            if index is None:
+                index = TextIndex(collection, text_fields(spec.field))
+                index.build(documents.items())
+            return index.scores(spec.operand)
+
+    def _range_ids(self, collection: DatastoreEntityName,
+                   keyset: List[Tuple[str, int]],
+                   after: List[Any]) -> Optional[List[str]]:
+        """
+        Returns the ids of the documents whose first sort field sorts at or
+        after the cursor key, from a SortedIndex on the field, or None when
+        no index can narrow them down.
+        """
+        field, direction = keyset[0]
+        for index in self.indexes.get(self._collection_name(collection), []):
+            if isinstance(index, SortedIndex) and index.serves(field):
+                doc_ids = index.after(after[0], direction)
+                if doc_ids is not None:
+                    self._use_index(index.name)
+                    return doc_ids
+        return None
+
+    def _scan_ids(self,
+                  collection: DatastoreEntityName,
+                  documents: Mapping,
+                  query: OnDiskQuery,
+                  ranked: bool = False,
+                  keyset: Optional[List[Tuple[str, int]]] = None,
+                  after: Optional[List[Any]] = None) -> Optional[List[str]]:
+        """
+        Returns the ids of the documents that may match the query, or None
+        for the whole collection. They are in collection order, or by
+        relevance when ranked and the query is an unsorted text search. With
+        the keyset and key of a cursor, documents sorting before the key may
+        be left out.
+        """
+        doc_ids = self._candidate_ids(collection, query)
+        range_ids = (self._range_ids(collection, keyset, after)
+                     if keyset and after is not None else None)
+        if range_ids is not None:
+            if doc_ids is None:
+                doc_ids = range_ids
+            else:
+                in_range = set(range_ids)
+                doc_ids = [doc_id for doc_id in doc_ids if doc_id in in_range]
+        scores = self._text_scores(collection, documents,
+                                   query) if ranked else None
+        if scores is not None:
+            doc_ids = sorted(doc_ids if doc_ids is not None else documents,
+                             key=lambda doc_id: -scores.get(doc_id, 0.0))
+        return doc_ids
+
+    def _scan(
+            self,
+            collection: DatastoreEntityName,
+            documents: Mapping,
+            query: OnDiskQuery,
+            ranked: bool = False,
+            keyset: Optional[List[Tuple[str, int]]] = None,
+            after: Optional[List[Any]] = None
+    ) -> Iterable[Tuple[str, Mapping]]:
+        """
+        Returns the documents that may match the query, see _scan_ids.
+        """
+        doc_ids = self._scan_ids(collection, documents, query, ranked, keyset,
+                                 after)
+        if doc_ids is None:
+            return documents.items()
+        return ((doc_id, documents[doc_id]) for doc_id in doc_ids)
+
+    def _iter_matches(self, documents: Mapping, doc_ids: List[str],
+                      query: OnDiskQuery) -> Iterator[Mapping]:
+        for doc_id in doc_ids:
+            doc = documents.get(doc_id)
+            if doc is not None and self._matches_query(doc, query):
+                yield doc
+
+    def _sort_documents(self, docs: List[Mapping],
+                        query: OnDiskQuery) -> List[Mapping]:
+        # Stable sorts applied from the least to the most significant field.
+        # Documents missing the field sort first, as they do in MongoDB.
+        for sort_field in reversed(query.sort_fields):
+            field = sort_field["field"]
+            docs.sort(key=lambda doc:
+                      (doc.get(field) is not None, doc.get(field)),
+                      reverse=sort_field["direction"] == SortOrder.DESCENDING)
+        return docs
+
+    def _keyset(self,
+                query: OnDiskQuery,
+                ranked: bool = False) -> List[Tuple[str, int]]:
+        # Ties are broken by insertion order, which unsorted listings follow
+        # like get_many does.
+        if ranked:
+            return [(TEXT_SCORE, -1), (INSERTION_ORDER, 1)]
+        keyset = [
+            (sort_field["field"],
+             -1 if sort_field["direction"] == SortOrder.DESCENDING else 1)
+            for sort_field in query.sort_fields
+        ]
+        keyset.append((INSERTION_ORDER, 1))
+        return keyset
+
+    def _sort_key(self,
+                  doc_id: str,
+                  doc: Mapping,
+                  keyset: List[Tuple[str, int]],
+                  order: InsertionOrder,
+                  scores: Optional[Dict[str, float]] = None) -> List[Any]:
+        values = [
+            scores.get(doc_id, 0.0) if field == TEXT_SCORE else doc.get(field)
+            for field, _ in keyset[:-1]
+        ]
+        return values + [order[doc_id]]
+
     def _matches_query(self, doc: Dict, query: OnDiskQuery) -> bool:
+        self.documents_scanned += 1
+        if self._profile is not None and self._profile.current is not None:
+            return self._profile.current.matches(doc, query)
         query_data = query.build()
         return check_query_matches(doc, query_data)
 
-    def _load_collections(self):
-        for collection_file in os.listdir(self.data_dir):
-            if collection_file.endswith(".json"):
-                collection_name = collection_file[:
-                                                  -5]  # Remove '.json' extension
-                file_path = os.path.join(self.data_dir, collection_file)
+    def _to_dict(self, doc: Mapping) -> Dict:
+        if self._profile is not None and self._profile.current is not None:
+            operation = self._profile.current
+            operation.returned += 1
+            if not isinstance(doc, dict):
+                with operation.phase("serialize"):
+                    return doc.to_dict()
+        if isinstance(doc, dict):
+            return doc
+        return doc.to_dict()
 
-                # Check if the file is empty
-                if os.path.getsize(file_path) == 0:
-                    self.collections[collection_name] = {}
-                    continue
+    def _phase(self, name: str) -> ContextManager:
+        if self._profile is None or self._profile.current is None:
+            return nullcontext()
+        return self._profile.current.phase(name)
+
+    def _use_index(self, name: str):
+        if self._profile is not None and self._profile.current is not None:
+            self._profile.current.use_index(name)
+
+    def _collection_name(self, collection: DatastoreEntityName) -> str:
+        if isinstance(collection, DatastoreEntityName):
+            return collection.value
+        return collection
+
+    def _collection_path(self, name: str) -> str:
+        return os.path.join(self.data_dir, name + ".json")
+
+    def _get_collection(self,
+                        collection: DatastoreEntityName) -> MutableMapping:
+        """
+        Returns the documents of a collection, loading it from disk on first
+        access and marking it as the most recently used one.
+        """
+        name = self._collection_name(collection)
+        if name in self.collections:
+            self.collections.move_to_end(name)
+            return self.collections[name]
 
-                with open(file_path, "r") as f:
-                    try:
-                        self.collections[collection_name] = json.load(f)
-                    except json.JSONDecodeError:
-                        # Handle the case where the JSON is not properly formatted
-                        print(
-                            f"""Warning: Could not decode JSON from {collection_file}. 
-                            Initializing as empty collection.
-                            """)
-                        self.collections[collection_name] = {}
+        with self._phase("load"):
+            self.collections[name] = self._load_collection(name)
+            for index in self.indexes.get(name, []):
+                if not index.built:
+                    index.build(self.collections[name].items())
+        self._enforce_memory_budget()
+        return self.collections[name]
+
+    def _load_collection(self, name: str) -> MutableMapping:
+        file_path = self._collection_path(name)
+        layout = self.layouts.get(name)
+        documents = CompactCollection(layout) if layout else {}
+        if not os.path.exists(file_path):
+            self._collection_sizes[name] = 0
+            return documents
+
+        # Check if the file is empty
+        size = os.path.getsize(file_path)
+        self._collection_sizes[name] = size
+        if size == 0:
+            return documents
+
+        with open(file_path, "r") as f:
+            try:
+                if layout is None:
+                    return json.load(f)
+                # Decode one document at a time so that the dict form of the
+                # whole collection never has to be held in memory.
+                for doc_id, doc in iter_json_object_items(f.read()):
+                    documents[doc_id] = doc
+                return documents
+            except json.JSONDecodeError:
+                # Handle the case where the JSON is not properly formatted
+                print(f"""Warning: Could not decode JSON from {name}.json. 
+                    Initializing as empty collection.
+                    """)
+                return CompactCollection(layout) if layout else {}
+
+    def _enforce_memory_budget(self):
+        """
+        Unloads least recently used collections without unsaved changes until
+        the loaded collections fit in the memory budget. The most recently
+        used collection is never unloaded.
+        """
+        if self.memory_budget is None:
+            return
+
+        loaded_size = sum(
+            self._collection_sizes.get(name, 0) for name in self.collections)
+        for name in list(self.collections)[:-1]:
+            if loaded_size <= self.memory_budget:
+                break
+            if name in self._dirty:
+                continue
+            del self.collections[name]
+            loaded_size -= self._collection_sizes.pop(name, 0)
 
     def _save_collection(self, collection: str):
-        collection_path = os.path.join(self.data_dir, collection + ".json")
-        with open(collection_path, "w") as f:
-            json.dump(self.collections[collection], f, cls=CustomJSONEncoder)
+        name = self._collection_name(collection)
+        collection_path = self._collection_path(name)
+        documents = self.collections[name]
+        with self._phase("save"), open(collection_path, "w") as f:
+            if isinstance(documents, CompactCollection):
+                self._dump_compact_collection(documents, f)
+            else:
+                json.dump(documents, f, cls=CustomJSONEncoder)
+        self._dirty.discard(name)
+        self._collection_sizes[name] = os.path.getsize(collection_path)
+        self._enforce_memory_budget()
+
+    def _dump_compact_collection(self, documents: CompactCollection, f):
+        """
+        Writes the collection one document at a time so that saving doesn't
+        materialize every row at once.
+        """
+        encoder = CustomJSONEncoder()
+        f.write("{")
+        for position, (doc_id, doc) in enumerate(documents.items()):
+            if position:
+                f.write(", ")
+            f.write(encoder.encode(doc_id))
+            f.write(": ")
+            f.write(encoder.encode(doc.to_dict()))
+        f.write("}")
 
     def reset_db(self):
-        for collection in self.collections:
-            self.collections[collection] = {}
-            self._save_collection(collection)
-        self.collections = {}
-        self._load_collections()
+        for collection_file in os.listdir(self.data_dir):
+            if collection_file.endswith(".json"):
+                file_path = os.path.join(self.data_dir, collection_file)
+                with open(file_path, "w") as f:
+                    json.dump({}, f)
+        self.collections = OrderedDict()
+        self._collection_sizes = {}
+        self._dirty = set()
+        self.insertion_orders = {}
+        for indexes in self.indexes.values():
+            for index in indexes:
+                index.clear()
+        for states in self.views.values():
+            for state in states:
+                state.clear()
+        # Watchers carry on from the reset, their history is gone.
+        for change_log in self.change_logs.values():
+            change_log.clear()
         return True
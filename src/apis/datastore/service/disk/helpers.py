@@ -1,5 +1,6 @@
 from datetime import datetime
 import json
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
 
 class CustomJSONEncoder(json.JSONEncoder):
     """Custom JSON encoder that converts datetime objects to ISO format strings."""
@@ -9,11 +10,84 @@ class CustomJSONEncoder(json.JSONEncoder):
         # Let the base class default method raise the TypeError
         return json.JSONEncoder.default(self, obj)
 
+class InsertionOrder:
+    """
+    Numbers the documents of a collection in the order they were added.
+    Unlike a document's position in the collection, its number doesn't
+    change when earlier documents are deleted, so it can break ties in a
+    pagination cursor.
+    """
+    def __init__(self, doc_ids: Iterable[str] = ()):
+        self.positions: Dict[str, int] = {}
+        self.next_position = 0
+        for doc_id in doc_ids:
+            self.add(doc_id)
+
+    def add(self, doc_id: str):
+        self.positions[doc_id] = self.next_position
+        self.next_position += 1
+
+    def remove(self, doc_id: str):
+        self.positions.pop(doc_id, None)
+
+    def __getitem__(self, doc_id: str) -> int:
+        return self.positions[doc_id]
+
+def iter_json_object_items(text: str) -> Iterator[Tuple[str, Any]]:
+    """
+    Yields the key/value pairs of the top-level JSON object in text, decoding
+    one value at a time.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
+
+    def skip(position: int, expected: str = "") -> int:
+        while position < len(text) and text[position] in whitespace:
+            position += 1
+        if expected:
+            if text[position:position + 1] != expected:
+                raise json.JSONDecodeError(f"Expecting '{expected}'", text,
+                                           position)
+            position = skip(position + 1)
+        return position
+
+    position = skip(0, "{")
+    if text[position:position + 1] == "}":
+        return
+    while True:
+        key, position = decoder.raw_decode(text, position)
+        value, position = decoder.raw_decode(text, skip(position, ":"))
+        yield key, value
+        position = skip(position)
+        if text[position:position + 1] == "}":
+            return
+        position = skip(position, ",")
+
+
+def compare_sort_keys(a: List[Any], b: List[Any],
+                      keyset: List[Tuple[str, int]]) -> int:
+    """
+    Compares two lists of sort values field by field, in the direction of
+    each field of the keyset. None sorts before any other value, as missing
+    fields do in MongoDB.
+    """
+    for a_value, b_value, (_, direction) in zip(a, b, keyset):
+        if a_value == b_value:
+            continue
+        if a_value is None:
+            return -direction
+        if b_value is None or a_value > b_value:
+            return direction
+        return -direction
+    return 0
+
+
 def check_and_conditions(condition, doc):
     return all(condition[key](key, doc) for key in condition)
 
-def check_or_conditions(condition, doc):
-    return any(condition[key](key, doc) for key in condition)
+def check_or_conditions(conditions, doc):
+    return any(condition[key](key, doc) for condition in conditions
+               for key in condition)
 
 
 def check_query_matches(doc, query_data):
@@ -0,0 +1,533 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from collections import Counter
+import math
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TYPE_CHECKING,
+)
+from config import DatastoreEntityName
+from apis.datastore.service.text import (
+    FIELD_SEPARATOR,
+    document_tokens,
+    text_fields,
+    tokenize,
+)
+
+if TYPE_CHECKING:
+    from .query import OnDiskQuery
+
+REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+# Quantifiers allowing the character before them to be absent.
+OPTIONAL_QUANTIFIERS = set("*?{")
+# Operators matched from the start of the value with re.match.
+PATTERN_OPS = ("like", "regex_match")
+
+
+def literal_prefix(pattern: str) -> str:
+    """
+    Returns the literal text that every value matched by re.match(pattern)
+    starts with, e.g. "SKU-00" for "SKU-00[0-9]+". Patterns with an
+    alternation have no prefix.
+    """
+    if "|" in pattern:
+        return ""
+    position = 1 if pattern.startswith("^") else 0
+    prefix = []
+    while position < len(pattern):
+        char = pattern[position]
+        step = 1
+        if char == "\\":
+            char = pattern[position + 1:position + 2]
+            step = 2
+            # Escaped letters and digits are classes or back references.
+            if not char or char.isalnum():
+                break
+        elif char in REGEX_SPECIAL:
+            break
+        following = pattern[position + step:position + step + 1]
+        if following and following in OPTIONAL_QUANTIFIERS:
+            break
+        prefix.append(char)
+        position += step
+    return "".join(prefix)
+
+
+class DiskIndex(ABC):
+    """
+    A secondary index of one field of an on-disk collection, kept up to date
+    on every write made through the datastore.
+
+    candidates returns the ids of the documents that may match a filter, in
+    collection order, or None when the index can't narrow it down. Every
+    candidate is still tested against the whole query, so an index only has
+    to never leave out a matching document.
+    """
+
+    kind = "index"
+
+    def __init__(self, collection: DatastoreEntityName, field: str):
+        self.collection = collection
+        self.field = field
+        self.clear()
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind}:{self.field}"
+
+    def serves(self, field: str) -> bool:
+        """
+        Whether the index can serve filters on the field.
+        """
+        return field == self.field
+
+    def build(self, documents: Iterable[Tuple[str, Mapping]]):
+        self.clear()
+        for doc_id, doc in documents:
+            self.update(doc_id, doc)
+        self.built = True
+
+    def clear(self):
+        self.built = False
+        # Position of each document in the collection, to return candidates
+        # in the order a scan would find them.
+        self.positions: Dict[str, int] = {}
+        self.next_position = 0
+        # Documents with a value the index doesn't hold, e.g. a list in a
+        # text index, are candidates of every lookup.
+        self.others: Set[str] = set()
+
+    def _append(self, doc_id: str):
+        self.positions[doc_id] = self.next_position
+        self.next_position += 1
+
+    def update(self, doc_id: str, doc: Mapping):
+        """
+        Indexes a document that was added or updated.
+        """
+        if doc_id in self.positions:
+            self._remove(doc_id)
+        else:
+            self._append(doc_id)
+        self._add(doc_id, doc)
+
+    def remove(self, doc_id: str):
+        """
+        Removes a deleted document from the index.
+        """
+        if doc_id in self.positions:
+            self._remove(doc_id)
+            del self.positions[doc_id]
+
+    def candidates(self, op: Optional[str],
+                   operand: Any) -> Optional[List[str]]:
+        doc_ids = self._lookup(op, operand)
+        if doc_ids is None:
+            return None
+        doc_ids.update(self.others)
+        return sorted(doc_ids, key=self.positions.__getitem__)
+
+    def _string_value(self, doc_id: str, doc: Mapping) -> Optional[str]:
+        """
+        Returns the value of the field when it is a string. Documents with
+        another value are added to others.
+        """
+        value = doc.get(self.field)
+        if value is not None and not isinstance(value, str):
+            self.others.add(doc_id)
+            return None
+        return value
+
+    @abstractmethod
+    def _add(self, doc_id: str, doc: Mapping):
+        """
+        Indexes a document that isn't in the index.
+        """
+
+    @abstractmethod
+    def _remove(self, doc_id: str):
+        """
+        Removes a document from the index, keeping its position.
+        """
+
+    @abstractmethod
+    def _lookup(self, op: Optional[str], operand: Any) -> Optional[Set[str]]:
+        """
+        Returns the ids of the documents that may match the filter, others
+        aside, or None when the index can't serve it.
+        """
+
+
+class SortedIndex(DiskIndex):
+    """
+    Keeps the string values of a field sorted, so that starts_with filters
+    and like/regex_match patterns beginning with literal text are answered
+    with a range scan, as are the pages after a pagination cursor sorted on
+    the field.
+    """
+
+    kind = "sorted"
+
+    def clear(self):
+        super().clear()
+        self.entries: List[Tuple[str, str]] = []
+        self.values: Dict[str, str] = {}
+        # Documents without the field, which sort before any value.
+        self.missing: Set[str] = set()
+
+    def build(self, documents: Iterable[Tuple[str, Mapping]]):
+        self.clear()
+        for doc_id, doc in documents:
+            self._append(doc_id)
+            value = doc.get(self.field)
+            if isinstance(value, str):
+                self.values[doc_id] = value
+            elif value is not None:
+                self.others.add(doc_id)
+            else:
+                self.missing.add(doc_id)
+        # Sorting once is much faster than inserting one value at a time.
+        self.entries = sorted(
+            (value, doc_id) for doc_id, value in self.values.items())
+        self.built = True
+
+    def after(self, value: Any, direction: int) -> Optional[List[str]]:
+        """
+        Returns the ids of the documents whose value sorts at or after value,
+        in ascending order when direction is 1 and descending order when it
+        is -1, in collection order. Documents missing the field sort first,
+        documents with a value that isn't a string are always included. None
+        when value isn't a string.
+        """
+        if not isinstance(value, str):
+            return None
+        start = bisect_left(self.entries, (value, ))
+        if direction > 0:
+            doc_ids = {doc_id for _, doc_id in self.entries[start:]}
+        else:
+            end = start
+            while end < len(self.entries) and self.entries[end][0] == value:
+                end += 1
+            doc_ids = {doc_id for _, doc_id in self.entries[:end]}
+            doc_ids.update(self.missing)
+        doc_ids.update(self.others)
+        return sorted(doc_ids, key=self.positions.__getitem__)
+
+    def _add(self, doc_id: str, doc: Mapping):
+        value = self._string_value(doc_id, doc)
+        if value is not None:
+            self.values[doc_id] = value
+            insort(self.entries, (value, doc_id))
+        elif doc.get(self.field) is None:
+            self.missing.add(doc_id)
+
+    def _remove(self, doc_id: str):
+        self.others.discard(doc_id)
+        self.missing.discard(doc_id)
+        value = self.values.pop(doc_id, None)
+        if value is not None:
+            del self.entries[bisect_left(self.entries, (value, doc_id))]
+
+    def _lookup(self, op: Optional[str], operand: Any) -> Optional[Set[str]]:
+        if not isinstance(operand, str):
+            return None
+        if op == "starts_with":
+            prefix = operand
+        elif op in PATTERN_OPS:
+            prefix = literal_prefix(operand)
+        else:
+            return None
+        if not prefix:
+            return None
+        doc_ids = set()
+        for position in range(bisect_left(self.entries, (prefix, )),
+                              len(self.entries)):
+            value, doc_id = self.entries[position]
+            if not value.startswith(prefix):
+                break
+            doc_ids.add(doc_id)
+        return doc_ids
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex(DiskIndex):
+    """
+    Maps every three character sequence of the string values of a field to
+    the documents containing it. has_substring, starts_with and ends_with
+    filters, and the literal prefix of like/regex_match patterns, are
+    answered by intersecting the documents of the operand's trigrams.
+    Operands shorter than three characters can't use the index.
+    """
+
+    kind = "trigram"
+
+    def clear(self):
+        super().clear()
+        self.postings: Dict[str, Set[str]] = {}
+        self.values: Dict[str, str] = {}
+
+    def _add(self, doc_id: str, doc: Mapping):
+        value = self._string_value(doc_id, doc)
+        if value is None:
+            return
+        self.values[doc_id] = value
+        for trigram in trigrams(value):
+            self.postings.setdefault(trigram, set()).add(doc_id)
+
+    def _remove(self, doc_id: str):
+        self.others.discard(doc_id)
+        value = self.values.pop(doc_id, None)
+        if value is None:
+            return
+        for trigram in trigrams(value):
+            posting = self.postings[trigram]
+            posting.discard(doc_id)
+            if not posting:
+                del self.postings[trigram]
+
+    def _lookup(self, op: Optional[str], operand: Any) -> Optional[Set[str]]:
+        if not isinstance(operand, str):
+            return None
+        if op in ("has_substring", "starts_with", "ends_with"):
+            text = operand
+        elif op in PATTERN_OPS:
+            text = literal_prefix(operand)
+        else:
+            return None
+        keys = trigrams(text)
+        if not keys:
+            return None
+        postings = sorted((self.postings.get(key, set()) for key in keys),
+                          key=len)
+        return set(postings[0]).intersection(*postings[1:])
+
+
+class TextIndex(DiskIndex):
+    """
+    An inverted index of the words of one or more fields. It serves
+    text_search filters naming the same fields, in any order, and ranks their
+    matches with BM25.
+    """
+
+    kind = "text"
+    # BM25 term frequency saturation and document length normalization.
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, collection: DatastoreEntityName, fields: Sequence[str]):
+        self.fields = list(fields)
+        super().__init__(collection, FIELD_SEPARATOR.join(self.fields))
+
+    def serves(self, field: str) -> bool:
+        return set(text_fields(field)) == set(self.fields)
+
+    def clear(self):
+        super().clear()
+        # Term -> document id -> occurrences of the term in the document.
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.terms: Dict[str, Tuple[str, ...]] = {}
+        self.lengths: Dict[str, int] = {}
+        self.total_length = 0
+
+    def _add(self, doc_id: str, doc: Mapping):
+        tokens = document_tokens(doc, self.fields)
+        counts = Counter(tokens)
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+        self.terms[doc_id] = tuple(counts)
+        self.lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def scores(self, terms: str) -> Dict[str, float]:
+        """
+        Returns the BM25 score of every document containing any of the terms.
+        """
+        documents = len(self.lengths)
+        if not documents:
+            return {}
+        average_length = self.total_length / documents or 1
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(terms)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (documents - len(posting) + 0.5) /
+                           (len(posting) + 0.5))
+            for doc_id, count in posting.items():
+                length = self.lengths[doc_id] / average_length
+                saturation = count + self.K1 * (1 - self.B + self.B * length)
+                scores[doc_id] = (scores.get(doc_id, 0.0) + idf * count *
+                                  (self.K1 + 1) / saturation)
+        return scores
+
+    def _remove(self, doc_id: str):
+        for term in self.terms.pop(doc_id, ()):
+            posting = self.postings[term]
+            del posting[doc_id]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(doc_id, 0)
+
+    def _lookup(self, op: Optional[str], operand: Any) -> Optional[Set[str]]:
+        if op != "text_search":
+            return None
+        doc_ids: Set[str] = set()
+        for term in set(tokenize(operand)):
+            doc_ids.update(self.postings.get(term, ()))
+        return doc_ids
+
+
+def _sort_rank(value: Any) -> Optional[int]:
+    """
+    Groups the values that can be ordered together: numbers, then strings.
+    Other values are left out of range lookups.
+    """
+    if isinstance(value, (int, float)):
+        return 0
+    if isinstance(value, str):
+        return 1
+    return None
+
+
+def _hashable(value: Any) -> bool:
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class MultikeyIndex(DiskIndex):
+    """
+    Maps every element of an array field to the documents holding it, and
+    every field value of the sub-documents in the array to the documents
+    holding such a sub-document, e.g. the "sku" of each line item of an
+    order. It serves contains and excludes filters, range_contains through
+    its elements kept in sorted order, and contains_doc sub-queries with an
+    equals filter.
+
+    Documents whose field isn't an array are candidates of every lookup.
+    """
+
+    kind = "multikey"
+
+    def clear(self):
+        super().clear()
+        self.elements: Dict[Any, Set[str]] = {}
+        self.sub_values: Dict[Tuple[str, Any], Set[str]] = {}
+        # (rank, element, document id) of the orderable elements.
+        self.entries: List[Tuple[int, Any, str]] = []
+        self.arrays: Set[str] = set()
+        self.keys: Dict[str, Tuple[List[Any], List[Tuple[str, Any]]]] = {}
+
+    def build(self, documents: Iterable[Tuple[str, Mapping]]):
+        self.clear()
+        for doc_id, doc in documents:
+            self._append(doc_id)
+            self._index(doc_id, doc, self.entries.append)
+        # Sorting once is much faster than inserting one entry at a time.
+        self.entries.sort()
+        self.built = True
+
+    def _add(self, doc_id: str, doc: Mapping):
+        self._index(doc_id, doc, lambda entry: insort(self.entries, entry))
+
+    def _index(self, doc_id: str, doc: Mapping,
+               add_entry: Callable[[Tuple[int, Any, str]], None]):
+        value = doc.get(self.field)
+        if value is None:
+            return
+        if not isinstance(value, list):
+            self.others.add(doc_id)
+            return
+        self.arrays.add(doc_id)
+        elements = []
+        sub_values = []
+        for element in value:
+            if isinstance(element, dict):
+                for sub_field, sub_value in element.items():
+                    if _hashable(sub_value):
+                        sub_values.append((sub_field, sub_value))
+            elif _hashable(element):
+                elements.append(element)
+        elements = list(set(elements))
+        sub_values = list(set(sub_values))
+        for element in elements:
+            self.elements.setdefault(element, set()).add(doc_id)
+            rank = _sort_rank(element)
+            if rank is not None:
+                add_entry((rank, element, doc_id))
+        for key in sub_values:
+            self.sub_values.setdefault(key, set()).add(doc_id)
+        self.keys[doc_id] = (elements, sub_values)
+
+    def _remove(self, doc_id: str):
+        self.others.discard(doc_id)
+        self.arrays.discard(doc_id)
+        elements, sub_values = self.keys.pop(doc_id, ([], []))
+        for element in elements:
+            self._discard(self.elements, element, doc_id)
+            rank = _sort_rank(element)
+            if rank is not None:
+                entry = (rank, element, doc_id)
+                del self.entries[bisect_left(self.entries, entry)]
+        for key in sub_values:
+            self._discard(self.sub_values, key, doc_id)
+
+    def _discard(self, postings: Dict[Any, Set[str]], key: Any, doc_id: str):
+        posting = postings[key]
+        posting.discard(doc_id)
+        if not posting:
+            del postings[key]
+
+    def _lookup(self, op: Optional[str], operand: Any) -> Optional[Set[str]]:
+        if op == "contains" and _hashable(operand):
+            return set(self.elements.get(operand, ()))
+        if op == "excludes" and _hashable(operand):
+            return self.arrays - self.elements.get(operand, set())
+        if op == "range_contains":
+            return self._range(operand)
+        if op == "contains_doc":
+            return self._sub_documents(operand)
+        return None
+
+    def _range(self, operand: Any) -> Optional[Set[str]]:
+        low, high = operand
+        rank = _sort_rank(low)
+        if rank is None or rank != _sort_rank(high):
+            return None
+        doc_ids = set()
+        for position in range(bisect_left(self.entries, (rank, low)),
+                              len(self.entries)):
+            entry_rank, element, doc_id = self.entries[position]
+            if entry_rank != rank or element > high:
+                break
+            doc_ids.add(doc_id)
+        return doc_ids
+
+    def _sub_documents(self, sub_query: "OnDiskQuery") -> Optional[Set[str]]:
+        """
+        Returns the documents holding a sub-document with the value of every
+        equals filter of the sub-query, when it has no OR filter.
+        """
+        if sub_query.conditions.get("||"):
+            return None
+        doc_ids: Optional[Set[str]] = None
+        for spec in sub_query.filter_specs():
+            if spec.op != "equals" or not _hashable(spec.operand):
+                continue
+            matches = self.sub_values.get((spec.field, spec.operand), set())
+            doc_ids = (set(matches) if doc_ids is None else doc_ids & matches)
+        return doc_ids
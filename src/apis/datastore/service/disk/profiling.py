@@ -0,0 +1,223 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import time
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from apis.datastore.service.instrumented import query_shape
+from apis.datastore.service.interface import DatastoreEntityName
+from .query import OnDiskQuery
+
+PHASES = ("load", "build", "filter", "sort", "serialize", "save")
+
+
+class PredicateStats:
+    """
+    How often one filter of a query was evaluated and matched, and the time
+    spent evaluating it. Patterns are compiled when the query is built, so
+    their compilation isn't included.
+    """
+
+    __slots__ = ("field", "op", "evaluations", "matches", "seconds")
+
+    def __init__(self, field: str, op: Optional[str]):
+        self.field = field
+        self.op = op
+        self.evaluations = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+    def to_dict(self) -> Dict:
+        selectivity = None
+        if self.evaluations:
+            selectivity = round(self.matches / self.evaluations, 4)
+        return {
+            "field": self.field,
+            "op": self.op or "custom",
+            "evaluations": self.evaluations,
+            "matches": self.matches,
+            "selectivity": selectivity,
+            "timeMillis": round(self.seconds * 1000, 3),
+        }
+
+
+class OperationProfile:
+    """
+    The profile of one datastore call.
+    """
+
+    def __init__(self, method: str, collection: str,
+                 query: Optional[OnDiskQuery]):
+        self.method = method
+        self.collection = collection
+        self.query = query
+        self.phases: Dict[str, float] = dict.fromkeys(PHASES, 0.0)
+        self.examined = 0
+        self.returned = 0
+        self.index: Optional[str] = None
+        self.seconds = 0.0
+        self.predicates: Dict[Tuple[str, int], PredicateStats] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0.0) +
+                                 time.perf_counter() - started)
+
+    def use_index(self, name: str):
+        """
+        Records that the call was answered from an index or view rather than
+        by scanning the collection.
+        """
+        self.index = name
+
+    def matches(self, doc: Mapping, query: OnDiskQuery) -> bool:
+        """
+        Evaluates the query the way check_query_matches does, counting each
+        predicate evaluation.
+        """
+        started = time.perf_counter()
+        query_data = query.build()
+        built = time.perf_counter()
+        self.phases["build"] += built - started
+        self.examined += 1
+
+        conditions = query_data.get("conditions", {})
+        matched = all(
+            self._evaluate(condition, doc)
+            for condition in conditions.get("$$", []))
+        if matched and conditions.get("||"):
+            matched = any(
+                self._evaluate(condition, doc)
+                for condition in conditions["||"])
+        self.phases["filter"] += time.perf_counter() - built
+        return matched
+
+    def _evaluate(self, condition: Dict[str, Callable], doc: Mapping) -> bool:
+        for field, predicate in condition.items():
+            stats = self.predicates.get((field, id(predicate)))
+            if stats is None:
+                stats = PredicateStats(field, getattr(predicate, "op", None))
+                self.predicates[(field, id(predicate))] = stats
+            started = time.perf_counter()
+            result = predicate(field, doc)
+            stats.seconds += time.perf_counter() - started
+            stats.evaluations += 1
+            if result:
+                stats.matches += 1
+            else:
+                return False
+        return True
+
+    def to_dict(self) -> Dict:
+        """
+        Describes the call in the spirit of MongoDB's explain output.
+        """
+        if self.index is not None:
+            plan = {"stage": "IXSCAN", "indexName": self.index}
+        elif self.query is not None:
+            plan = {"stage": "COLLSCAN"}
+        else:
+            plan = {"stage": "NONE"}
+        phases = {
+            name: round(seconds * 1000, 3)
+            for name, seconds in self.phases.items()
+        }
+        predicates = [stats.to_dict() for stats in self.predicates.values()]
+        stats = {
+            "nReturned": self.returned,
+            "totalDocsExamined": self.examined,
+            "executionTimeMillis": round(self.seconds * 1000, 3),
+            "phasesMillis": phases,
+            "predicates": predicates,
+        }
+        return {
+            "method": self.method,
+            "collection": self.collection,
+            "query": query_shape(self.query),
+            "winningPlan": plan,
+            "executionStats": stats,
+        }
+
+
+class QueryProfile:
+    """
+    Collects an OperationProfile for every call made on an OnDiskDatastore
+    while its profile() context is active. The call in progress is tracked
+    per task, so concurrent calls inside the block don't mix up.
+    """
+
+    def __init__(self):
+        self.operations: List[OperationProfile] = []
+        self._current: ContextVar[Optional[OperationProfile]] = ContextVar(
+            "current_operation", default=None)
+
+    @property
+    def current(self) -> Optional[OperationProfile]:
+        return self._current.get()
+
+    @contextmanager
+    def operation(self, method: str, collection: DatastoreEntityName,
+                  query: Optional[OnDiskQuery]) -> Iterator[OperationProfile]:
+        name = (collection.value if isinstance(collection, DatastoreEntityName)
+                else str(collection))
+        operation = OperationProfile(method, name, query)
+        self.operations.append(operation)
+        previous = self._current.get()
+        self._current.set(operation)
+        started = time.perf_counter()
+        try:
+            yield operation
+        finally:
+            operation.seconds = time.perf_counter() - started
+            # Not reset with a token: an async generator may be closed from
+            # another context than the one it started in.
+            self._current.set(previous)
+
+    def explain(self) -> Dict:
+        return {"operations": [op.to_dict() for op in self.operations]}
+
+
+def _find_query(args: Tuple, kwargs: Dict) -> Optional[OnDiskQuery]:
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, OnDiskQuery):
+            return value
+    return None
+
+
+def profiled(method: Callable) -> Callable:
+    """
+    Records calls to a datastore method, a coroutine or async generator
+    taking the collection first, in the active profile if there is one.
+    """
+    if inspect.isasyncgenfunction(method):
+
+        async def profile_generator(self, collection, *args, **kwargs):
+            with self._profile.operation(method.__name__, collection,
+                                         _find_query(args, kwargs)):
+                async for item in method(self, collection, *args, **kwargs):
+                    yield item
+
+        @functools.wraps(method)
+        def generator_wrapper(self, collection, *args, **kwargs):
+            # Unprofiled calls get the generator itself, without a wrapping
+            # generator slowing every item down.
+            if self._profile is None:
+                return method(self, collection, *args, **kwargs)
+            return profile_generator(self, collection, *args, **kwargs)
+
+        return generator_wrapper
+
+    @functools.wraps(method)
+    async def wrapper(self, collection, *args, **kwargs) -> Any:
+        if self._profile is None:
+            return await method(self, collection, *args, **kwargs)
+        with self._profile.operation(method.__name__, collection,
+                                     _find_query(args, kwargs)):
+            return await method(self, collection, *args, **kwargs)
+
+    return wrapper
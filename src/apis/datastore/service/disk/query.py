@@ -2,94 +2,151 @@ import re
 from typing import Any, Callable, Dict, Optional
 from apis.datastore.service.interface import LogicalOperator, Query, JoinType
 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from apis.datastore.service.interface import (
     Query,
+    FilterSpec,
     LogicalOperator,
     Operator,
     SortOrder,
     JoinType,
     DatastoreEntityName,
 )
+from apis.datastore.service.text import document_tokens, text_fields, tokenize
 from .helpers import check_query_matches
 
 
+def describe(
+        op: str, operand: Any,
+        predicate: Callable[[Any, Any], bool]) -> Callable[[Any, Any], bool]:
+    """
+    Tags a predicate with the Operator method and operand it was built from,
+    so that queries can describe their filters.
+    """
+    predicate.op = op
+    predicate.operand = operand
+    return predicate
+
+
 class DiskDbOperator(Operator):
 
     def equals(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and doc[field] == operand
+        return describe(
+            "equals", operand,
+            lambda field, doc: field in doc and doc[field] == operand)
 
     def not_equal(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field not in doc or doc[field] != operand
+        return describe(
+            "not_equal", operand,
+            lambda field, doc: field not in doc or doc[field] != operand)
 
     def greater_than(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and doc[field] > operand
+        return describe(
+            "greater_than", operand,
+            lambda field, doc: field in doc and doc[field] > operand)
 
     def less_than(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and doc[field] < operand
+        return describe(
+            "less_than", operand,
+            lambda field, doc: field in doc and doc[field] < operand)
 
     def greater_than_or_equal(self,
                               operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and doc[field] >= operand
+        return describe(
+            "greater_than_or_equal", operand,
+            lambda field, doc: field in doc and doc[field] >= operand)
 
     def less_than_or_equal(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and doc[field] <= operand
+        return describe(
+            "less_than_or_equal", operand,
+            lambda field, doc: field in doc and doc[field] <= operand)
 
     def is_in(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and doc[field] in operand
+        return describe(
+            "is_in", operand,
+            lambda field, doc: field in doc and doc[field] in operand)
 
     def not_in(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: doc[field] not in operand
+        return describe("not_in", operand,
+                        lambda field, doc: doc[field] not in operand)
 
     def like(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and re.match(
-            operand, doc[field])
+        # Compiled once per query rather than looked up in re's cache for
+        # every document.
+        pattern = re.compile(operand)
+        return describe(
+            "like", operand,
+            lambda field, doc: field in doc and pattern.match(doc[field]))
 
     def starts_with(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and doc[field].startswith(
-            operand)
+        return describe(
+            "starts_with", operand,
+            lambda field, doc: field in doc and doc[field].startswith(operand))
 
     def ends_with(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and doc[field].endswith(operand)
+        return describe(
+            "ends_with", operand,
+            lambda field, doc: field in doc and doc[field].endswith(operand))
 
     def regex_match(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and re.match(
-            operand, doc[field])
+        # Compiled once per query rather than looked up in re's cache for
+        # every document.
+        pattern = re.compile(operand)
+        return describe(
+            "regex_match", operand,
+            lambda field, doc: field in doc and pattern.match(doc[field]))
 
     def value_in_range(self, operand: Any) -> Callable[[Any, Any], bool]:
         # single value field is in range
-        return (lambda field, doc: field in doc and operand[0] <= doc[field] <=
-                operand[1])
+        return describe(
+            "value_in_range", operand, lambda field, doc: field in doc and
+            operand[0] <= doc[field] <= operand[1])
 
     def range_contains(self, operand: Any) -> Callable[[Any, Any], bool]:
         # array field has at least one value in range
-        return lambda field, doc: field in doc and any(
-            operand[0] <= value <= operand[1] for value in doc[field])
+        return describe(
+            "range_contains", operand, lambda field, doc: field in doc and any(
+                operand[0] <= value <= operand[1] for value in doc[field]))
 
     def contains(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and operand in doc[field]
+        return describe(
+            "contains", operand,
+            lambda field, doc: field in doc and operand in doc[field])
 
     def contains_doc(self, sub_query: Query) -> Callable[[Any, Any], bool]:
         sub_doc_query = sub_query.build()
-        return lambda field, doc: field in doc and any(
-            check_query_matches(sub_doc, sub_doc_query)
-            for sub_doc in doc[field])
+        return describe(
+            "contains_doc", sub_query, lambda field, doc: field in doc and any(
+                check_query_matches(sub_doc, sub_doc_query)
+                for sub_doc in doc[field]))
 
     def excludes(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and operand not in doc[field]
+        return describe(
+            "excludes", operand,
+            lambda field, doc: field in doc and operand not in doc[field])
 
     def has_substring(self, operand: Any) -> Callable[[Any, Any], bool]:
-        return lambda field, doc: field in doc and operand in doc[field]
+        return describe(
+            "has_substring", operand,
+            lambda field, doc: field in doc and operand in doc[field])
+
+    def text_search(self, terms: str) -> Callable[[Any, Any], bool]:
+        searched = set(tokenize(terms))
+        return describe(
+            "text_search", terms, lambda field, doc: not searched.isdisjoint(
+                document_tokens(doc, text_fields(field))))
 
 
 class OnDiskQuery(Query):
 
     def __init__(self):
         self.conditions = {}
+        self.specs: List[FilterSpec] = []
         self.joins = []
         self.sort_fields = []
         self.limit = None
         self.offset = None
+        self.cursor = None
 
     def ops(self) -> DiskDbOperator:
         return DiskDbOperator()
@@ -104,8 +161,22 @@ class OnDiskQuery(Query):
             self.conditions.setdefault("$$", []).append({field: statement})
         elif logical_op == LogicalOperator.OR:
             self.conditions.setdefault("||", []).append({field: statement})
+        self.specs.append(
+            FilterSpec(
+                field=field,
+                op=getattr(statement, "op", None),
+                operand=getattr(statement, "operand", None),
+                logical_op=logical_op,
+            ))
         return self
 
+    def filter_specs(self) -> List[FilterSpec]:
+        return list(self.specs)
+
+    def sort_specs(self) -> List[Tuple[str, SortOrder]]:
+        return [(sort_field["field"], sort_field["direction"])
+                for sort_field in self.sort_fields]
+
     def join(
         self,
         collection: DatastoreEntityName,
@@ -137,6 +208,10 @@ class OnDiskQuery(Query):
         self.offset = offset
         return self
 
+    def set_cursor(self, cursor: Optional[str]) -> "Query":
+        self.cursor = cursor
+        return self
+
     def build(self) -> Dict:
         query_data = {}
         if self.conditions:
@@ -1,12 +1,54 @@
+from functools import lru_cache
 import logging
 import os
+from typing import Callable, Dict, List
 
+from apis.datastore.service.instrumented import InstrumentedDatastore
 from apis.datastore.service.interface import Datastore
 from apis.datastore.service.mongo import MongoDBDatastore
 from apis.datastore.service.disk import OnDiskDatastore
+from apis.datastore.service.disk.indexes import (
+    DiskIndex,
+    MultikeyIndex,
+    SortedIndex,
+    TextIndex,
+    TrigramIndex,
+)
+from config import DatastoreEntityName
 
 logger = logging.getLogger(__name__)
 
+IndexFactory = Callable[[DatastoreEntityName, str], DiskIndex]
+
+
+def _text_index(collection: DatastoreEntityName, fields: str) -> DiskIndex:
+    return TextIndex(collection, fields.split("+"))
+
+
+DISK_INDEX_KINDS: Dict[str, IndexFactory] = {
+    "sorted": SortedIndex,
+    "trigram": TrigramIndex,
+    "text": _text_index,
+    "multikey": MultikeyIndex,
+}
+
+
+def parse_disk_indexes(setting: str) -> List[DiskIndex]:
+    """
+    Parses a comma separated list of kind:collection.field entries, e.g.
+    "trigram:products.name,sorted:products.sku". Text indexes name their
+    fields separated by "+", e.g. "text:products.name+tags".
+    """
+    indexes = []
+    for entry in filter(None, (part.strip() for part in setting.split(","))):
+        kind, _, target = entry.partition(":")
+        collection, _, field = target.partition(".")
+        if kind not in DISK_INDEX_KINDS or not collection or not field:
+            raise ValueError(f"Invalid on-disk index: {entry}")
+        indexes.append(DISK_INDEX_KINDS[kind](DatastoreEntityName(collection),
+                                              field))
+    return indexes
+
 
 def get_datastore() -> Datastore:
     """
@@ -17,11 +59,33 @@ def get_datastore() -> Datastore:
     mongo_cert_file = os.environ.get("MONGO_DB_CERT_FILE", None)
     if mongo_uri and mongo_dbname:
         logger.info("Using MongoDB datastore")
+        explain_queries = os.environ.get("MONGO_EXPLAIN_QUERIES", "") == "1"
+        # "tokens" for deployments without text indexes.
+        text_search_mode = os.environ.get("MONGO_TEXT_SEARCH", "text")
         datastore = MongoDBDatastore(mongo_uri,
                                      mongo_dbname,
-                                     cert_file=mongo_cert_file)
+                                     cert_file=mongo_cert_file,
+                                     explain_queries=explain_queries,
+                                     text_search_mode=text_search_mode)
     else:
-        datastore = OnDiskDatastore()
+        memory_budget = os.environ.get("ONDISKDB_MEMORY_BUDGET", None)
+        indexes = parse_disk_indexes(os.environ.get("ONDISKDB_INDEXES", ""))
+        datastore = OnDiskDatastore(
+            memory_budget=int(memory_budget) if memory_budget else None,
+            indexes=indexes)
         logger.info("Using on-disk datastore")
 
     return datastore
+
+
+@lru_cache(maxsize=None)
+def get_shared_datastore() -> Datastore:
+    """
+    Returns a datastore shared by the whole process, so that routes depending
+    on it reuse the same connection pool and loaded collections. Its calls
+    are recorded in the process metrics, and the ones slower than
+    DATASTORE_SLOW_QUERY_MS (500 by default) are logged.
+    """
+    slow_query_ms = float(os.environ.get("DATASTORE_SLOW_QUERY_MS", 500))
+    return InstrumentedDatastore(get_datastore(),
+                                 slow_query_seconds=slow_query_ms / 1000)
@@ -0,0 +1,270 @@
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+from config import DatastoreEntityName
+from apis.datastore.service.interface import (
+    ChangeEvent,
+    Datastore,
+    GroupSumResult,
+    PaginatedResult,
+    Query,
+)
+from apis.datastore.service.views import MaterializedView
+from apis.metrics.registry import MetricsRegistry, registry
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                   2.5, 5, 10)
+RESULT_SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+LABELS = ("backend", "method", "collection")
+
+
+def query_shape(query: Optional[Query]) -> Optional[Dict]:
+    """
+    Describes the fields, operators and sort order of a query without any of
+    its values, so that it can be logged without leaking data and grouped
+    with queries of the same shape.
+    """
+    if query is None:
+        return None
+    filters = [{
+        "field": spec.field,
+        "op": spec.op or "custom",
+        "logical_op": spec.logical_op.value,
+    } for spec in query.filter_specs()]
+    sort = [[field, direction.name.lower()]
+            for field, direction in query.sort_specs()]
+    return {
+        "filters": filters,
+        "sort": sort,
+        "limit": getattr(query, "limit", None) is not None,
+        "offset": bool(getattr(query, "offset", None)),
+    }
+
+
+def _collection_label(collection: DatastoreEntityName) -> str:
+    if isinstance(collection, DatastoreEntityName):
+        return collection.value
+    return str(collection)
+
+
+class InstrumentedDatastore(Datastore):
+    """
+    Wraps a Datastore to record the latency of every call per backend,
+    method and collection, the number of documents returned and, for the
+    on-disk datastore, the number of documents scanned. Calls slower than
+    slow_query_seconds are logged along with the shape of their query.
+
+    Methods outside the Datastore interface are passed through to the
+    wrapped datastore.
+    """
+
+    def __init__(self,
+                 datastore: Datastore,
+                 slow_query_seconds: float = 0.5,
+                 metrics: MetricsRegistry = registry):
+        self.datastore = datastore
+        self.backend = type(datastore).__name__
+        self.slow_query_seconds = slow_query_seconds
+        self.latency = metrics.histogram(
+            "datastore_operation_duration_seconds",
+            "Duration of datastore calls", LATENCY_BUCKETS, LABELS)
+        self.result_size = metrics.histogram(
+            "datastore_result_documents",
+            "Number of documents returned by datastore reads",
+            RESULT_SIZE_BUCKETS, LABELS)
+        self.scanned = metrics.counter(
+            "datastore_documents_scanned_total",
+            "Documents tested against a query by the on-disk datastore",
+            LABELS)
+        self.slow_queries = metrics.counter(
+            "datastore_slow_queries_total",
+            "Datastore calls slower than the slow query threshold", LABELS)
+        self.errors = metrics.counter("datastore_errors_total",
+                                      "Datastore calls that raised", LABELS)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.datastore, name)
+
+    async def add(self, collection: DatastoreEntityName,
+                  document: Dict) -> str:
+        return await self._call("add", collection, None,
+                                self.datastore.add(collection, document))
+
+    async def get_one(self, collection: DatastoreEntityName,
+                      query: Query) -> Optional[Dict]:
+        return await self._call("get_one",
+                                collection,
+                                query,
+                                self.datastore.get_one(collection, query),
+                                result_size=lambda doc: int(doc is not None))
+
+    async def get_many(self, collection: DatastoreEntityName,
+                       query: Query) -> List[Dict]:
+        return await self._call("get_many",
+                                collection,
+                                query,
+                                self.datastore.get_many(collection, query),
+                                result_size=len)
+
+    async def iter_many(
+        self,
+        collection: DatastoreEntityName,
+        query: Query,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[Dict]:
+        """
+        Records the time until the iterator is exhausted or closed, including
+        the time the consumer spends between documents.
+        """
+        started = time.perf_counter()
+        scanned_before = self._documents_scanned()
+        returned = 0
+        failed = False
+        try:
+            async for doc in self.datastore.iter_many(collection, query,
+                                                      batch_size):
+                returned += 1
+                yield doc
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._record("iter_many", collection, query, started,
+                         scanned_before, returned, failed)
+
+    async def get_paginated(self, collection: DatastoreEntityName,
+                            query: Query) -> PaginatedResult:
+        return await self._call("get_paginated",
+                                collection,
+                                query,
+                                self.datastore.get_paginated(
+                                    collection, query),
+                                result_size=lambda result: len(result.items))
+
+    async def count(self, collection: DatastoreEntityName,
+                    query: Query) -> int:
+        return await self._call("count", collection, query,
+                                self.datastore.count(collection, query))
+
+    async def sum(self, collection: DatastoreEntityName, field: str,
+                  query: Query) -> float:
+        return await self._call("sum", collection, query,
+                                self.datastore.sum(collection, field, query))
+
+    async def group_sum(
+        self,
+        collection: DatastoreEntityName,
+        group_field: str,
+        value_field: str,
+        query: Query,
+    ) -> List[GroupSumResult]:
+        return await self._call("group_sum",
+                                collection,
+                                query,
+                                self.datastore.group_sum(
+                                    collection, group_field, value_field,
+                                    query),
+                                result_size=len)
+
+    async def aggregate(self, collection: DatastoreEntityName, query: Query,
+                        pipeline: List) -> List:
+        return await self._call(
+            "aggregate", collection, query,
+            self.datastore.aggregate(collection, query, pipeline))
+
+    async def update_one(self, collection: DatastoreEntityName, query: Query,
+                         update_values: Dict) -> Dict:
+        return await self._call(
+            "update_one", collection, query,
+            self.datastore.update_one(collection, query, update_values))
+
+    async def update_many(self, collection: DatastoreEntityName, query: Query,
+                          update_values: Dict) -> List[Dict]:
+        return await self._call(
+            "update_many", collection, query,
+            self.datastore.update_many(collection, query, update_values))
+
+    async def delete_many(self, collection: DatastoreEntityName,
+                          query: Query) -> int:
+        return await self._call("delete_many", collection, query,
+                                self.datastore.delete_many(collection, query))
+
+    async def delete_one(self, collection: DatastoreEntityName,
+                         query: Query) -> bool:
+        return await self._call("delete_one", collection, query,
+                                self.datastore.delete_one(collection, query))
+
+    async def register_view(self, view: MaterializedView) -> None:
+        return await self._call("register_view", view.collection, None,
+                                self.datastore.register_view(view))
+
+    def watch(
+        self,
+        collection: DatastoreEntityName,
+        query: Optional[Query] = None,
+        resume_after: Optional[Any] = None,
+    ) -> AsyncIterator[ChangeEvent]:
+        return self.datastore.watch(collection, query, resume_after)
+
+    def get_query_builder(self) -> Query:
+        return self.datastore.get_query_builder()
+
+    async def _call(self,
+                    method: str,
+                    collection: DatastoreEntityName,
+                    query: Optional[Query],
+                    call: Any,
+                    result_size: Optional[Any] = None) -> Any:
+        started = time.perf_counter()
+        scanned_before = self._documents_scanned()
+        try:
+            result = await call
+        except Exception:
+            self._record(method, collection, query, started, scanned_before,
+                         None, True)
+            raise
+        size = result_size(result) if result_size is not None else None
+        self._record(method, collection, query, started, scanned_before, size,
+                     False)
+        return result
+
+    def _documents_scanned(self) -> Optional[int]:
+        return getattr(self.datastore, "documents_scanned", None)
+
+    def _record(self, method: str, collection: DatastoreEntityName,
+                query: Optional[Query], started: float,
+                scanned_before: Optional[int], result_size: Optional[int],
+                failed: bool):
+        duration = time.perf_counter() - started
+        labels = (self.backend, method, _collection_label(collection))
+        self.latency.observe(labels, duration)
+        if failed:
+            self.errors.inc(labels)
+        if result_size is not None:
+            self.result_size.observe(labels, result_size)
+        scanned = None
+        if scanned_before is not None:
+            # Calls interleaving with this one on the event loop are counted
+            # too, which only matters for iter_many.
+            scanned = self._documents_scanned() - scanned_before
+            self.scanned.inc(labels, scanned)
+
+        if duration < self.slow_query_seconds:
+            return
+        self.slow_queries.inc(labels)
+        entry = {
+            "event": "slow_query",
+            "backend": self.backend,
+            "method": method,
+            "collection": labels[2],
+            "duration_ms": round(duration * 1000, 3),
+            "query": query_shape(query),
+            "returned": result_size,
+            "scanned": scanned,
+            "failed": failed,
+        }
+        logger.warning(f"Slow datastore call: {json.dumps(entry)}",
+                       extra={"slow_query": entry})
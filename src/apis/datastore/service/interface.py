@@ -1,11 +1,26 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from enum import Enum
-from typing import Callable, List, Dict, Any, Optional, Union, Tuple, TypeVar, Generic
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Callable,
+    List,
+    Dict,
+    Any,
+    Optional,
+    Union,
+    Tuple,
+    TypeVar,
+    Generic,
+)
 from pydantic import BaseModel
 from config import DatastoreEntityName
 from apis.datastore.utils import SortOrder
 
+if TYPE_CHECKING:
+    from apis.datastore.service.views import MaterializedView
+
 
 QueryExpression = Union[str, Dict, Callable]
 
@@ -102,12 +117,36 @@ class Operator(ABC):
     def has_substring(self, operand: Any) -> QueryExpression:
         pass
 
+    @abstractmethod
+    def text_search(self, terms: str) -> QueryExpression:
+        """
+        Matches the documents containing any of the words of terms, ignoring
+        case and accents. The filter field may name several fields separated
+        by commas, e.g. query.filter("name,tags", ops.text_search("neon cat")).
+        Unless the query is sorted otherwise, results are ranked by
+        relevance, best first.
+        """
+
 
 class LogicalOperator(Enum):
     AND = "and"
     OR = "or"
 
 
+@dataclass(frozen=True)
+class FilterSpec:
+    """
+    A dataclass describing a filter added to a query: the name of the Operator
+    method that built the statement and its operand. op is None when the
+    statement wasn't built through ops().
+    """
+
+    field: str
+    op: Optional[str]
+    operand: Any
+    logical_op: LogicalOperator
+
+
 class JoinType(Enum):
     INNER = "inner"
     LEFT = "left"
@@ -129,6 +168,30 @@ class PaginatedResult(Generic[T]):
     page: int
     pages: int
     page_size: int
+    # Opaque cursor of the page after this one, None on the last page.
+    next_cursor: Optional[str] = None
+
+
+class ChangeOperation(Enum):
+    INSERT = "insert"
+    UPDATE = "update"
+    DELETE = "delete"
+
+
+@dataclass
+class ChangeEvent:
+    """
+    A dataclass representing a change made to a document in a collection.
+    document is the document after an insert or update, and the deleted
+    document for a delete when the backend has it. resume_token can be passed
+    back to watch to continue right after this event.
+    """
+
+    operation: ChangeOperation
+    collection: str
+    document_id: str
+    document: Optional[Dict]
+    resume_token: Any
 
 
 class Query(ABC):
@@ -149,6 +212,18 @@ class Query(ABC):
         Adds a filter to the query.
         """
 
+    @abstractmethod
+    def filter_specs(self) -> List[FilterSpec]:
+        """
+        Returns the filters added to the query, in the order they were added.
+        """
+
+    @abstractmethod
+    def sort_specs(self) -> List[Tuple[str, SortOrder]]:
+        """
+        Returns the sort fields and directions of the query, in order.
+        """
+
     @abstractmethod
     def join(
         self,
@@ -182,6 +257,15 @@ class Query(ABC):
         Sets the offset of the query.
         """
 
+    @abstractmethod
+    def set_cursor(self, cursor: Optional[str]) -> "Query":
+        """
+        Makes get_paginated return the page after the one that issued the
+        cursor (PaginatedResult.next_cursor). The page is found with a range
+        filter on the sort fields instead of skipping the previous pages, and
+        the offset is ignored.
+        """
+
     @abstractmethod
     def build(self) -> Any:
         """
@@ -204,6 +288,19 @@ class Datastore(ABC):
     ) -> List[Dict]:
         pass
 
+    @abstractmethod
+    def iter_many(
+        self,
+        collection: DatastoreEntityName,
+        query: Query,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[Dict]:
+        """
+        Yields every document matching the query without holding the whole
+        result in memory. Documents are fetched batch_size at a time.
+        """
+        pass
+
     @abstractmethod
     async def get_paginated(
         self, collection: DatastoreEntityName, query: Query
@@ -259,6 +356,30 @@ class Datastore(ABC):
     async def delete_one(self, collection: DatastoreEntityName, query: Query) -> bool:
         pass
 
+    @abstractmethod
+    async def register_view(self, view: "MaterializedView") -> None:
+        """
+        Builds a materialized view from the current data and keeps it up to
+        date on every add/update/delete made through this datastore. Matching
+        count, sum and group_sum calls are then served from the view.
+        """
+        pass
+
+    @abstractmethod
+    def watch(
+        self,
+        collection: DatastoreEntityName,
+        query: Optional[Query] = None,
+        resume_after: Optional[Any] = None,
+    ) -> AsyncIterator[ChangeEvent]:
+        """
+        Yields the insert/update/delete events of a collection as they
+        happen, optionally restricted to documents matching the query.
+        Consumers are never pushed more events than they pull, and can resume
+        after the last event they processed with its resume_token.
+        """
+        pass
+
     @abstractmethod
     def get_query_builder(self) -> Query:
         pass
@@ -1,23 +1,91 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
 import logging
+from bson import ObjectId
+from pymongo import UpdateOne
 from pymongo.collection import ReturnDocument
+from pymongo.errors import OperationFailure
 from motor.motor_asyncio import AsyncIOMotorClient
 
-from .query import MongoDBQuery
+from .indexes import (
+    DEFAULT_INDEX_SPECS,
+    DEFAULT_TEXT_FIELDS,
+    IndexSpec,
+    QueryShapeRecorder,
+    plan_stages,
+    query_shape,
+    text_index_spec,
+    winning_plan,
+)
+from .query import (
+    MongoDBQuery,
+    TEXT_SEARCH_INDEX,
+    TEXT_SEARCH_TOKENS,
+    TEXT_TOKENS_FIELD,
+)
+from apis.datastore.service.text import document_tokens
 from apis.datastore.service.interface import (
+    ChangeEvent,
+    ChangeOperation,
     Datastore,
     PaginatedResult,
     DatastoreEntityName,
     GroupSumResult,
 )
+from apis.datastore.service.cursor import decode_cursor, encode_cursor
+from apis.datastore.service.views import MaterializedView
+from errors import ValidationError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+CHANGE_OPERATIONS = {
+    "insert": ChangeOperation.INSERT,
+    "update": ChangeOperation.UPDATE,
+    "replace": ChangeOperation.UPDATE,
+    "delete": ChangeOperation.DELETE,
+}
+# IndexOptionsConflict and IndexKeySpecsConflict
+INDEX_CONFLICT_CODES = {85, 86}
+
+
+def _to_cursor_value(value: Any) -> Any:
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    return value
+
+
+def _from_cursor_value(value: Any) -> Any:
+    if isinstance(value, dict) and set(value) == {"$oid"}:
+        return ObjectId(value["$oid"])
+    return value
+
 
 class MongoDBDatastore(Datastore):
 
-    def __init__(self, uri: str, dbname: str, cert_file: Optional[str] = None):
+    def __init__(self,
+                 uri: str,
+                 dbname: str,
+                 cert_file: Optional[str] = None,
+                 index_specs: Optional[Dict[DatastoreEntityName,
+                                            List[IndexSpec]]] = None,
+                 explain_queries: bool = False,
+                 text_fields: Optional[Dict[DatastoreEntityName,
+                                            List[str]]] = None,
+                 text_search_mode: str = TEXT_SEARCH_INDEX):
+        """
+        :param index_specs: The indexes ensure_indexes creates, per
+            collection. Defaults to DEFAULT_INDEX_SPECS.
+        :param explain_queries: Explains the first query of every shape and
+            logs a warning when it scans the whole collection. Meant for
+            development, as it costs an extra round trip per new shape.
+        :param text_fields: The fields text searches look into, per
+            collection. Defaults to DEFAULT_TEXT_FIELDS. ensure_indexes
+            creates the index serving them.
+        :param text_search_mode: TEXT_SEARCH_INDEX searches with $text.
+            TEXT_SEARCH_TOKENS stores the words of the text fields in an
+            array on every write and searches it through a multikey index,
+            ranking documents by the number of searched words they contain.
+        """
         kwargs: Dict = {}
         if cert_file:
             kwargs["tlsCAFile"] = cert_file
@@ -25,56 +93,115 @@ class MongoDBDatastore(Datastore):
         self.client = AsyncIOMotorClient(uri, **kwargs)
         self.db = self.client[dbname]
         self.default_limit = 32
+        self.views: Dict[str, List[MaterializedView]] = {}
+        self.text_fields = (DEFAULT_TEXT_FIELDS
+                            if text_fields is None else text_fields)
+        self.text_search_mode = text_search_mode
+        self.index_specs = {
+            collection: list(specs)
+            for collection, specs in (DEFAULT_INDEX_SPECS if index_specs is
+                                      None else index_specs).items()
+        }
+        for collection, fields in self.text_fields.items():
+            self.index_specs.setdefault(collection, []).append(
+                text_index_spec(fields, text_search_mode))
+        self.explain_queries = explain_queries
+        self.query_shapes = QueryShapeRecorder()
+        self._explained_shapes: Set[Tuple] = set()
 
     async def add(self, collection: DatastoreEntityName,
                   document: Dict) -> str:
+        fields = self._token_fields(collection)
+        if fields:
+            document[TEXT_TOKENS_FIELD] = self._text_tokens(document, fields)
         result = await self.db[collection].insert_one(document)
+        await self._update_views(collection, [(None, document)])
         return str(result.inserted_id)
 
     async def get_one(self, collection: DatastoreEntityName,
                       query: MongoDBQuery) -> Optional[Dict]:
+        await self._observe_query(collection, query)
         query_pipeline = query.build()
         result = await self.db[collection].aggregate(query_pipeline).to_list(1)
         return result[0] if result else None
 
     async def get_many(self, collection: DatastoreEntityName,
                        query: MongoDBQuery) -> List[Dict]:
+        await self._observe_query(collection, query)
         query_pipeline = query.build()
         result = (await self.db[collection].aggregate(query_pipeline).to_list(
             query.limit or self.default_limit))
         return result
 
+    async def iter_many(
+        self,
+        collection: DatastoreEntityName,
+        query: MongoDBQuery,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[Dict]:
+        """
+        Iterates an aggregation cursor, so only one batch of documents is held
+        at a time. Unlike get_many there is no default limit.
+        """
+        await self._observe_query(collection, query)
+        query_pipeline = query.build()
+        cursor = self.db[collection].aggregate(query_pipeline,
+                                               batchSize=batch_size,
+                                               allowDiskUse=True)
+        async for doc in cursor:
+            yield doc
+
     async def get_paginated(self, collection: DatastoreEntityName,
                             query: MongoDBQuery) -> PaginatedResult:
-        # Build the aggregation pipeline from the query object, including pagination
-        query_pipeline = query.build()
-        logger.info(f"Query pipeline for get_paginated: {query_pipeline}")
-        # To get the total count, we need a count pipeline without the limit and skip stages
+        await self._observe_query(collection, query)
+        limit = query.limit or self.default_limit
+        keyset = query.keyset()
+        after = None
+        page = query.offset // limit + 1
+        if query.cursor is not None:
+            key, page = decode_cursor(query.cursor, keyset)
+            after = [_from_cursor_value(value) for value in key]
+
+        # The total ignores the cursor, skip and limit of the page
         count_pipeline = [
-            stage for stage in query_pipeline
-            if "$limit" not in stage and "$skip" not in stage
+            stage for stage in query.build()
+            if not {"$sort", "$skip", "$limit"} & set(stage)
         ]
         count_pipeline.append({"$count": "total"})
         total_count = await self.db[collection].aggregate(count_pipeline
                                                           ).to_list(1)
         total = total_count[0]["total"] if total_count else 0
 
-        # Execute the final query with pagination
+        query_pipeline = query.build_page(limit, after)
         cursor = self.db[collection].aggregate(query_pipeline)
-        limit = query.limit or self.default_limit
         items = await cursor.to_list(limit)
-        # Calculate pagination details
-        pages = (total + limit - 1) // limit if limit else 1
-        current_page = (query.offset // limit + 1) if limit else 1
+        pages = (total + limit - 1) // limit
+        next_cursor = None
+        if items and len(items) == limit and page < pages:
+            last = items[-1]
+            next_cursor = encode_cursor(
+                keyset,
+                [_to_cursor_value(last.get(field))
+                 for field, _ in keyset], page + 1)
+        # build_page keeps the score of a text search for the cursor.
+        for item in items:
+            for field in query.hidden_fields():
+                item.pop(field, None)
 
         return PaginatedResult(total=total,
                                items=items,
-                               page=current_page,
+                               page=page,
                                pages=pages,
-                               page_size=limit)
+                               page_size=limit,
+                               next_cursor=next_cursor)
 
     async def count(self, collection: DatastoreEntityName,
                     query: MongoDBQuery) -> int:
+        view = self._find_view(collection, query)
+        if view is not None:
+            summary = await self._read_view(view)
+            return sum(entry["count"] for entry in summary)
+        await self._observe_query(collection, query)
         query_pipeline = query.build()
         count_pipeline = query_pipeline + [{"$count": "total"}]
         result = await self.db[collection].aggregate(count_pipeline).to_list(1)
@@ -86,6 +213,11 @@ class MongoDBDatastore(Datastore):
         field: str,
         query: MongoDBQuery,
     ) -> float:
+        view = self._find_view(collection, query, value_field=field)
+        if view is not None:
+            summary = await self._read_view(view)
+            return sum(entry["total"] for entry in summary)
+        await self._observe_query(collection, query)
         query_pipeline = query.build()
         sum_pipeline = query_pipeline + [{
             "$group": {
@@ -105,6 +237,32 @@ class MongoDBDatastore(Datastore):
         value_field: str,
         query: MongoDBQuery,
     ) -> List[GroupSumResult]:
+        view = self._find_view(collection,
+                               query,
+                               group_field=group_field,
+                               value_field=value_field)
+        if view is not None:
+            result = await self._read_view(view)
+        else:
+            result = await self._group_sum(collection, group_field,
+                                           value_field, query)
+        return [
+            GroupSumResult(
+                group_field=entry["_id"],
+                value_field=value_field,
+                total=entry["total"],
+                count=entry["count"],
+            ) for entry in result
+        ]
+
+    async def _group_sum(
+        self,
+        collection: DatastoreEntityName,
+        group_field: str,
+        value_field: str,
+        query: MongoDBQuery,
+    ) -> List[Dict]:
+        await self._observe_query(collection, query)
         query_pipeline = query.build()
         group_sum_pipeline = query_pipeline + [{
             "$group": {
@@ -117,16 +275,8 @@ class MongoDBDatastore(Datastore):
                 },
             }
         }]
-        result = await self.db[collection].aggregate(group_sum_pipeline
-                                                     ).to_list(1000)
-        return [
-            GroupSumResult(
-                group_field=entry["_id"],
-                value_field=value_field,
-                total=entry["total"],
-                count=entry["count"],
-            ) for entry in result
-        ]
+        return await self.db[collection].aggregate(group_sum_pipeline).to_list(
+            1000)
 
     async def aggregate(self, collection: DatastoreEntityName,
                         query: MongoDBQuery, pipeline: List) -> List:
@@ -136,35 +286,372 @@ class MongoDBDatastore(Datastore):
     async def update_one(self, collection: DatastoreEntityName,
                          query: MongoDBQuery, update_values: Dict) -> Dict:
         match_clause = self._get_match_clause(query)
-        result = await self.db[collection].find_one_and_update(
-            match_clause,
-            {"$set": update_values},
-            return_document=ReturnDocument.AFTER,
-        )
+        if not self.views.get(collection):
+            result = await self.db[collection].find_one_and_update(
+                match_clause,
+                {"$set": update_values},
+                return_document=ReturnDocument.AFTER,
+            )
+        else:
+            before = await self.db[collection].find_one_and_update(
+                match_clause,
+                {"$set": update_values},
+                return_document=ReturnDocument.BEFORE,
+            )
+            if before is None:
+                return None
+            result = await self.db[collection].find_one({"_id": before["_id"]})
+            await self._update_views(collection, [(before, result)])
+        if result is not None and self._changes_text(collection,
+                                                     update_values):
+            await self._refresh_text_tokens(collection, {"_id": result["_id"]})
+        if result is not None:
+            result.pop(TEXT_TOKENS_FIELD, None)
         return result
 
     async def update_many(self, collection: DatastoreEntityName,
                           query: MongoDBQuery,
                           update_values: Dict) -> List[Dict]:
         match_clause = self._get_match_clause(query)
-        await self.db[collection].update_many(match_clause,
-                                              {"$set": update_values})
-        return await self.get_many(collection, MongoDBQuery())
+        if not self.views.get(collection):
+            ids = None
+            if self._changes_text(collection, update_values):
+                ids = await self.db[collection].distinct("_id", match_clause)
+            await self.db[collection].update_many(match_clause,
+                                                  {"$set": update_values})
+            if ids is not None:
+                await self._refresh_text_tokens(collection,
+                                                {"_id": {
+                                                    "$in": ids
+                                                }})
+            return await self.get_many(collection, self.get_query_builder())
+
+        before = await self._view_snapshots(collection, match_clause)
+        ids = [doc["_id"] for doc in before]
+        await self.db[collection].update_many({"_id": {
+            "$in": ids
+        }}, {"$set": update_values})
+        after = {
+            doc["_id"]: doc
+            for doc in await self._view_snapshots(collection,
+                                                  {"_id": {
+                                                      "$in": ids
+                                                  }})
+        }
+        await self._update_views(collection, [(doc, after.get(doc["_id"]))
+                                              for doc in before])
+        if self._changes_text(collection, update_values):
+            await self._refresh_text_tokens(collection, {"_id": {"$in": ids}})
+        return await self.get_many(collection, self.get_query_builder())
 
     async def delete_many(self, collection: DatastoreEntityName,
                           query: MongoDBQuery) -> int:
         match_clause = self._get_match_clause(query)
-        result = await self.db[collection].delete_many(match_clause)
+        if not self.views.get(collection):
+            result = await self.db[collection].delete_many(match_clause)
+            return result.deleted_count
+
+        # Only the documents whose contribution was read are deleted, so that
+        # the views stay consistent with concurrent inserts.
+        before = await self._view_snapshots(collection, match_clause)
+        result = await self.db[collection].delete_many(
+            {"_id": {
+                "$in": [doc["_id"] for doc in before]
+            }})
+        await self._update_views(collection, [(doc, None) for doc in before])
         return result.deleted_count
 
     async def delete_one(self, collection: DatastoreEntityName,
                          query: MongoDBQuery) -> bool:
         match_clause = self._get_match_clause(query)
-        result = await self.db[collection].delete_one(match_clause)
-        return result.deleted_count > 0
+        if not self.views.get(collection):
+            result = await self.db[collection].delete_one(match_clause)
+            return result.deleted_count > 0
+
+        deleted = await self.db[collection].find_one_and_delete(match_clause)
+        if deleted is None:
+            return False
+        await self._update_views(collection, [(deleted, None)])
+        return True
+
+    async def register_view(self, view: MaterializedView) -> None:
+        """
+        Builds the view into its summary collection with a $merge pipeline.
+        Subsequent writes through this datastore $inc the affected groups.
+        """
+        summary = self.db[self._view_collection(view)]
+        await summary.delete_many({})
+        pipeline = [
+            {
+                "$match": view.where
+            },
+            {
+                "$group": {
+                    "_id":
+                    f"${view.group_field}" if view.group_field else None,
+                    "total": {
+                        "$sum":
+                        f"${view.value_field}" if view.value_field else 0
+                    },
+                    "count": {
+                        "$sum": 1
+                    },
+                }
+            },
+            {
+                "$merge": {
+                    "into": self._view_collection(view),
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert",
+                }
+            },
+        ]
+        await self.db[view.collection].aggregate(pipeline).to_list(None)
+        self.views.setdefault(view.collection, []).append(view)
+
+    async def watch(
+        self,
+        collection: DatastoreEntityName,
+        query: Optional[MongoDBQuery] = None,
+        resume_after: Optional[Any] = None,
+        batch_size: Optional[int] = None,
+    ) -> AsyncIterator[ChangeEvent]:
+        """
+        Yields the changes of the collection from a change stream, which
+        requires a replica set. The server only sends the next batch once the
+        current one has been consumed.
+
+        Without pre-images, deletes carry no document and are yielded
+        whatever the query is. Raises ValidationError for text searches with
+        $text, which change streams can't match.
+        """
+        pipeline = []
+        if (query is not None and query.text_terms is not None
+                and self.text_search_mode != TEXT_SEARCH_TOKENS):
+            raise ValidationError(
+                "Text search is not supported when watching a collection")
+        if query is not None:
+            match_clause = self._prefix_fields(self._get_match_clause(query),
+                                               "fullDocument.")
+            pipeline.append({
+                "$match": {
+                    "$or": [{
+                        "operationType": "delete"
+                    }, match_clause]
+                }
+            })
+        async with self.db[collection].watch(
+                pipeline,
+                full_document="updateLookup",
+                resume_after=resume_after,
+                batch_size=batch_size,
+        ) as stream:
+            async for change in stream:
+                operation = CHANGE_OPERATIONS.get(change["operationType"])
+                if operation is None:
+                    continue
+                yield ChangeEvent(
+                    operation=operation,
+                    collection=collection,
+                    document_id=str(change["documentKey"]["_id"]),
+                    document=change.get("fullDocument"),
+                    resume_token=change["_id"],
+                )
+
+    async def ensure_indexes(self):
+        """
+        Creates the declared indexes that don't exist yet. Creating an index
+        that already exists with the same options is a no-op, so this is safe
+        to run on every startup. An index whose options changed is left as it
+        is and reported, since rebuilding it may take a while.
+        """
+        for collection, specs in self.index_specs.items():
+            for spec in specs:
+                try:
+                    await self.db[collection].create_indexes(
+                        [spec.to_index_model()])
+                except OperationFailure as e:
+                    if e.code not in INDEX_CONFLICT_CODES:
+                        raise
+                    logger.warning(
+                        f"Index {spec.index_name()} on {collection} differs "
+                        f"from its declaration and was not changed: {e}")
+
+    async def explain(self, collection: DatastoreEntityName,
+                      query: MongoDBQuery) -> Optional[Dict]:
+        """
+        Returns the winning plan MongoDB chooses for the query.
+        """
+        explanation = await self.db.command(
+            "explain",
+            {
+                "aggregate": self._collection_name(collection),
+                "pipeline": query.build(),
+                "cursor": {},
+            },
+            verbosity="queryPlanner",
+        )
+        return winning_plan(explanation)
+
+    def suggest_indexes(self,
+                        collection: DatastoreEntityName,
+                        min_count: int = 1) -> List[IndexSpec]:
+        """
+        Returns the indexes that would serve the queries run so far on the
+        collection and are not declared yet.
+        """
+        name = self._collection_name(collection)
+        existing = [
+            spec for key, specs in self.index_specs.items()
+            if self._collection_name(key) == name for spec in specs
+        ]
+        return self.query_shapes.suggest(name, existing, min_count)
 
     def get_query_builder(self) -> MongoDBQuery:
-        return MongoDBQuery()
+        return MongoDBQuery(self.text_search_mode)
+
+    def _token_fields(self, collection: DatastoreEntityName) -> List[str]:
+        """
+        Returns the text fields whose words are stored in TEXT_TOKENS_FIELD,
+        none unless text search uses the tokens mode.
+        """
+        if self.text_search_mode != TEXT_SEARCH_TOKENS:
+            return []
+        for key, fields in self.text_fields.items():
+            if self._collection_name(key) == self._collection_name(collection):
+                return fields
+        return []
+
+    def _text_tokens(self, document: Dict, fields: List[str]) -> List[str]:
+        return sorted(set(document_tokens(document, fields)))
+
+    def _changes_text(self, collection: DatastoreEntityName,
+                      update_values: Dict) -> bool:
+        return any(field in update_values
+                   for field in self._token_fields(collection))
+
+    async def _refresh_text_tokens(self, collection: DatastoreEntityName,
+                                   match_clause: Dict):
+        """
+        Recomputes the words of the text fields of the matching documents.
+        """
+        fields = self._token_fields(collection)
+        requests = []
+        async for doc in self.db[collection].find(match_clause,
+                                                  dict.fromkeys(fields, 1)):
+            requests.append(
+                UpdateOne({"_id": doc["_id"]}, {
+                    "$set": {
+                        TEXT_TOKENS_FIELD: self._text_tokens(doc, fields)
+                    }
+                }))
+        if requests:
+            await self.db[collection].bulk_write(requests)
+
+    def _prefix_fields(self, match_clause: Dict, prefix: str) -> Dict:
+        """
+        Rewrites the field names of a match clause, keeping $and/$or/$nor
+        clauses intact.
+        """
+        prefixed = {}
+        for key, value in match_clause.items():
+            if key in ("$and", "$or", "$nor"):
+                prefixed[key] = [
+                    self._prefix_fields(clause, prefix) for clause in value
+                ]
+            else:
+                prefixed[prefix + key] = value
+        return prefixed
+
+    async def _observe_query(self, collection: DatastoreEntityName,
+                             query: MongoDBQuery):
+        name = self._collection_name(collection)
+        self.query_shapes.record(name, query)
+        if not self.explain_queries:
+            return
+        shape = (name, query_shape(query))
+        if shape in self._explained_shapes:
+            return
+        self._explained_shapes.add(shape)
+        plan = await self.explain(collection, query)
+        if plan is None:
+            return
+        if any(
+                stage.get("stage") == "COLLSCAN"
+                for stage in plan_stages(plan)):
+            logger.warning(
+                f"Query on {name} scans the whole collection: {shape[1]}. "
+                f"Suggested indexes: {self.suggest_indexes(collection)}")
+
+    def _collection_name(self, collection: DatastoreEntityName) -> str:
+        if isinstance(collection, DatastoreEntityName):
+            return collection.value
+        return collection
+
+    def _view_collection(self, view: MaterializedView) -> str:
+        return f"_mv_{view.name}"
+
+    def _find_view(
+            self,
+            collection: DatastoreEntityName,
+            query: MongoDBQuery,
+            group_field: Optional[str] = None,
+            value_field: Optional[str] = None) -> Optional[MaterializedView]:
+        for view in self.views.get(collection, []):
+            if view.serves(query, group_field, value_field):
+                return view
+        return None
+
+    async def _read_view(self, view: MaterializedView) -> List[Dict]:
+        return await self.db[self._view_collection(view)].find({
+            "count": {
+                "$gt": 0
+            }
+        }).to_list(None)
+
+    async def _view_snapshots(self, collection: DatastoreEntityName,
+                              match_clause: Dict) -> List[Dict]:
+        """
+        Returns the matching documents projected to the fields the
+        collection's views depend on.
+        """
+        projection = {
+            field: 1
+            for view in self.views[collection]
+            for field in view.fields()
+        }
+        return await self.db[collection].find(match_clause,
+                                              projection).to_list(None)
+
+    async def _update_views(self, collection: DatastoreEntityName,
+                            changes: List[Tuple[Optional[Dict],
+                                                Optional[Dict]]]):
+        """
+        Applies the change deltas to the summary collection of every view on
+        the collection.
+        """
+        for view in self.views.get(collection, []):
+            deltas = view.deltas(changes)
+            if not deltas:
+                continue
+            summary = self.db[self._view_collection(view)]
+            await summary.bulk_write([
+                UpdateOne({"_id": group},
+                          {"$inc": {
+                              "total": total,
+                              "count": count
+                          }},
+                          upsert=True)
+                for group, (total, count) in deltas.items()
+            ])
+            await summary.delete_many({
+                "_id": {
+                    "$in": list(deltas)
+                },
+                "count": {
+                    "$lte": 0
+                }
+            })
 
     def _get_match_clause(self, query: MongoDBQuery) -> Dict:
         query_pipeline = query.build()
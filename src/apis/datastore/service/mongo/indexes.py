@@ -0,0 +1,199 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+from config import DatastoreEntityName
+from .query import MongoDBQuery, TEXT_SEARCH_TOKENS, TEXT_TOKENS_FIELD
+
+# Operators that select a single value, or a few, of a field. An index serves
+# them best with their fields ahead of the sort fields.
+EQUALITY_OPS = {"equals", "is_in"}
+# Operators that select a range of values. Their fields go after the sort
+# fields in an index, so that the index can still provide the sort order.
+RANGE_OPS = {
+    "greater_than",
+    "less_than",
+    "greater_than_or_equal",
+    "less_than_or_equal",
+    "value_in_range",
+    "starts_with",
+}
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    """
+    A dataclass declaring an index of a collection.
+
+    :param keys: The (field, direction) pairs of the index, in order. More
+        than one makes a compound index. The direction of the fields of a
+        text index is pymongo.TEXT.
+    :param expire_after_seconds: Makes a TTL index on a single date field.
+    :param partial_filter: Only indexes the documents matching this filter.
+    """
+
+    keys: Tuple[Tuple[str, Union[int, str]], ...]
+    name: Optional[str] = None
+    unique: bool = False
+    expire_after_seconds: Optional[int] = None
+    partial_filter: Optional[Dict[str, Any]] = field(default=None, hash=False)
+
+    def index_name(self) -> str:
+        return self.name or "_".join(f"{key}_{direction}"
+                                     for key, direction in self.keys)
+
+    def to_index_model(self) -> IndexModel:
+        options: Dict[str, Any] = {"name": self.index_name()}
+        if self.unique:
+            options["unique"] = True
+        if self.expire_after_seconds is not None:
+            options["expireAfterSeconds"] = self.expire_after_seconds
+        if self.partial_filter is not None:
+            options["partialFilterExpression"] = self.partial_filter
+        return IndexModel(list(self.keys), **options)
+
+    def covers(self, keys: Tuple[Tuple[str, int], ...]) -> bool:
+        """
+        Whether the index can serve everything an index on keys would, i.e.
+        keys is a prefix of this index (or of its reverse).
+        """
+        if len(keys) > len(self.keys) or self.partial_filter is not None:
+            return False
+        prefix = self.keys[:len(keys)]
+        reverse = tuple((key, -direction) for key, direction in keys)
+        return prefix == keys or prefix == reverse
+
+
+# The fields searched by text_search, per collection. A collection has a
+# single text index, on all of them.
+DEFAULT_TEXT_FIELDS: Dict[DatastoreEntityName, List[str]] = {
+    DatastoreEntityName.PRODUCT: ["name", "tags"],
+}
+
+
+def text_index_spec(fields: List[str], text_search_mode: str) -> IndexSpec:
+    """
+    Declares the index serving text searches on the fields: a text index, or
+    a multikey index on the array of their words in the tokens mode.
+    """
+    if text_search_mode == TEXT_SEARCH_TOKENS:
+        return IndexSpec(keys=((TEXT_TOKENS_FIELD, ASCENDING), ))
+    return IndexSpec(keys=tuple((field, TEXT) for field in fields))
+
+
+# The indexes created at startup. Add a spec here along with any query that
+# filters or sorts on new fields.
+DEFAULT_INDEX_SPECS: Dict[DatastoreEntityName, List[IndexSpec]] = {
+    DatastoreEntityName.PRODUCT: [
+        IndexSpec(keys=(("created_at", DESCENDING), ("_id", ASCENDING))),
+    ],
+    DatastoreEntityName.ORDER: [
+        IndexSpec(keys=(("status", ASCENDING), ("created_at", DESCENDING))),
+    ],
+    DatastoreEntityName.DESIGN_SPEC: [
+        IndexSpec(keys=(("created_at", DESCENDING), ("_id", ASCENDING))),
+    ],
+}
+
+
+def plan_stages(plan: Dict) -> Iterator[Dict]:
+    """
+    Yields every stage of a query plan tree, from the root down.
+    """
+    yield plan
+    children = list(plan.get("inputStages", []))
+    if "inputStage" in plan:
+        children.append(plan["inputStage"])
+    for child in children:
+        yield from plan_stages(child)
+
+
+def winning_plan(explanation: Dict) -> Optional[Dict]:
+    """
+    Returns the winning plan of an explained aggregation, whether or not the
+    pipeline was pushed down into the query layer.
+    """
+    planner = explanation.get("queryPlanner")
+    if planner is None:
+        for stage in explanation.get("stages", []):
+            cursor = stage.get("$cursor")
+            if cursor is not None:
+                planner = cursor.get("queryPlanner")
+                break
+    if planner is None:
+        return None
+    plan = planner.get("winningPlan")
+    # Slot based execution nests the classic plan tree under queryPlan.
+    return plan.get("queryPlan", plan) if plan else None
+
+
+def query_shape(query: MongoDBQuery) -> Tuple:
+    """
+    Returns the fields and operators of a query without its values, so that
+    queries differing only in values count as the same shape.
+    """
+    filters = tuple((spec.field, spec.op, spec.logical_op.value)
+                    for spec in query.filter_specs())
+    return filters, tuple(query.sorts)
+
+
+def index_for_shape(shape: Tuple) -> Optional[Tuple[Tuple[str, int], ...]]:
+    """
+    Returns the keys of an index serving a query shape following the
+    equality, sort, range rule, or None when no index would help.
+    """
+    filters, sorts = shape
+    if any(logical_op == "or" for _, _, logical_op in filters):
+        # Each branch of an $or needs its own index.
+        return None
+    equality = [field for field, op, _ in filters if op in EQUALITY_OPS]
+    ranges = [field for field, op, _ in filters if op in RANGE_OPS]
+    candidates = ([(field, ASCENDING) for field in equality] + list(sorts) +
+                  [(field, ASCENDING) for field in ranges])
+    keys: List[Tuple[str, int]] = []
+    for key in candidates:
+        if key[0] not in (existing for existing, _ in keys):
+            keys.append(key)
+    if not keys or keys == [("_id", ASCENDING)]:
+        return None
+    return tuple(keys)
+
+
+class QueryShapeRecorder:
+    """
+    Counts the shapes of the queries run per collection, to suggest the
+    indexes that would serve the most frequent ones.
+    """
+
+    def __init__(self):
+        self.shapes: Dict[str, Counter] = {}
+
+    def record(self, collection: str, query: MongoDBQuery):
+        self.shapes.setdefault(collection, Counter())[query_shape(query)] += 1
+
+    def suggest(self,
+                collection: str,
+                existing: List[IndexSpec],
+                min_count: int = 1) -> List[IndexSpec]:
+        """
+        Returns the indexes missing for the query shapes seen at least
+        min_count times, most frequent first. Suggestions that are a prefix
+        of another suggestion are left out.
+        """
+        wanted: Counter = Counter()
+        for shape, count in self.shapes.get(collection, Counter()).items():
+            keys = index_for_shape(shape)
+            if keys is not None and count >= min_count:
+                wanted[keys] += count
+
+        suggestions: List[IndexSpec] = []
+        for keys, _ in wanted.most_common():
+            if any(spec.covers(keys) for spec in existing + suggestions):
+                continue
+            suggestions = [
+                spec for spec in suggestions
+                if not IndexSpec(keys=keys).covers(spec.keys)
+            ]
+            suggestions.append(IndexSpec(keys=keys))
+        return suggestions
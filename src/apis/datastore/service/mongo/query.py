@@ -1,88 +1,144 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from pymongo import ASCENDING, DESCENDING
 from apis.datastore.utils import SortOrder
 from apis.datastore.service.interface import (
+    FilterSpec,
     Operator,
     LogicalOperator,
     Query,
     JoinType,
     DatastoreEntityName,
 )
+from apis.datastore.service.text import tokenize
+
+# Text search modes: a $text query on the collection's text index, or an $in
+# query on an array of the words of its text fields kept in
+# TEXT_TOKENS_FIELD, for deployments without text indexes.
+TEXT_SEARCH_INDEX = "text"
+TEXT_SEARCH_TOKENS = "tokens"
+TEXT_TOKENS_FIELD = "_text_tokens"
+# Holds the relevance of the documents found by a text search while they are
+# sorted by it.
+TEXT_SCORE_FIELD = "_text_score"
+
+
+class MongoStatement(dict):
+    """
+    A filter statement that remembers the Operator method and operand it was
+    built from, so that queries can describe their filters.
+    """
+
+    def __init__(self, op: str, operand: Any, clause: Dict):
+        super().__init__(clause)
+        self.op = op
+        self.operand = operand
 
 
 class MongoOperator(Operator):
 
+    def __init__(self, text_search_mode: str = TEXT_SEARCH_INDEX):
+        self.text_search_mode = text_search_mode
+
     def equals(self, operand: Any) -> Dict:
-        return {"$eq": operand}
+        return MongoStatement("equals", operand, {"$eq": operand})
 
     def not_equal(self, operand: Any) -> Dict:
-        return {"$ne": operand}
+        return MongoStatement("not_equal", operand, {"$ne": operand})
 
     def greater_than(self, operand: Any) -> Dict:
-        return {"$gt": operand}
+        return MongoStatement("greater_than", operand, {"$gt": operand})
 
     def less_than(self, operand: Any) -> Dict:
-        return {"$lt": operand}
+        return MongoStatement("less_than", operand, {"$lt": operand})
 
     def greater_than_or_equal(self, operand: Any) -> Dict:
-        return {"$gte": operand}
+        return MongoStatement("greater_than_or_equal", operand,
+                              {"$gte": operand})
 
     def less_than_or_equal(self, operand: Any) -> Dict:
-        return {"$lte": operand}
+        return MongoStatement("less_than_or_equal", operand, {"$lte": operand})
 
     def is_in(self, operand: Any) -> Dict:
-        return {"$in": operand}
+        return MongoStatement("is_in", operand, {"$in": operand})
 
     def not_in(self, operand: Any) -> Dict:
-        return {"$nin": operand}
+        return MongoStatement("not_in", operand, {"$nin": operand})
 
     def like(self, operand: Any) -> Dict:
-        return {"$regex": operand}
+        return MongoStatement("like", operand, {"$regex": operand})
 
     def starts_with(self, operand: Any) -> Dict:
-        return {"$regex": f"^{operand}"}
+        return MongoStatement("starts_with", operand,
+                              {"$regex": f"^{operand}"})
 
     def ends_with(self, operand: Any) -> Dict:
-        return {"$regex": f"{operand}$"}
+        return MongoStatement("ends_with", operand, {"$regex": f"{operand}$"})
 
     def regex_match(self, operand: Any) -> Dict:
-        return {"$regex": operand}
+        return MongoStatement("regex_match", operand, {"$regex": operand})
 
     def value_in_range(self, operand: Any) -> Dict:
         # single value field is in range
-        return {"$gte": operand[0], "$lte": operand[1]}
+        return MongoStatement("value_in_range", operand, {
+            "$gte": operand[0],
+            "$lte": operand[1]
+        })
 
     def range_contains(self, operand: Any) -> Dict:
         # array field has at least one value in range
-        return {"$elemMatch": {"$gte": operand[0], "$lte": operand[1]}}
+        return MongoStatement(
+            "range_contains", operand,
+            {"$elemMatch": {
+                "$gte": operand[0],
+                "$lte": operand[1]
+            }})
 
     def contains(self, operand: Any) -> Dict:
-        return {"$elemMatch": {"$eq": operand}}
+        return MongoStatement("contains", operand,
+                              {"$elemMatch": {
+                                  "$eq": operand
+                              }})
 
     def contains_doc(self, sub_query: Query) -> Dict:
         operand = sub_query.build()
         sub_doc_match_clause = operand[0]["$match"]
-        return {"$elemMatch": sub_doc_match_clause}
+        return MongoStatement("contains_doc", sub_query,
+                              {"$elemMatch": sub_doc_match_clause})
 
     def excludes(self, operand: Any) -> Dict:
-        return {"$not": {"$elemMatch": {"$eq": operand}}}
+        return MongoStatement("excludes", operand,
+                              {"$not": {
+                                  "$elemMatch": {
+                                      "$eq": operand
+                                  }
+                              }})
 
     def has_substring(self, operand: Any) -> Dict:
-        return {"$regex": operand}
+        return MongoStatement("has_substring", operand, {"$regex": operand})
+
+    def text_search(self, terms: str) -> Dict:
+        if self.text_search_mode == TEXT_SEARCH_TOKENS:
+            return MongoStatement("text_search", terms,
+                                  {"$in": sorted(set(tokenize(terms)))})
+        return MongoStatement("text_search", terms, {"$search": terms})
 
 
 class MongoDBQuery(Query):
 
-    def __init__(self):
+    def __init__(self, text_search_mode: str = TEXT_SEARCH_INDEX):
+        self.text_search_mode = text_search_mode
+        self.text_terms: Optional[str] = None
         self.filters = {"$and": [], "$or": []}
+        self.specs: List[FilterSpec] = []
         self.sorts = []
         self.limit = None
         self.offset = 0
+        self.cursor = None
         self.joins = []
         self.operator = self.ops()
 
     def ops(self) -> Operator:
-        return MongoOperator()
+        return MongoOperator(self.text_search_mode)
 
     def filter(
         self,
@@ -90,12 +146,65 @@ class MongoDBQuery(Query):
         statement: Dict,
         logical_op: LogicalOperator = LogicalOperator.AND,
     ) -> Query:
+        clause = {field: statement}
+        if getattr(statement, "op", None) == "text_search":
+            clause = self._text_search_clause(statement, logical_op)
         if logical_op == LogicalOperator.AND:
-            self.filters["$and"].append({field: statement})
+            self.filters["$and"].append(clause)
         elif logical_op == LogicalOperator.OR:
-            self.filters["$or"].append({field: statement})
+            self.filters["$or"].append(clause)
+        self.specs.append(
+            FilterSpec(
+                field=field,
+                op=getattr(statement, "op", None),
+                operand=getattr(statement, "operand", None),
+                logical_op=logical_op,
+            ))
         return self
 
+    def filter_specs(self) -> List[FilterSpec]:
+        return list(self.specs)
+
+    def _text_search_clause(self, statement: MongoStatement,
+                            logical_op: LogicalOperator) -> Dict:
+        """
+        $text searches the fields of the collection's text index whatever
+        the filter field is.
+        """
+        if self.text_terms is None:
+            self.text_terms = statement.operand
+        if self.text_search_mode == TEXT_SEARCH_TOKENS:
+            return {TEXT_TOKENS_FIELD: statement}
+        if logical_op == LogicalOperator.OR:
+            raise NotImplementedError(
+                "MongoDB text search can't be combined with OR filters.")
+        return {"$text": dict(statement)}
+
+    def ranked(self) -> bool:
+        """
+        Whether the results are ordered by the relevance of a text search,
+        which is the case when the query has one and no sort.
+        """
+        return self.text_terms is not None and not self.sorts
+
+    def _text_score(self) -> Dict:
+        if self.text_search_mode == TEXT_SEARCH_TOKENS:
+            # The number of distinct searched words the document contains.
+            tokens = {"$ifNull": [f"${TEXT_TOKENS_FIELD}", []]}
+            terms = sorted(set(tokenize(self.text_terms)))
+            return {"$size": {"$setIntersection": [tokens, terms]}}
+        return {"$meta": "textScore"}
+
+    def _sorts(self) -> List[Tuple[str, int]]:
+        if self.ranked():
+            return [(TEXT_SCORE_FIELD, DESCENDING)]
+        return self.sorts
+
+    def sort_specs(self) -> List[Tuple[str, SortOrder]]:
+        return [(field, SortOrder.ASCENDING
+                 if direction == ASCENDING else SortOrder.DESCENDING)
+                for field, direction in self.sorts]
+
     def join(
         self,
         collection: DatastoreEntityName,
@@ -131,6 +240,47 @@ class MongoDBQuery(Query):
         self.offset = offset
         return self
 
+    def set_cursor(self, cursor: Optional[str]) -> Query:
+        self.cursor = cursor
+        return self
+
+    def keyset(self) -> List[Tuple[str, int]]:
+        """
+        Returns the sort fields of the query followed by _id, which makes the
+        order total so that pages can be resumed from their last document.
+        """
+        keyset = []
+        for field, direction in self._sorts():
+            keyset.append((field, direction))
+            if field == "_id":
+                return keyset
+        keyset.append(("_id", ASCENDING))
+        return keyset
+
+    def build_page(self,
+                   limit: int,
+                   after: Optional[List[Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Builds the pipeline of one page ordered by keyset(). With the key of
+        the last document of the previous page, the page starts with a range
+        match on the sort fields instead of a $skip, so that it can be read
+        from an index on them.
+        """
+        keyset = self.keyset()
+        query = [
+            stage for stage in self.build()
+            if not {"$sort", "$skip", "$limit", "$project"} & set(stage)
+        ]
+        if after is not None:
+            # After the stage adding the score of a ranked query.
+            position = 2 if self.ranked() else 1
+            query.insert(position, {"$match": keyset_match(keyset, after)})
+        query.append({"$sort": dict(keyset)})
+        if after is None and self.offset:
+            query.append({"$skip": self.offset})
+        query.append({"$limit": limit})
+        return query
+
     def build(self) -> List[Dict[str, Any]]:
         query = []
 
@@ -144,13 +294,20 @@ class MongoDBQuery(Query):
         else:
             query.append({"$match": {}})
 
+        if self.ranked():
+            query.append(
+                {"$addFields": {
+                    TEXT_SCORE_FIELD: self._text_score()
+                }})
+
         # Handle joins (lookup)
         for join in self.joins:
             query.append(join)
 
         # Handle sorting
-        if self.sorts:
-            sort_stage = {"$sort": dict(self.sorts)}
+        sorts = self._sorts()
+        if sorts:
+            sort_stage = {"$sort": dict(sorts)}
             query.append(sort_stage)
 
         # Handle offset (skip)
@@ -163,4 +320,43 @@ class MongoDBQuery(Query):
             limit_stage = {"$limit": self.limit}
             query.append(limit_stage)
 
+        hidden = self.hidden_fields()
+        if hidden:
+            query.append({"$project": dict.fromkeys(hidden, 0)})
+
         return query
+
+    def hidden_fields(self) -> List[str]:
+        """
+        Returns the fields the text search adds to documents, which are left
+        out of the results.
+        """
+        hidden = []
+        if self.ranked():
+            hidden.append(TEXT_SCORE_FIELD)
+        if self.text_search_mode == TEXT_SEARCH_TOKENS:
+            hidden.append(TEXT_TOKENS_FIELD)
+        return hidden
+
+
+def keyset_match(keyset: List[Tuple[str, int]], key: List[Any]) -> Dict:
+    """
+    Matches the documents that sort after key in keyset order. Missing and
+    null values sort before any other value, as they do in $sort.
+    """
+    branches = []
+    for position, (field, direction) in enumerate(keyset):
+        value = key[position]
+        if direction == ASCENDING:
+            after = {field: {"$gt": value}}
+            if value is None:
+                after = {field: {"$ne": None}}
+        elif value is not None:
+            after = {"$or": [{field: {"$lt": value}}, {field: None}]}
+        else:
+            # Nothing sorts after null in descending order.
+            continue
+        previous_fields = [previous for previous, _ in keyset[:position]]
+        equal = dict(zip(previous_fields, key[:position]))
+        branches.append({"$and": [equal, after]} if equal else after)
+    return {"$or": branches} if branches else {"_id": {"$exists": False}}
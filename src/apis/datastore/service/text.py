@@ -0,0 +1,45 @@
+"""
+Tokenization shared by the text search of every backend.
+"""
+import re
+import unicodedata
+from typing import Any, Iterable, List, Mapping
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Separates the fields of a text search filter, e.g. "name,tags".
+FIELD_SEPARATOR = ","
+
+
+def normalize(text: str) -> str:
+    """
+    Folds case and strips accents, so that "Café" and "cafe" are the same
+    token. Words are not stemmed.
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in decomposed
+                   if not unicodedata.combining(char)).casefold()
+
+
+def tokenize(value: Any) -> List[str]:
+    """
+    Returns the tokens of a string, or of the strings in a list, in order.
+    Other values have no tokens.
+    """
+    if isinstance(value, str):
+        return TOKEN_PATTERN.findall(normalize(value))
+    if isinstance(value, (list, tuple)):
+        return [token for item in value for token in tokenize(item)]
+    return []
+
+
+def text_fields(field: str) -> List[str]:
+    """
+    Returns the fields named by the field of a text search filter.
+    """
+    return [
+        name.strip() for name in field.split(FIELD_SEPARATOR) if name.strip()
+    ]
+
+
+def document_tokens(doc: Mapping, fields: Iterable[str]) -> List[str]:
+    return [token for field in fields for token in tokenize(doc.get(field))]
@@ -0,0 +1,189 @@
+from dataclasses import dataclass, field
+from numbers import Number
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+from config import DatastoreEntityName
+from apis.datastore.service.interface import (
+    GroupSumResult,
+    LogicalOperator,
+    Query,
+)
+
+
+@dataclass
+class MaterializedView:
+    """
+    A dataclass describing an aggregate that the datastore maintains
+    incrementally on every write, e.g. the sum of `amount` grouped by
+    `status` where `category` == "hoodies".
+
+    count, sum and group_sum calls whose query filters are exactly the
+    equality filters in `where` are answered from the view instead of
+    scanning the collection.
+    """
+
+    name: str
+    collection: DatastoreEntityName
+    value_field: Optional[str] = None
+    group_field: Optional[str] = None
+    where: Dict[str, Any] = field(default_factory=dict)
+
+    def fields(self) -> List[str]:
+        """
+        Returns the document fields the view depends on.
+        """
+        fields = list(self.where)
+        for view_field in (self.group_field, self.value_field):
+            if view_field and view_field not in fields:
+                fields.append(view_field)
+        return fields
+
+    def contribution(self,
+                     doc: Optional[Mapping]) -> Optional[Tuple[Any, float]]:
+        """
+        Returns the group and value a document adds to the view, or None when
+        the document is not part of it. Like Mongo's $group and $sum, a
+        missing group is None and a non-numeric value counts as 0.
+        """
+        if doc is None:
+            return None
+        for where_field, value in self.where.items():
+            if where_field not in doc or doc[where_field] != value:
+                return None
+        group = doc.get(self.group_field) if self.group_field else None
+        value = doc.get(self.value_field, 0) if self.value_field else 0
+        if not is_number(value):
+            value = 0
+        return group, value
+
+    def deltas(
+        self, changes: Iterable[Tuple[Optional[Mapping], Optional[Mapping]]]
+    ) -> Dict[Any, List[float]]:
+        """
+        Returns the [total, count] change per group caused by replacing each
+        before document with its after document. Inserts have no before
+        document and deletes have no after document.
+        """
+        deltas: Dict[Any, List[float]] = {}
+        for before, after in changes:
+            for doc, sign in ((before, -1), (after, 1)):
+                contribution = self.contribution(doc)
+                if contribution is None:
+                    continue
+                group, value = contribution
+                delta = deltas.setdefault(group, [0, 0])
+                delta[0] += sign * value
+                delta[1] += sign
+        return {
+            group: delta
+            for group, delta in deltas.items() if delta[0] or delta[1]
+        }
+
+    def serves(self,
+               query: Query,
+               group_field: Optional[str] = None,
+               value_field: Optional[str] = None) -> bool:
+        """
+        Whether a count/sum/group_sum call with this query and fields can be
+        answered from the view.
+        """
+        if group_field is not None and group_field != self.group_field:
+            return False
+        if value_field is not None and value_field != self.value_field:
+            return False
+        if getattr(query, "limit", None) is not None:
+            return False
+        return equality_filters(query) == self.where
+
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def equality_filters(query: Query) -> Optional[Dict[str, Any]]:
+    """
+    Returns the query filters as a field to value dict when the query only
+    ANDs `equals` filters on distinct fields, None otherwise.
+    """
+    filters: Dict[str, Any] = {}
+    for spec in query.filter_specs():
+        if (spec.op != "equals" or spec.logical_op != LogicalOperator.AND
+                or spec.field in filters):
+            return None
+        filters[spec.field] = spec.operand
+    if getattr(query, "joins", None):
+        return None
+    return filters
+
+
+class ViewState:
+    """
+    The in-memory [total, count] buckets of a materialized view, keyed by
+    group.
+
+    Scanning the documents raises for a missing field or a non-numeric
+    value where the view counts None or 0, so the documents of the view
+    that have them are counted, and sum and group_sum are left to the scan
+    while there are any.
+    """
+
+    def __init__(self, view: MaterializedView):
+        self.view = view
+        self.groups: Dict[Any, List[float]] = {}
+        self.missing_groups = 0
+        self.invalid_values = 0
+
+    def serves(self,
+               query: Query,
+               group_field: Optional[str] = None,
+               value_field: Optional[str] = None) -> bool:
+        if not self.view.serves(query, group_field, value_field):
+            return False
+        if value_field is not None and self.invalid_values:
+            return False
+        return group_field is None or not self.missing_groups
+
+    def update(self, changes: Iterable[Tuple[Optional[Mapping],
+                                             Optional[Mapping]]]):
+        """
+        Applies the changes, given as for MaterializedView.deltas.
+        """
+        changes = list(changes)
+        self.apply(self.view.deltas(changes))
+        group_field, value_field = self.view.group_field, self.view.value_field
+        for before, after in changes:
+            for doc, sign in ((before, -1), (after, 1)):
+                if doc is None or self.view.contribution(doc) is None:
+                    continue
+                if group_field and group_field not in doc:
+                    self.missing_groups += sign
+                if value_field and not is_number(doc.get(value_field)):
+                    self.invalid_values += sign
+
+    def clear(self):
+        self.groups = {}
+        self.missing_groups = 0
+        self.invalid_values = 0
+
+    def apply(self, deltas: Dict[Any, List[float]]):
+        for group, (total, count) in deltas.items():
+            bucket = self.groups.setdefault(group, [0, 0])
+            bucket[0] += total
+            bucket[1] += count
+            if bucket[1] <= 0:
+                del self.groups[group]
+
+    def count(self) -> int:
+        return sum(int(count) for _, count in self.groups.values())
+
+    def sum(self) -> float:
+        return sum(total for total, _ in self.groups.values())
+
+    def group_sum(self) -> List[GroupSumResult]:
+        return [
+            GroupSumResult(
+                group_field=group,
+                value_field=self.view.value_field,
+                total=total,
+                count=int(count),
+            ) for group, (total, count) in self.groups.items()
+        ]
@@ -0,0 +1,214 @@
+import csv
+from enum import Enum
+import io
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
+import zlib
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import StreamingResponse
+
+from config import DatastoreEntityName
+from apis.datastore.service.factory import get_shared_datastore
+from apis.datastore.service.interface import Datastore, Query as DatastoreQuery
+from utils.router import error_handler, get_error_responses
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# Rows are buffered up to this many bytes before a chunk is sent.
+CHUNK_SIZE = 64 * 1024
+
+# Filter suffixes accepted in the query string, e.g. ?amount__gte=10
+FILTER_OPERATORS = {
+    "eq": "equals",
+    "ne": "not_equal",
+    "gt": "greater_than",
+    "gte": "greater_than_or_equal",
+    "lt": "less_than",
+    "lte": "less_than_or_equal",
+    "in": "is_in",
+    "nin": "not_in",
+    "startswith": "starts_with",
+    "endswith": "ends_with",
+    "substring": "has_substring",
+    "regex": "regex_match",
+    "contains": "contains",
+    "excludes": "excludes",
+    "search": "text_search",
+}
+LIST_OPERATORS = {"in", "nin"}
+# Operators whose value is always a string.
+TEXT_OPERATORS = {"search"}
+RESERVED_PARAMS = {"format", "fields", "batch_size"}
+
+
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+def _parse_value(raw: str) -> Any:
+    """
+    Reads numbers, booleans and null from their JSON form, anything else is
+    kept as a string.
+    """
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+def build_query(datastore: Datastore, params: List[tuple]) -> DatastoreQuery:
+    """
+    Translates query string filters of the form field=value or
+    field__op=value into a datastore query.
+    """
+    query = datastore.get_query_builder()
+    ops = query.ops()
+    for key, raw in params:
+        if key in RESERVED_PARAMS:
+            continue
+        field, _, suffix = key.partition("__")
+        op = FILTER_OPERATORS.get(suffix or "eq")
+        if not field or op is None:
+            raise ValueError(f"Unsupported filter: {key}")
+        if suffix in LIST_OPERATORS:
+            value = [_parse_value(item) for item in raw.split(",")]
+        elif suffix in TEXT_OPERATORS:
+            value = raw
+        else:
+            value = _parse_value(raw)
+        query.filter(field, getattr(ops, op)(value))
+    return query
+
+
+def _to_json(doc: Dict) -> str:
+    return json.dumps(doc, default=str)
+
+
+def _to_cell(value: Any) -> Any:
+    if isinstance(value, (dict, list)):
+        return _to_json(value)
+    return value
+
+
+async def _ndjson_rows(docs: AsyncIterator[Dict],
+                       fields: Optional[List[str]]) -> AsyncIterator[str]:
+    async for doc in docs:
+        if fields:
+            doc = {field: doc[field] for field in fields if field in doc}
+        yield _to_json(doc) + "\n"
+
+
+async def _csv_rows(docs: AsyncIterator[Dict],
+                    fields: Optional[List[str]]) -> AsyncIterator[str]:
+    """
+    Writes one CSV row per document. Without explicit fields, the columns are
+    the fields of the first document.
+    """
+    buffer = io.StringIO()
+    writer = None
+    async for doc in docs:
+        if writer is None:
+            writer = csv.DictWriter(buffer,
+                                    fieldnames=fields or list(doc),
+                                    extrasaction="ignore")
+            writer.writeheader()
+        writer.writerow({key: _to_cell(value) for key, value in doc.items()})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Whether an Accept-Encoding header allows gzip: it is listed, or failing
+    that *, with a q-value above 0.
+    """
+    qualities: Dict[str, float] = {}
+    for entry in accept_encoding.split(","):
+        coding, _, params = entry.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+async def _chunks(rows: AsyncIterator[str],
+                  compress: bool,
+                  chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Groups rows into chunks of about chunk_size bytes, gzipping them on the
+    fly when requested.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    pending: List[bytes] = []
+    pending_size = 0
+    async for row in rows:
+        data = row.encode()
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size < chunk_size:
+            continue
+        chunk = b"".join(pending)
+        pending, pending_size = [], 0
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+
+    chunk = b"".join(pending)
+    if compressor is not None:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+@router.get("/{collection}", responses=get_error_responses)
+@error_handler
+async def export_collection(
+        collection: DatastoreEntityName,
+        request: Request,
+        format: ExportFormat = ExportFormat.NDJSON,
+        fields: Optional[str] = None,
+        batch_size: int = Query(1000, ge=1, le=10000),
+        datastore: Datastore = Depends(get_shared_datastore),
+):
+    """
+    Streams the documents of a collection matching the query string filters
+    as NDJSON or CSV. The response is gzipped when the client accepts it.
+    """
+    query = build_query(datastore, request.query_params.multi_items())
+    docs = datastore.iter_many(collection, query, batch_size=batch_size)
+    field_list = fields.split(",") if fields else None
+    if format == ExportFormat.CSV:
+        rows = _csv_rows(docs, field_list)
+        media_type = "text/csv"
+    else:
+        rows = _ndjson_rows(docs, field_list)
+        media_type = "application/x-ndjson"
+
+    compress = accepts_gzip(request.headers.get("accept-encoding", ""))
+    headers = {
+        "Content-Disposition":
+        f'attachment; filename="{collection.value}.{format.value}"',
+        # Caches must not serve a gzipped export to clients that can't
+        # decode it.
+        "Vary": "Accept-Encoding",
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(_chunks(rows, compress),
+                             media_type=media_type,
+                             headers=headers)
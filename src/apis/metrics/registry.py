@@ -0,0 +1,157 @@
+import bisect
+import math
+from typing import Dict, List, Sequence, Tuple
+
+# Label values, in the order of a metric's label names.
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = [
+        f'{name}="{_escape(str(value))}"'
+        for name, value in zip(names, values)
+    ]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """
+    A monotonically increasing value per label set.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, labels: LabelValues, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, labels)} "
+            f"{_format_number(value)}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Histogram:
+    """
+    Counts observations in cumulative buckets per label set, along with their
+    sum and count, in the way Prometheus histograms do.
+    """
+
+    kind = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 help: str,
+                 buckets: Sequence[float],
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: observations per bucket (the last one is +Inf),
+        # their sum and their count.
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, labels: LabelValues, value: float):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            self.values[labels] = entry
+        counts, totals = entry
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def quantile(self, labels: LabelValues, q: float) -> float:
+        """
+        Returns the upper bound of the bucket holding the q quantile.
+        """
+        entry = self.values.get(labels)
+        if entry is None:
+            return math.nan
+        counts, totals = entry
+        rank = q * totals[1]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf, ), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+    def samples(self) -> List[str]:
+        lines = []
+        bucket_labels = self.labels + ("le", )
+        for labels, (counts, totals) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf, ), counts):
+                cumulative += count
+                bucket_values = labels + (_format_number(bound), )
+                lines.append(f"{self.name}_bucket"
+                             f"{_format_labels(bucket_labels, bucket_values)} "
+                             f"{cumulative}")
+            label_text = _format_labels(self.labels, labels)
+            lines.append(
+                f"{self.name}_sum{label_text} {_format_number(totals[0])}")
+            lines.append(f"{self.name}_count{label_text} {int(totals[1])}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds the metrics of the process and renders them in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, help: str,
+                labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float],
+        labels: Sequence[str] = ()) -> Histogram:
+        return self._register(Histogram(name, help, buckets, labels))
+
+    def _register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
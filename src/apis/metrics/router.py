@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from apis.metrics.registry import registry
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Returns the process metrics in the Prometheus text exposition format.
+    """
+    return PlainTextResponse(registry.render(),
+                             media_type="text/plain; version=0.0.4")
@@ -0,0 +1,275 @@
+from dataclasses import dataclass
+import re
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Tuple
+from cachetools import LRUCache
+
+from apis.datastore.service.interface import (
+    Datastore,
+    LogicalOperator,
+    Query,
+)
+from apis.datastore.utils import SortOrder
+from errors import ValidationError
+
+# Operator name -> (kind of value it takes, relative cost of evaluating it).
+# Costs are a rough measure of how much scanning a filter implies; anchored
+# or indexable comparisons are cheap, pattern matching and array scans are
+# not.
+OPERATORS: Dict[str, Tuple[str, int]] = {
+    "equals": ("scalar", 1),
+    "not_equal": ("scalar", 4),
+    "greater_than": ("scalar", 2),
+    "less_than": ("scalar", 2),
+    "greater_than_or_equal": ("scalar", 2),
+    "less_than_or_equal": ("scalar", 2),
+    "is_in": ("list", 1),
+    "not_in": ("list", 4),
+    "value_in_range": ("pair", 2),
+    "range_contains": ("pair", 6),
+    "starts_with": ("scalar", 3),
+    "ends_with": ("scalar", 10),
+    "like": ("pattern", 10),
+    "regex_match": ("pattern", 10),
+    "has_substring": ("scalar", 10),
+    "contains": ("scalar", 5),
+    "excludes": ("scalar", 8),
+    "contains_doc": ("query", 10),
+    "text_search": ("scalar", 3),
+}
+# Added to a plan's cost when nothing narrows the scan down.
+UNFILTERED_COST = 20
+
+FIELD_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)*$")
+DSL_KEYS = {"where", "any", "sort", "limit", "offset"}
+SORT_KEYS = {"field", "direction"}
+SORT_DIRECTIONS = {
+    "asc": SortOrder.ASCENDING,
+    "desc": SortOrder.DESCENDING,
+}
+
+
+@dataclass(frozen=True)
+class FilterStep:
+    field: str
+    op: str
+    kind: str
+    logical_op: LogicalOperator
+    sub_plan: Optional["QueryPlan"] = None
+
+
+@dataclass(frozen=True)
+class QueryPlan:
+    """
+    A validated query shape. Binding it to the literal values of a request
+    builds the datastore query without parsing or validating the DSL again.
+    """
+
+    filters: Tuple[FilterStep, ...]
+    sort: Tuple[Tuple[str, SortOrder], ...]
+    cost: int
+
+    def bind(self, datastore: Datastore, values: Iterator[Any]) -> Query:
+        query = datastore.get_query_builder()
+        ops = query.ops()
+        for step in self.filters:
+            if step.sub_plan is not None:
+                operand = step.sub_plan.bind(datastore, values)
+            else:
+                operand = next(values)
+                if step.kind == "pair":
+                    operand = tuple(operand)
+                elif step.kind == "pattern":
+                    # Checked on every request, the plan holds no values.
+                    check_pattern(step.op, operand)
+            query.filter(step.field,
+                         getattr(ops, step.op)(operand), step.logical_op)
+        for field, direction in self.sort:
+            query.sort_by(field, direction)
+        return query
+
+
+def check_pattern(op: str, pattern: Any):
+    if not isinstance(pattern, str):
+        raise ValidationError(f"'{op}' takes a regular expression")
+    try:
+        re.compile(pattern)
+    except re.error as error:
+        raise ValidationError(
+            f"Invalid regular expression for '{op}': {error}")
+
+
+def query_shape(dsl: Any) -> Hashable:
+    """
+    Returns the DSL with every literal value replaced by a marker of its
+    kind, so that queries differing only in their values share a plan.
+    """
+    if not isinstance(dsl, dict):
+        return ("invalid", )
+    shape = []
+    for key in ("where", "any"):
+        conditions = dsl.get(key) or []
+        if not isinstance(conditions, list):
+            return ("invalid", )
+        for condition in conditions:
+            if not isinstance(condition, dict):
+                return ("invalid", )
+            value = condition.get("value")
+            kind = OPERATORS.get(condition.get("op"), ("", 0))[0]
+            if kind == "query":
+                value_shape = query_shape(value)
+            elif isinstance(value, list):
+                # Pairs are validated on their length, other lists are not.
+                value_shape = ("list", len(value) if kind == "pair" else None)
+            elif isinstance(value, dict):
+                value_shape = "object"
+            else:
+                value_shape = "scalar"
+            # The keys are part of the shape so that a condition missing
+            # one isn't bound to the plan of a valid one.
+            keys = tuple(sorted(condition))
+            shape.append((key, keys, condition.get("field"),
+                          condition.get("op"), value_shape))
+    sort = dsl.get("sort") or []
+    if not isinstance(sort, list):
+        return ("invalid", )
+    for sorter in sort:
+        if not isinstance(sorter, dict):
+            return ("invalid", )
+        shape.append(("sort", tuple(sorted(sorter)), sorter.get("field"),
+                      sorter.get("direction")))
+    shape.append(tuple(sorted(dsl)))
+    return tuple(shape)
+
+
+def query_values(dsl: Dict) -> Iterator[Any]:
+    """
+    Yields the literal values of the DSL in the order QueryPlan.bind
+    consumes them.
+    """
+    for key in ("where", "any"):
+        for condition in dsl.get(key) or []:
+            if condition["op"] == "contains_doc":
+                yield from query_values(condition["value"])
+            else:
+                yield condition["value"]
+
+
+class QueryPlanner:
+    """
+    Parses and validates the JSON filter DSL into QueryPlans, caching them by
+    query shape:
+
+        {
+            "where": [{"field": "status", "op": "equals", "value": "paid"}],
+            "any": [{"field": "amount", "op": "greater_than", "value": 100}],
+            "sort": [{"field": "amount", "direction": "desc"}],
+            "limit": 50,
+            "offset": 0
+        }
+
+    "where" conditions are ANDed and "any" conditions are ORed. The value of
+    contains_doc is itself a DSL object without sort, limit or offset.
+    """
+
+    def __init__(self, cache_size: int = 512, max_cost: int = 40):
+        self.max_cost = max_cost
+        self.cache: LRUCache = LRUCache(maxsize=cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    def build(self, datastore: Datastore, dsl: Any) -> Query:
+        """
+        Returns the datastore query for the DSL, without its limit and
+        offset.
+        """
+        shape = query_shape(dsl)
+        plan = self.cache.get(shape)
+        if plan is None:
+            self.misses += 1
+            plan = self.plan(dsl)
+            self.cache[shape] = plan
+        else:
+            self.hits += 1
+        return plan.bind(datastore, query_values(dsl))
+
+    def plan(self, dsl: Any, nested: bool = False) -> QueryPlan:
+        if not isinstance(dsl, dict):
+            raise ValidationError("A query must be a JSON object")
+        allowed_keys = {"where", "any"} if nested else DSL_KEYS
+        unknown_keys = set(dsl) - allowed_keys
+        if unknown_keys:
+            raise ValidationError(
+                f"Unsupported query keys: {', '.join(sorted(unknown_keys))}")
+
+        filters = []
+        for key, logical_op in (("where", LogicalOperator.AND),
+                                ("any", LogicalOperator.OR)):
+            conditions = dsl.get(key) or []
+            if not isinstance(conditions, list):
+                raise ValidationError(f"'{key}' must be a list of conditions")
+            for condition in conditions:
+                filters.append(self._plan_filter(condition, logical_op))
+
+        sort = []
+        for sorter in dsl.get("sort") or []:
+            if not isinstance(sorter, dict) or not set(sorter) <= SORT_KEYS:
+                raise ValidationError(
+                    "Sort entries must be objects with 'field' and an "
+                    "optional 'direction'")
+            field = self._validate_field(sorter.get("field"))
+            direction = SORT_DIRECTIONS.get(sorter.get("direction", "asc"))
+            if direction is None:
+                raise ValidationError("Sort direction must be 'asc' or 'desc'")
+            sort.append((field, direction))
+
+        cost = sum(OPERATORS[step.op][1] +
+                   (step.sub_plan.cost if step.sub_plan else 0)
+                   for step in filters)
+        if not any(step.logical_op == LogicalOperator.AND for step in filters):
+            cost += UNFILTERED_COST
+        if not nested and cost > self.max_cost:
+            raise ValidationError(
+                f"Query is too expensive to run (cost {cost}, maximum "
+                f"{self.max_cost}). Add selective 'where' conditions.")
+        return QueryPlan(filters=tuple(filters), sort=tuple(sort), cost=cost)
+
+    def _plan_filter(self, condition: Any,
+                     logical_op: LogicalOperator) -> FilterStep:
+        if not isinstance(condition, dict) or set(condition) != {
+                "field", "op", "value"
+        }:
+            raise ValidationError(
+                "Conditions must have exactly 'field', 'op' and 'value'")
+        op = condition["op"]
+        if op not in OPERATORS:
+            raise ValidationError(f"Unsupported operator: {op}")
+        if op == "text_search" and logical_op == LogicalOperator.OR:
+            # MongoDB can't OR a $text search with other filters.
+            raise ValidationError(
+                "'text_search' can't be used in 'any' conditions")
+        field = condition["field"]
+        if op == "text_search" and isinstance(field, str):
+            # Text searches may look into several fields, e.g. "name,tags".
+            field = ",".join(
+                self._validate_field(part) for part in field.split(","))
+        else:
+            field = self._validate_field(field)
+
+        kind = OPERATORS[op][0]
+        value = condition["value"]
+        if kind == "query":
+            return FilterStep(field, op, kind, logical_op,
+                              self.plan(value, nested=True))
+        if kind == "list" and not isinstance(value, list):
+            raise ValidationError(f"'{op}' takes a list of values")
+        if kind == "pair" and not (isinstance(value, list)
+                                   and len(value) == 2):
+            raise ValidationError(f"'{op}' takes a [low, high] pair")
+        if kind in ("scalar", "pattern") and isinstance(value, (list, dict)):
+            raise ValidationError(f"'{op}' takes a single value")
+        return FilterStep(field, op, kind, logical_op)
+
+    def _validate_field(self, field: Any) -> str:
+        if not isinstance(field, str) or not FIELD_PATTERN.match(field):
+            raise ValidationError(f"Invalid field name: {field}")
+        return field
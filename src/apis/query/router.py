@@ -0,0 +1,71 @@
+import asyncio
+import json
+import logging
+from typing import Any, Dict
+from fastapi import APIRouter, Body, Depends, Response
+
+from config import DatastoreEntityName
+from apis.datastore.service.factory import get_shared_datastore
+from apis.datastore.service.interface import Datastore
+from apis.query.planner import QueryPlanner
+from errors import QueryTimeoutError, ValidationError
+from utils.router import error_handler, get_error_responses
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+MAX_OFFSET = 10000
+# Seconds a query may run before it is abandoned.
+QUERY_TIMEOUT = 10
+
+planner = QueryPlanner()
+
+
+def _page_bounds(dsl: Dict) -> tuple:
+    limit = dsl.get("limit", DEFAULT_LIMIT)
+    offset = dsl.get("offset", 0)
+    if not isinstance(limit, int) or not 0 < limit <= MAX_LIMIT:
+        raise ValidationError(f"'limit' must be between 1 and {MAX_LIMIT}")
+    if not isinstance(offset, int) or not 0 <= offset <= MAX_OFFSET:
+        raise ValidationError(f"'offset' must be between 0 and {MAX_OFFSET}")
+    return limit, offset
+
+
+@router.post("/{collection}", responses=get_error_responses)
+@error_handler
+async def run_query(
+        collection: DatastoreEntityName,
+        dsl: Dict[str, Any] = Body(...),
+        datastore: Datastore = Depends(get_shared_datastore),
+):
+    """
+    Runs a query written in the JSON filter DSL (see QueryPlanner) against
+    the collection and returns at most MAX_LIMIT matching documents.
+    """
+    query = planner.build(datastore, dsl)
+    limit, offset = _page_bounds(dsl)
+    query.set_limit(limit).set_offset(offset)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + QUERY_TIMEOUT
+
+    async def collect():
+        # wait_for can only interrupt collect while it awaits, so the
+        # deadline is also checked whenever a document comes in.
+        items = []
+        async for doc in datastore.iter_many(collection, query):
+            items.append(doc)
+            if loop.time() > deadline:
+                raise asyncio.TimeoutError
+        return items
+
+    try:
+        items = await asyncio.wait_for(collect(), QUERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise QueryTimeoutError(
+            f"Query did not finish within {QUERY_TIMEOUT} seconds")
+    content = json.dumps({"items": items, "count": len(items)}, default=str)
+    return Response(content=content, media_type="application/json")
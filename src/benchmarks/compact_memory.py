@@ -0,0 +1,88 @@
+"""
+Compares the resident memory of an on-disk collection held as plain dicts with
+the same collection held in a CompactCollection.
+
+Run from the src directory:
+
+    python -m benchmarks.compact_memory --docs 500000
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Dict
+
+from config import DatastoreEntityName
+from apis.datastore.service.disk import OnDiskDatastore
+from benchmarks.data import Order, iter_orders, write_collection
+
+def resident_memory() -> int:
+    """
+    Current resident set size in bytes.
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+async def measure(data_dir: str, compact: bool) -> Dict:
+    schemas = {DatastoreEntityName.ORDER: Order} if compact else None
+    datastore = OnDiskDatastore(data_dir=data_dir, schemas=schemas)
+    gc.collect()
+    before = resident_memory()
+    count = await datastore.count(DatastoreEntityName.ORDER,
+                                  datastore.get_query_builder())
+    gc.collect()
+    after = resident_memory()
+    return {
+        "mode": "compact" if compact else "dict",
+        "documents": count,
+        "rss_bytes": after - before,
+    }
+
+
+def run_child(data_dir: str, compact: bool) -> Dict:
+    args = [sys.executable, "-m", "benchmarks.compact_memory"]
+    args += ["--measure", data_dir] + (["--compact"] if compact else [])
+    output = subprocess.run(args, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs", type=int, default=200_000)
+    parser.add_argument("--measure", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--compact", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # Each representation is measured in its own process so that memory
+        # freed by one run doesn't hide the cost of the other.
+        print(json.dumps(asyncio.run(measure(args.measure, args.compact))))
+        return
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        path = os.path.join(data_dir, DatastoreEntityName.ORDER.value + ".json")
+        with open(path, "w") as f:
+            write_collection(f, iter_orders(args.docs))
+
+        plain = run_child(data_dir, compact=False)
+        compact = run_child(data_dir, compact=True)
+
+    print(
+        json.dumps(
+            {
+                "documents": args.docs,
+                "dict": plain,
+                "compact": compact,
+                "reduction": round(plain["rss_bytes"] / compact["rss_bytes"], 2),
+            },
+            indent=2,
+        ))
+
+
+if __name__ == "__main__":
+    main()
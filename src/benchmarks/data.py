@@ -0,0 +1,119 @@
+"""
+Deterministic synthetic documents for the benchmarks.
+"""
+import json
+import random
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, IO, Iterator, List, Optional, Tuple
+from pydantic import BaseModel
+
+from config import DatastoreEntityName
+
+STATUSES = ["pending", "paid", "shipped", "delivered", "refunded"]
+CATEGORIES = ["t-shirts", "hoodies", "mugs", "posters", "stickers", "hats"]
+CURRENCIES = ["USD", "EUR", "GBP"]
+STYLES = ["minimal", "retro", "pixel", "watercolor", "neon", "line-art"]
+COLORS = ["black", "white", "red", "purple", "teal", "orange", "navy"]
+WORDS = [
+    "cat", "cityscape", "sunset", "mountain", "robot", "ocean", "forest",
+    "dragon", "skyline", "galaxy", "flower", "wave", "neon", "vintage"
+]
+# Products are shared by orders and design specs, so a fixed number of them
+# is referenced whatever the size of those collections.
+PRODUCT_POOL = 500
+START = datetime(2024, 1, 1)
+
+
+class Order(BaseModel):
+    product_id: uuid.UUID
+    customer_id: uuid.UUID
+    status: str
+    category: str
+    currency: str
+    amount: float
+    quantity: int
+    discount: Optional[float] = None
+    created_at: datetime
+
+
+def _uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128)))
+
+
+def product_ids(seed: int) -> List[str]:
+    rng = random.Random(seed)
+    return [_uuid(rng) for _ in range(PRODUCT_POOL)]
+
+
+def sku(index: int) -> str:
+    return f"SKU-{index:08d}"
+
+
+def iter_products(count: int, seed: int = 7) -> Iterator[Tuple[str, Dict]]:
+    rng = random.Random(seed + 1)
+    pool = product_ids(seed)
+    for index in range(count):
+        doc_id = pool[index] if index < PRODUCT_POOL else _uuid(rng)
+        yield doc_id, {
+            "sku": sku(index),
+            "name": " ".join(rng.sample(WORDS, 3)),
+            "category": rng.choice(CATEGORIES),
+            "price": round(rng.uniform(5, 120), 2),
+            "tags": rng.sample(WORDS, 3),
+            "active": rng.random() < 0.9,
+            "created_at": (START + timedelta(seconds=index * 53)).isoformat(),
+        }
+
+
+def iter_orders(count: int, seed: int = 7) -> Iterator[Tuple[str, Dict]]:
+    rng = random.Random(seed + 2)
+    pool = product_ids(seed)
+    for index in range(count):
+        yield _uuid(rng), {
+            "product_id": rng.choice(pool),
+            "customer_id": _uuid(rng),
+            "status": rng.choice(STATUSES),
+            "category": rng.choice(CATEGORIES),
+            "currency": rng.choice(CURRENCIES),
+            "amount": round(rng.uniform(5, 250), 2),
+            "quantity": rng.randint(1, 5),
+            "discount": rng.choice([None, 0.1, 0.2]),
+            "created_at": (START + timedelta(seconds=index * 37)).isoformat(),
+        }
+
+
+def iter_design_specs(count: int, seed: int = 7) -> Iterator[Tuple[str, Dict]]:
+    rng = random.Random(seed + 3)
+    pool = product_ids(seed)
+    for index in range(count):
+        yield _uuid(rng), {
+            "product_id": rng.choice(pool),
+            "prompt": " ".join(rng.choices(WORDS, k=8)),
+            "style": rng.choice(STYLES),
+            "colors": rng.sample(COLORS, 3),
+            "created_at": (START + timedelta(seconds=index * 61)).isoformat(),
+        }
+
+
+Generator = Callable[[int, int], Iterator[Tuple[str, Dict]]]
+GENERATORS: Dict[DatastoreEntityName, Generator] = {
+    DatastoreEntityName.PRODUCT: iter_products,
+    DatastoreEntityName.ORDER: iter_orders,
+    DatastoreEntityName.DESIGN_SPEC: iter_design_specs,
+}
+
+
+def write_collection(f: IO[str], documents: Iterator[Tuple[str, Dict]]):
+    """
+    Writes documents in the on-disk datastore's file format without holding
+    them all in memory.
+    """
+    f.write("{")
+    for position, (doc_id, document) in enumerate(documents):
+        if position:
+            f.write(",")
+        f.write(json.dumps(doc_id))
+        f.write(":")
+        f.write(json.dumps(document))
+    f.write("}")
@@ -0,0 +1,400 @@
+"""
+Measures the throughput and latency of the Datastore methods against
+synthetic products, orders and design specs, on the on-disk datastore and on
+a local MongoDB when one is reachable.
+
+Run from the src directory:
+
+    python -m benchmarks.datastore --docs 100000 --output results.json
+
+The results are written as sorted JSON so that runs from two commits can be
+diffed, or compared directly with --baseline.
+"""
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from config import DatastoreEntityName
+from apis.datastore.service.disk import OnDiskDatastore
+from apis.datastore.service.mongo import MongoDBDatastore
+from apis.datastore.service.interface import Datastore
+from apis.datastore.utils import SortOrder
+from benchmarks.data import (
+    CATEGORIES,
+    CURRENCIES,
+    GENERATORS,
+    STATUSES,
+    Order,
+    iter_design_specs,
+    product_ids,
+    sku,
+    write_collection,
+)
+
+DEFAULT_MONGO_URI = "mongodb://localhost:27017"
+MONGO_DBNAME = "datastore_benchmark"
+PAGE_SIZE = 50
+
+
+@dataclass
+class Sizes:
+    orders: int
+    products: int
+    design_specs: int
+    seed: int
+
+
+@dataclass
+class Case:
+    name: str
+    method: str
+    run: Callable[[Datastore, random.Random, Sizes], Awaitable[Any]]
+    writes: bool = False
+
+
+async def point_read(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    query = datastore.get_query_builder()
+    query.filter("sku", query.ops().equals(sku(rng.randrange(sizes.products))))
+    return await datastore.get_one(DatastoreEntityName.PRODUCT, query)
+
+
+async def filtered_scan(datastore: Datastore, rng: random.Random,
+                        sizes: Sizes):
+    query = datastore.get_query_builder()
+    ops = query.ops()
+    query.filter("status", ops.equals(rng.choice(STATUSES)))
+    query.filter("amount", ops.greater_than(rng.uniform(150, 240)))
+    query.set_limit(100)
+    return await datastore.get_many(DatastoreEntityName.ORDER, query)
+
+
+async def streamed_scan(datastore: Datastore, rng: random.Random,
+                        sizes: Sizes):
+    query = datastore.get_query_builder()
+    query.filter("category", query.ops().equals(rng.choice(CATEGORIES)))
+    query.filter("quantity", query.ops().equals(5))
+    return [
+        doc
+        async for doc in datastore.iter_many(DatastoreEntityName.ORDER, query)
+    ]
+
+
+def _product_page_query(datastore: Datastore):
+    query = datastore.get_query_builder()
+    query.sort_by("created_at", SortOrder.DESCENDING)
+    return query.set_limit(PAGE_SIZE)
+
+
+async def offset_page(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    query = _product_page_query(datastore)
+    query.set_offset(rng.randrange(max(sizes.products - PAGE_SIZE, 1)))
+    return await datastore.get_paginated(DatastoreEntityName.PRODUCT, query)
+
+
+def cursor_pages() -> Callable:
+    """
+    Returns a case that reads the product pages in order by following
+    next_cursor, starting over after the last page.
+    """
+    state = {"cursor": None}
+
+    async def cursor_page(datastore: Datastore, rng: random.Random,
+                          sizes: Sizes):
+        query = _product_page_query(datastore).set_cursor(state["cursor"])
+        result = await datastore.get_paginated(DatastoreEntityName.PRODUCT,
+                                               query)
+        state["cursor"] = result.next_cursor
+        return result
+
+    return cursor_page
+
+
+async def count(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    query = datastore.get_query_builder()
+    query.filter("status", query.ops().equals(rng.choice(STATUSES)))
+    return await datastore.count(DatastoreEntityName.ORDER, query)
+
+
+async def sum_amount(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    query = datastore.get_query_builder()
+    query.filter("category", query.ops().equals(rng.choice(CATEGORIES)))
+    return await datastore.sum(DatastoreEntityName.ORDER, "amount", query)
+
+
+async def group_sum(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    query = datastore.get_query_builder()
+    query.filter("currency", query.ops().equals(rng.choice(CURRENCIES)))
+    return await datastore.group_sum(DatastoreEntityName.ORDER, "status",
+                                     "amount", query)
+
+
+async def aggregate(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    query = datastore.get_query_builder()
+    query.filter("status", query.ops().equals(rng.choice(STATUSES)))
+    return await datastore.aggregate(DatastoreEntityName.ORDER, query, [])
+
+
+async def insert(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    _, document = next(iter_design_specs(1, rng.randrange(2**31)))
+    return await datastore.add(DatastoreEntityName.DESIGN_SPEC, document)
+
+
+async def update_one(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    query = datastore.get_query_builder()
+    query.filter("sku", query.ops().equals(sku(rng.randrange(sizes.products))))
+    return await datastore.update_one(DatastoreEntityName.PRODUCT, query,
+                                      {"price": round(rng.uniform(5, 120), 2)})
+
+
+async def update_many(datastore: Datastore, rng: random.Random, sizes: Sizes):
+    query = datastore.get_query_builder()
+    product_id = rng.choice(product_ids(sizes.seed))
+    query.filter("product_id", query.ops().equals(product_id))
+    return await datastore.update_many(DatastoreEntityName.ORDER, query,
+                                       {"flagged": rng.random() < 0.5})
+
+
+def build_cases() -> List[Case]:
+    return [
+        Case("point_read", "get_one", point_read),
+        Case("filtered_scan", "get_many", filtered_scan),
+        Case("streamed_scan", "iter_many", streamed_scan),
+        Case("offset_page", "get_paginated", offset_page),
+        Case("cursor_page", "get_paginated", cursor_pages()),
+        Case("count", "count", count),
+        Case("sum", "sum", sum_amount),
+        Case("group_sum", "group_sum", group_sum),
+        Case("aggregate", "aggregate", aggregate),
+        Case("insert", "add", insert, writes=True),
+        Case("update_one", "update_one", update_one, writes=True),
+        Case("update_many", "update_many", update_many, writes=True),
+    ]
+
+
+def percentile(latencies: List[float], q: float) -> float:
+    """
+    Nearest-rank percentile of sorted latencies.
+    """
+    return latencies[max(math.ceil(q * len(latencies)) - 1, 0)]
+
+
+async def run_case(datastore: Datastore, case: Case, iterations: int,
+                   sizes: Sizes) -> Dict:
+    rng = random.Random(f"{sizes.seed}:{case.name}")
+    try:
+        # Warm up caches and lazily loaded collections.
+        await case.run(datastore, rng, sizes)
+    except NotImplementedError:
+        return {"method": case.method, "skipped": "not implemented"}
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        await case.run(datastore, rng, sizes)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "method": case.method,
+        "ops": iterations,
+        "throughput_ops": round(iterations / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / iterations * 1000, 3),
+    }
+
+
+async def run_cases(datastore: Datastore, args: argparse.Namespace,
+                    sizes: Sizes) -> Dict[str, Dict]:
+    results = {}
+    for case in build_cases():
+        if args.cases and case.name not in args.cases:
+            continue
+        iterations = args.write_iterations if case.writes else args.iterations
+        results[case.name] = await run_case(datastore, case, iterations, sizes)
+        print(f"{type(datastore).__name__} {case.name}: {results[case.name]}",
+              file=sys.stderr)
+    return results
+
+
+def collection_sizes(sizes: Sizes) -> Dict[DatastoreEntityName, int]:
+    return {
+        DatastoreEntityName.PRODUCT: sizes.products,
+        DatastoreEntityName.ORDER: sizes.orders,
+        DatastoreEntityName.DESIGN_SPEC: sizes.design_specs,
+    }
+
+
+async def bench_disk(args: argparse.Namespace, sizes: Sizes) -> Dict:
+    with tempfile.TemporaryDirectory() as data_dir:
+        load_started = time.perf_counter()
+        for collection, size in collection_sizes(sizes).items():
+            path = os.path.join(data_dir, collection.value + ".json")
+            with open(path, "w") as f:
+                write_collection(f, GENERATORS[collection](size, sizes.seed))
+        schemas = {DatastoreEntityName.ORDER: Order} if args.compact else None
+        datastore = OnDiskDatastore(data_dir=data_dir, schemas=schemas)
+        seed_seconds = time.perf_counter() - load_started
+        results = await run_cases(datastore, args, sizes)
+    return {"seed_seconds": round(seed_seconds, 3), "cases": results}
+
+
+async def mongo_available(uri: str) -> bool:
+    client = AsyncIOMotorClient(uri, serverSelectionTimeoutMS=1000)
+    try:
+        await client.admin.command("ping")
+        return True
+    except Exception:
+        return False
+    finally:
+        client.close()
+
+
+async def bench_mongo(args: argparse.Namespace, sizes: Sizes) -> Dict:
+    datastore = MongoDBDatastore(args.mongo_uri, MONGO_DBNAME)
+    await datastore.client.drop_database(MONGO_DBNAME)
+    try:
+        load_started = time.perf_counter()
+        for collection, size in collection_sizes(sizes).items():
+            batch = []
+            for doc_id, document in GENERATORS[collection](size, sizes.seed):
+                batch.append({"_id": doc_id, **document})
+                if len(batch) == 10000:
+                    await datastore.db[collection].insert_many(batch)
+                    batch = []
+            if batch:
+                await datastore.db[collection].insert_many(batch)
+        await datastore.ensure_indexes()
+        seed_seconds = time.perf_counter() - load_started
+        results = await run_cases(datastore, args, sizes)
+    finally:
+        await datastore.client.drop_database(MONGO_DBNAME)
+    return {"seed_seconds": round(seed_seconds, 3), "cases": results}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    Returns a line per case whose p50 latency grew by more than threshold
+    (a fraction) from the baseline run.
+    """
+    regressions = []
+    for backend, run in results["backends"].items():
+        baseline_cases = baseline.get("backends", {}).get(backend,
+                                                          {}).get("cases", {})
+        for name, result in run["cases"].items():
+            before = baseline_cases.get(name, {}).get("p50_ms")
+            after = result.get("p50_ms")
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if change > threshold:
+                regressions.append(f"{backend} {name}: p50 {before}ms -> "
+                                   f"{after}ms (+{change:.0%})")
+    return regressions
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    sizes = Sizes(
+        orders=args.docs,
+        products=max(args.docs // 10, 500),
+        design_specs=max(args.docs // 10, 500),
+        seed=args.seed,
+    )
+    backends = {}
+    if "disk" in args.backends:
+        backends["disk"] = await bench_disk(args, sizes)
+    if "mongo" in args.backends:
+        if await mongo_available(args.mongo_uri):
+            backends["mongo"] = await bench_mongo(args, sizes)
+        else:
+            print(f"No MongoDB at {args.mongo_uri}, skipping it",
+                  file=sys.stderr)
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "iterations": args.iterations,
+            "write_iterations": args.write_iterations,
+            "compact": args.compact,
+            "sizes": {
+                collection.value: size
+                for collection, size in collection_sizes(sizes).items()
+            },
+        },
+        "backends": backends,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--docs",
+                        type=int,
+                        default=10_000,
+                        help="Number of orders. Products and design specs "
+                        "get a tenth of it.")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--write-iterations", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--backends", nargs="+", default=["disk", "mongo"])
+    parser.add_argument("--cases",
+                        nargs="+",
+                        help="Only run these cases, e.g. point_read count")
+    parser.add_argument("--compact",
+                        action="store_true",
+                        help="Keep on-disk orders in a CompactCollection")
+    parser.add_argument("--mongo-uri",
+                        default=os.environ.get("MONGO_BENCH_URI",
+                                               DEFAULT_MONGO_URI))
+    parser.add_argument("--output", help="Write the JSON results to a file")
+    parser.add_argument("--baseline",
+                        help="JSON results of a previous run to compare to")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=0.2,
+                        help="p50 growth reported as a regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
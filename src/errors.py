@@ -28,6 +28,12 @@ class RateLimitError(Exception):
     """
 
 
+class QueryTimeoutError(Exception):
+    """
+    Raise when a query runs for longer than it is allowed to
+    """
+
+
 class ConflictError(Exception):
     """
     Raise when there is a conflict with the data
@@ -3,7 +3,13 @@ from fastapi import FastAPI, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from apis.datastore.service.factory import get_datastore
+from apis.codegen.router import router as codegen_router
+from apis.datastore.service.factory import get_shared_datastore
+from apis.export.router import router as export_router
+from apis.metrics.router import router as metrics_router
+from apis.query.router import router as query_router
+from tools.ai_client.factory import close_ai_clients
+from tools.ai_client.log_writer import get_log_writer
 
 logger = logging.getLogger(__name__)
 all_origins = ["*"]
@@ -20,6 +26,13 @@ async def health_check():
     return HealthResponse(status="ok")
 
 
+async def ensure_indexes():
+    # Only the MongoDB datastore manages indexes.
+    ensure = getattr(get_shared_datastore(), "ensure_indexes", None)
+    if ensure is not None:
+        await ensure()
+
+
 def create_app() -> FastAPI:
     app = FastAPI(
         title="Merchmaker API",
@@ -34,7 +47,17 @@ def create_app() -> FastAPI:
         allow_headers=["*"],
     )
 
+    app.add_event_handler("startup", ensure_indexes)
+    app.add_event_handler("shutdown", close_ai_clients)
+    app.add_event_handler("shutdown", get_log_writer().close)
+
     app.include_router(router, prefix="/api", tags=["api"])
+    app.include_router(metrics_router, prefix="/api", tags=["metrics"])
+    app.include_router(export_router, prefix="/api/export", tags=["export"])
+    app.include_router(query_router, prefix="/api/query", tags=["query"])
+    app.include_router(codegen_router,
+                       prefix="/api/codegen",
+                       tags=["codegen"])
 
     return app
 
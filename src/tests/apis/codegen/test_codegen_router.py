@@ -0,0 +1,57 @@
+import io
+import zipfile
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from apis.codegen.router import get_codegen_client, router
+from tools.ai_client.fake import FakeAiClient
+
+
+def client_for(ai_client: FakeAiClient) -> TestClient:
+    app = FastAPI()
+    app.include_router(router, prefix="/api/codegen")
+
+    def codegen_client():
+        return ai_client
+
+    app.dependency_overrides[get_codegen_client] = codegen_client
+    return TestClient(app)
+
+
+def test_zip_streams_every_generated_file():
+    client = client_for(FakeAiClient(default="generated = True\n"))
+    response = client.get("/api/codegen/zip",
+                          params={
+                              "spec": "A CRUD API for books.",
+                              "project_name": "library"
+                          })
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    assert (response.headers["content-disposition"] ==
+            'attachment; filename="library.zip"')
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.testzip() is None
+    assert sorted(archive.namelist()) == [
+        "library/datamodels.py", "library/main.py", "library/router.py",
+        "library/service.py"
+    ]
+    assert archive.read("library/main.py") == b"generated = True\n"
+
+
+def test_zip_fails_with_an_error_status_when_nothing_is_generated():
+    # The datamodels and main, generated first, both fail.
+    client = client_for(FakeAiClient(failures=[503, 503]))
+    response = client.get("/api/codegen/zip", params={"spec": "Books."})
+    assert response.status_code == 500
+    assert response.headers["content-type"] == "application/json"
+
+
+def test_zip_rejects_project_names_that_leave_the_folder():
+    client = client_for(FakeAiClient())
+    response = client.get("/api/codegen/zip",
+                          params={
+                              "spec": "Books.",
+                              "project_name": "../x"
+                          })
+    assert response.status_code == 422
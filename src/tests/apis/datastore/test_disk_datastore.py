@@ -0,0 +1,154 @@
+import asyncio
+
+from pydantic import BaseModel
+import pytest
+
+from apis.datastore.service.disk import OnDiskDatastore
+from apis.datastore.service.disk.indexes import SortedIndex
+from apis.datastore.utils import SortOrder
+from config import DatastoreEntityName
+
+PRODUCTS = DatastoreEntityName.PRODUCT
+
+
+class Product(BaseModel):
+    name: str
+    price: float
+
+
+def compact_datastore(tmp_path) -> OnDiskDatastore:
+    return OnDiskDatastore(data_dir=str(tmp_path), schemas={PRODUCTS: Product})
+
+
+async def add_products(datastore: OnDiskDatastore, count: int):
+    for number in range(1, count + 1):
+        await datastore.add(PRODUCTS, {
+            "name": f"p{number}",
+            "price": float(number)
+        })
+
+
+def by_name(datastore: OnDiskDatastore, name: str):
+    query = datastore.get_query_builder()
+    return query.filter("name", query.ops().equals(name))
+
+
+def test_sorted_iter_many_is_a_snapshot_of_compact_rows(tmp_path):
+    datastore = compact_datastore(tmp_path)
+
+    async def run():
+        await add_products(datastore, 4)
+        query = datastore.get_query_builder().sort_by("price",
+                                                      SortOrder.ASCENDING)
+        names = []
+        async for doc in datastore.iter_many(PRODUCTS, query):
+            names.append(doc["name"])
+            if len(names) == 1:
+                # Frees the row of p3, which the next insert reuses.
+                await datastore.delete_one(PRODUCTS, by_name(datastore, "p3"))
+                await datastore.add(PRODUCTS, {
+                    "name": "INTRUDER",
+                    "price": 0.0
+                })
+        return names
+
+    assert asyncio.run(run()) == ["p1", "p2", "p3", "p4"]
+
+
+async def read_pages(datastore: OnDiskDatastore, make_query) -> list:
+    pages = []
+    cursor = None
+    while True:
+        result = await datastore.get_paginated(
+            PRODUCTS,
+            make_query().set_limit(3).set_cursor(cursor))
+        pages.append([doc.get("name") for doc in result.items])
+        cursor = result.next_cursor
+        if cursor is None:
+            return pages
+
+
+def test_unsorted_pages_follow_insertion_order(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path))
+
+    async def run():
+        await add_products(datastore, 8)
+        return await read_pages(datastore, datastore.get_query_builder)
+
+    assert asyncio.run(run()) == [["p1", "p2", "p3"], ["p4", "p5", "p6"],
+                                  ["p7", "p8"]]
+
+
+def test_cursor_is_stable_when_earlier_documents_are_deleted(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path))
+
+    async def run():
+        await add_products(datastore, 8)
+        first = await datastore.get_paginated(
+            PRODUCTS,
+            datastore.get_query_builder().set_limit(3))
+        await datastore.delete_one(PRODUCTS, by_name(datastore, "p1"))
+        await datastore.delete_one(PRODUCTS, by_name(datastore, "p2"))
+        second = await datastore.get_paginated(
+            PRODUCTS,
+            datastore.get_query_builder().set_limit(3).set_cursor(
+                first.next_cursor))
+        return [doc["name"] for doc in second.items]
+
+    assert asyncio.run(run()) == ["p4", "p5", "p6"]
+
+
+@pytest.mark.parametrize("direction",
+                         [SortOrder.ASCENDING, SortOrder.DESCENDING])
+def test_sorted_index_serves_pages_after_a_cursor(tmp_path, direction):
+    indexed = OnDiskDatastore(data_dir=str(tmp_path / "indexed"),
+                              indexes=[SortedIndex(PRODUCTS, "name")])
+    plain = OnDiskDatastore(data_dir=str(tmp_path / "plain"))
+
+    async def run(datastore: OnDiskDatastore):
+        await add_products(datastore, 9)
+        # Ties on the name are broken by insertion order.
+        await datastore.add(PRODUCTS, {"name": "p5", "price": 0.0})
+        await datastore.add(PRODUCTS, {"price": 0.0})
+        datastore.documents_scanned = 0
+        return await read_pages(
+            datastore,
+            lambda: datastore.get_query_builder().sort_by("name", direction))
+
+    pages = asyncio.run(run(indexed))
+    assert pages == asyncio.run(run(plain))
+    names = [name for page in pages for name in page if name is not None]
+    assert names == sorted(names, reverse=direction == SortOrder.DESCENDING)
+    assert sum(len(page) for page in pages) == 11
+    assert indexed.documents_scanned < plain.documents_scanned
+
+
+def test_profile_records_only_the_task_that_entered_it(tmp_path):
+    datastore = compact_datastore(tmp_path)
+
+    async def profiled(entered: asyncio.Event, done: asyncio.Event):
+        with datastore.profile() as profile:
+            entered.set()
+            await done.wait()
+            await datastore.get_one(PRODUCTS, by_name(datastore, "p1"))
+            with datastore.profile() as inner:
+                await datastore.count(PRODUCTS, by_name(datastore, "p2"))
+            await datastore.count(PRODUCTS, by_name(datastore, "p3"))
+        return profile, inner
+
+    async def concurrent(entered: asyncio.Event, done: asyncio.Event):
+        await entered.wait()
+        await datastore.get_many(PRODUCTS, by_name(datastore, "p2"))
+        done.set()
+
+    async def run():
+        await add_products(datastore, 3)
+        entered, done = asyncio.Event(), asyncio.Event()
+        (profile, inner), _ = await asyncio.gather(profiled(entered, done),
+                                                   concurrent(entered, done))
+        return profile, inner
+
+    profile, inner = asyncio.run(run())
+    assert [op.method for op in profile.operations] == ["get_one", "count"]
+    assert [op.method for op in inner.operations] == ["count"]
+    assert datastore._profile is None
@@ -0,0 +1,63 @@
+import pytest
+
+from apis.datastore.service.disk.indexes import (
+    DiskIndex,
+    MultikeyIndex,
+    SortedIndex,
+    TextIndex,
+    TrigramIndex,
+)
+from config import DatastoreEntityName
+
+PRODUCTS = DatastoreEntityName.PRODUCT
+
+DOCUMENTS = [
+    ("1", {
+        "name": "apple pie",
+        "tags": ["fruit", "sweet"]
+    }),
+    ("2", {
+        "name": "banana bread",
+        "tags": ["fruit"]
+    }),
+    ("3", {
+        "tags": "none"
+    }),
+    ("4", {
+        "name": 4,
+        "tags": []
+    }),
+    ("5", {
+        "name": "apple juice",
+        "tags": ["drink", "fruit"]
+    }),
+]
+
+LOOKUPS = [
+    (lambda: SortedIndex(PRODUCTS, "name"), "starts_with", "apple"),
+    (lambda: TrigramIndex(PRODUCTS, "name"), "has_substring", "ana"),
+    (lambda: TextIndex(PRODUCTS, ["name"]), "text_search", "apple bread"),
+    (lambda: MultikeyIndex(PRODUCTS, "tags"), "contains", "fruit"),
+]
+
+
+def test_disk_index_is_abstract():
+    with pytest.raises(TypeError):
+        DiskIndex(PRODUCTS, "name")  # type: ignore
+
+
+@pytest.mark.parametrize("make_index, op, operand", LOOKUPS)
+def test_updates_match_a_rebuild(make_index, op, operand):
+    index = make_index()
+    # Every document is indexed once without its fields, then updated.
+    for doc_id, _ in DOCUMENTS:
+        index.update(doc_id, {})
+    for doc_id, doc in DOCUMENTS:
+        index.update(doc_id, doc)
+    index.remove("2")
+
+    rebuilt = make_index()
+    rebuilt.build(doc for doc in DOCUMENTS if doc[0] != "2")
+    assert index.candidates(op, operand) == rebuilt.candidates(op, operand)
+    assert index.candidates(op, operand)
+    assert index.others == rebuilt.others
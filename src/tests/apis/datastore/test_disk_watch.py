@@ -0,0 +1,138 @@
+import asyncio
+from typing import AsyncIterator, List
+
+import pytest
+
+from apis.datastore.service.disk import OnDiskDatastore
+from apis.datastore.service.disk.changes import ChangeStreamLagError
+from apis.datastore.service.interface import ChangeEvent, ChangeOperation
+from config import DatastoreEntityName
+
+ORDERS = DatastoreEntityName.ORDER
+
+
+async def read(stream: AsyncIterator[ChangeEvent],
+               count: int) -> List[ChangeEvent]:
+    events = []
+    try:
+        async for event in stream:
+            events.append(event)
+            if len(events) == count:
+                return events
+    finally:
+        await stream.aclose()
+    return events
+
+
+async def watching(datastore: OnDiskDatastore, count: int,
+                   **options) -> "asyncio.Task":
+    """
+    Starts a watcher reading count events, once it has subscribed.
+    """
+    task = asyncio.ensure_future(
+        read(datastore.watch(ORDERS, **options), count))
+    await asyncio.sleep(0)
+    return task
+
+
+def by_number(datastore: OnDiskDatastore, number: int):
+    query = datastore.get_query_builder()
+    return query.filter("number", query.ops().equals(number))
+
+
+def test_yields_inserts_updates_and_deletes(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path))
+
+    async def run():
+        watcher = await watching(datastore, 3)
+        doc_id = await datastore.add(ORDERS, {"number": 1})
+        await datastore.update_one(ORDERS, by_number(datastore, 1),
+                                   {"paid": True})
+        await datastore.delete_one(ORDERS, by_number(datastore, 1))
+        return doc_id, await watcher
+
+    doc_id, events = asyncio.run(run())
+    assert [event.operation for event in events] == [
+        ChangeOperation.INSERT, ChangeOperation.UPDATE, ChangeOperation.DELETE
+    ]
+    assert {event.document_id for event in events} == {doc_id}
+    assert events[0].document == {"number": 1}
+    assert events[1].document == {"number": 1, "paid": True}
+
+
+def test_filters_events_with_the_query(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path))
+    query = datastore.get_query_builder()
+    query.filter("number", query.ops().greater_than(2))
+
+    async def run():
+        watcher = await watching(datastore, 2, query=query)
+        for number in range(1, 5):
+            await datastore.add(ORDERS, {"number": number})
+        return await watcher
+
+    events = asyncio.run(run())
+    assert [event.document["number"] for event in events] == [3, 4]
+
+
+def test_resumes_after_a_token(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path))
+
+    async def run():
+        for number in range(1, 5):
+            await datastore.add(ORDERS, {"number": number})
+        everything = await watching(datastore, 2)
+        await datastore.add(ORDERS, {"number": 5})
+        await datastore.add(ORDERS, {"number": 6})
+        token = (await everything)[0].resume_token
+        return await read(datastore.watch(ORDERS, resume_after=token), 1)
+
+    events = asyncio.run(run())
+    assert [event.document["number"] for event in events] == [6]
+
+
+def test_rejects_a_token_from_another_history(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path))
+
+    async def run():
+        await read(datastore.watch(ORDERS, resume_after="other:3"), 1)
+
+    with pytest.raises(ChangeStreamLagError):
+        asyncio.run(run())
+
+
+def test_writers_wait_for_a_watcher_behind_by_a_burst(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path), change_history=3)
+
+    async def run():
+        watcher = await watching(datastore, 10)
+        for number in range(10):
+            await datastore.add(ORDERS, {"number": number})
+        return await watcher
+
+    events = asyncio.run(run())
+    assert [event.document["number"] for event in events] == list(range(10))
+
+
+def test_stalled_watcher_lags_once_writers_stop_waiting(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path),
+                                change_history=3,
+                                change_wait_seconds=0.05)
+
+    async def run():
+        stream = datastore.watch(ORDERS)
+        # Reads one event, then stalls.
+        first = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0)
+        await datastore.add(ORDERS, {"number": 0})
+        await first
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for number in range(1, 6):
+            await datastore.add(ORDERS, {"number": number})
+        assert loop.time() - started >= 0.05
+        with pytest.raises(ChangeStreamLagError):
+            await stream.__anext__()
+        await stream.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,51 @@
+from bson import ObjectId
+import pytest
+
+from apis.datastore.service.cursor import decode_cursor, encode_cursor
+from apis.datastore.service.mongo.query import MongoDBQuery, keyset_match
+from apis.datastore.utils import SortOrder
+from errors import ValidationError
+
+
+def test_keyset_ends_with_id():
+    query = MongoDBQuery().sort_by("name", SortOrder.DESCENDING)
+    assert query.keyset() == [("name", -1), ("_id", 1)]
+
+
+def test_keyset_match_resumes_after_the_key():
+    keyset = [("name", 1), ("_id", 1)]
+    later_name = {"name": {"$gt": "b"}}
+    same_name = {"$and": [{"name": "b"}, {"_id": {"$gt": 7}}]}
+    assert keyset_match(keyset, ["b", 7]) == {"$or": [later_name, same_name]}
+
+
+def test_keyset_match_puts_null_last_in_descending_order():
+    keyset = [("name", -1), ("_id", 1)]
+    earlier_or_null = {"$or": [{"name": {"$lt": "b"}}, {"name": None}]}
+    assert keyset_match(keyset, ["b", 7])["$or"][0] == earlier_or_null
+    # Only the documents with the same null name sort after a null one.
+    same_null = {"$and": [{"name": None}, {"_id": {"$gt": 7}}]}
+    assert keyset_match(keyset, [None, 7]) == {"$or": [same_null]}
+
+
+def test_page_after_a_cursor_matches_instead_of_skipping():
+    query = MongoDBQuery().sort_by("name").set_offset(30)
+    pipeline = query.build_page(10, ["b", 7])
+    assert pipeline[0] == {"$match": {}}
+    assert pipeline[1] == {"$match": keyset_match(query.keyset(), ["b", 7])}
+    assert pipeline[2:] == [{"$sort": {"name": 1, "_id": 1}}, {"$limit": 10}]
+    assert {"$skip": 30} in query.build_page(10)
+
+
+def test_cursor_round_trip():
+    keyset = [("name", 1), ("_id", 1)]
+    key = ["b", {"$oid": str(ObjectId())}]
+    assert decode_cursor(encode_cursor(keyset, key, 3), keyset) == (key, 3)
+
+
+def test_cursor_of_another_sort_order_is_rejected():
+    cursor = encode_cursor([("name", 1), ("_id", 1)], ["b", 7], 2)
+    with pytest.raises(ValidationError):
+        decode_cursor(cursor, [("name", -1), ("_id", 1)])
+    with pytest.raises(ValidationError):
+        decode_cursor("not a cursor", [("name", 1), ("_id", 1)])
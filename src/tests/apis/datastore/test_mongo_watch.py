@@ -0,0 +1,119 @@
+import asyncio
+from typing import Dict, List
+
+from bson import ObjectId
+import pytest
+
+from apis.datastore.service.interface import ChangeOperation
+from apis.datastore.service.mongo import MongoDBDatastore
+from config import DatastoreEntityName
+from errors import ValidationError
+
+ORDERS = DatastoreEntityName.ORDER
+
+
+class FakeChangeStream:
+    """
+    Stands in for the change stream of a replica set, replaying changes.
+    """
+
+    def __init__(self, changes: List[Dict]):
+        self.changes = changes
+
+    async def __aenter__(self) -> "FakeChangeStream":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def __aiter__(self):
+        for change in self.changes:
+            yield change
+
+
+class FakeCollection:
+
+    def __init__(self, changes: List[Dict]):
+        self.changes = changes
+        self.watches: List = []
+
+    def watch(self, pipeline: List[Dict], **options) -> FakeChangeStream:
+        self.watches.append((pipeline, options))
+        return FakeChangeStream(self.changes)
+
+
+@pytest.fixture
+def datastore():
+    datastore = MongoDBDatastore("mongodb://localhost:27017", "test")
+    yield datastore
+    datastore.client.close()
+
+
+def change(operation: str, doc_id: ObjectId, token: int, **document):
+    change = {
+        "_id": {
+            "_data": str(token)
+        },
+        "operationType": operation,
+        "documentKey": {
+            "_id": doc_id
+        },
+    }
+    if document:
+        change["fullDocument"] = {"_id": doc_id, **document}
+    return change
+
+
+async def read_all(datastore: MongoDBDatastore, **options) -> List:
+    return [event async for event in datastore.watch(ORDERS, **options)]
+
+
+def test_yields_the_changes_of_the_stream(datastore):
+    doc_id = ObjectId()
+    collection = FakeCollection([
+        change("insert", doc_id, 1, number=1),
+        change("replace", doc_id, 2, number=2),
+        change("delete", doc_id, 3),
+        change("drop", doc_id, 4),
+    ])
+    datastore.db = {ORDERS: collection}
+
+    events = asyncio.run(read_all(datastore, resume_after={"_data": "0"}))
+    assert [event.operation for event in events] == [
+        ChangeOperation.INSERT, ChangeOperation.UPDATE, ChangeOperation.DELETE
+    ]
+    assert [event.document_id for event in events] == [str(doc_id)] * 3
+    assert events[1].document == {"_id": doc_id, "number": 2}
+    assert events[2].document is None
+    assert events[2].resume_token == {"_data": "3"}
+    pipeline, options = collection.watches[0]
+    assert pipeline == []
+    assert options["resume_after"] == {"_data": "0"}
+    assert options["full_document"] == "updateLookup"
+
+
+def test_matches_the_query_on_the_full_document(datastore):
+    collection = FakeCollection([])
+    datastore.db = {ORDERS: collection}
+    query = datastore.get_query_builder()
+    query.filter("number", query.ops().greater_than(2))
+
+    asyncio.run(read_all(datastore, query=query))
+    pipeline, _ = collection.watches[0]
+    number_above_2 = {"$and": [{"fullDocument.number": {"$gt": 2}}]}
+    assert pipeline == [{
+        "$match": {
+            "$or": [{
+                "operationType": "delete"
+            }, number_above_2]
+        }
+    }]
+
+
+def test_rejects_text_searches(datastore):
+    datastore.db = {ORDERS: FakeCollection([])}
+    query = datastore.get_query_builder()
+    query.filter("name", query.ops().text_search("blue"))
+
+    with pytest.raises(ValidationError):
+        asyncio.run(read_all(datastore, query=query))
@@ -0,0 +1,51 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+from apis.datastore.service.disk import OnDiskDatastore
+from apis.datastore.service.factory import get_shared_datastore
+from apis.query import router as query_router
+from config import DatastoreEntityName
+
+
+@pytest.fixture
+def client(tmp_path):
+    datastore = OnDiskDatastore(data_dir=str(tmp_path))
+    for name in ("apple", "banana", "cherry"):
+        asyncio.run(datastore.add(DatastoreEntityName.PRODUCT, {"name": name}))
+    app = FastAPI()
+    app.include_router(query_router.router, prefix="/api/query")
+
+    def shared_datastore():
+        return datastore
+
+    app.dependency_overrides[get_shared_datastore] = shared_datastore
+    return TestClient(app)
+
+
+def pattern_query(op: str, pattern) -> dict:
+    return {"where": [{"field": "name", "op": op, "value": pattern}]}
+
+
+def test_runs_pattern_queries(client):
+    response = client.post("/api/query/products",
+                           json=pattern_query("regex_match", "^b"))
+    assert response.status_code == 200
+    assert [item["name"] for item in response.json()["items"]] == ["banana"]
+
+
+@pytest.mark.parametrize("op", ["regex_match", "like"])
+def test_rejects_invalid_patterns_with_a_cached_plan(client, op):
+    # The first query caches the plan that the next ones are bound to.
+    for pattern, status_code in (("^a", 200), ("([", 422), (5, 422)):
+        response = client.post("/api/query/products",
+                               json=pattern_query(op, pattern))
+        assert response.status_code == status_code
+
+
+def test_timeout_is_a_server_error(client, monkeypatch):
+    monkeypatch.setattr(query_router, "QUERY_TIMEOUT", 0)
+    response = client.post("/api/query/products", json={})
+    assert response.status_code == 504
@@ -0,0 +1,99 @@
+import asyncio
+import os
+
+import pytest
+
+from tools.ai_client.cache import (
+    CacheMissError,
+    CacheMode,
+    CachedAiClient,
+    ResponseCache,
+)
+from tools.ai_client.fake import FakeAiClient
+
+
+def cached(tmp_path, mode: CacheMode = CacheMode.READ_WRITE, **options):
+    client = FakeAiClient(default="code")
+    cache = ResponseCache(str(tmp_path), **options)
+    return client, CachedAiClient(client, cache, mode)
+
+
+def test_counts_hits_and_misses(tmp_path):
+    client, cached_client = cached(tmp_path)
+
+    async def run():
+        await cached_client.generate_code("a")
+        await cached_client.generate_code("a")
+        await cached_client.generate_code("b")
+        await cached_client.generate_code("a", "system")
+
+    asyncio.run(run())
+    assert (cached_client.hits, cached_client.misses) == (1, 3)
+    assert len(client.calls) == 3
+
+
+def test_evicts_least_recently_used_entries_beyond_max_bytes(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.set("a", "x", {})
+    entry_size = os.path.getsize(os.path.join(str(tmp_path), "a.json"))
+
+    # Room for two entries, whose sizes differ by a few bytes of timestamp.
+    cache = ResponseCache(str(tmp_path), max_bytes=2 * entry_size + 10)
+    cache.set("b", "x", {})
+    assert cache.get("a") == "x"
+    cache.set("c", "x", {})
+    assert cache.get("b") is None
+    assert cache.get("a") == "x"
+    assert cache.get("c") == "x"
+    assert sorted(os.listdir(str(tmp_path))) == ["a.json", "c.json"]
+
+
+def test_expired_entries_are_misses(tmp_path, monkeypatch):
+    cache = ResponseCache(str(tmp_path), ttl_seconds=60)
+    now = 1000.0
+    monkeypatch.setattr("tools.ai_client.cache.time.time", lambda: now)
+    cache.set("a", "x", {})
+    now += 30
+    assert cache.get("a") == "x"
+    now += 31
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_replay_raises_on_a_miss_without_calling_the_model(tmp_path):
+    client, cached_client = cached(tmp_path)
+    asyncio.run(cached_client.generate_code("a"))
+
+    replay = CachedAiClient(client, cached_client.cache, CacheMode.REPLAY)
+    assert asyncio.run(replay.generate_code("a")) == "code"
+    with pytest.raises(CacheMissError):
+        asyncio.run(replay.generate_code("b"))
+    assert len(client.calls) == 1
+
+
+def test_stream_is_stored_once_complete(tmp_path):
+    client, cached_client = cached(tmp_path)
+
+    async def run():
+        stream = cached_client.stream_code("a")
+        assert await stream.__anext__() == "code"
+        assert len(cached_client.cache) == 0
+        assert [chunk async for chunk in stream] == []
+        assert len(cached_client.cache) == 1
+        # A later generate_code shares the entry.
+        assert await cached_client.generate_code("a") == "code"
+
+    asyncio.run(run())
+    assert len(client.calls) == 1
+
+
+def test_abandoned_stream_is_not_stored(tmp_path):
+    _, cached_client = cached(tmp_path)
+
+    async def run():
+        stream = cached_client.stream_code("a")
+        await stream.__anext__()
+        await stream.aclose()
+
+    asyncio.run(run())
+    assert len(cached_client.cache) == 0
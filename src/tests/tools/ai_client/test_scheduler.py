@@ -0,0 +1,144 @@
+import asyncio
+from dataclasses import replace
+import time
+
+import httpx
+import pytest
+
+from errors import RateLimitError
+from tools.ai_client.fake import FakeAiClient
+from tools.ai_client.scheduler import (
+    AiScheduler,
+    ProviderError,
+    ProviderLimits,
+    ScheduledAiClient,
+    is_retryable,
+)
+
+# Backoff short enough for the retries of a test to take milliseconds.
+FAST_LIMITS = ProviderLimits(base_delay_seconds=0.001, max_delay_seconds=0.01)
+
+
+def scheduled(client: FakeAiClient, **limits) -> ScheduledAiClient:
+    return ScheduledAiClient(client,
+                             AiScheduler(replace(FAST_LIMITS, **limits)))
+
+
+def test_retries_throttled_and_server_errors():
+    client = FakeAiClient(default="code", failures=[429, 503])
+    result = asyncio.run(scheduled(client).generate_code("prompt"))
+    assert result == "code"
+    assert len(client.calls) == 3
+
+
+def test_does_not_retry_client_errors():
+    client = FakeAiClient(failures=[400])
+    with pytest.raises(ProviderError):
+        asyncio.run(scheduled(client).generate_code("prompt"))
+    assert len(client.calls) == 1
+
+
+def test_gives_up_after_max_retries():
+    client = FakeAiClient(failures=[503] * 3)
+    with pytest.raises(ProviderError):
+        asyncio.run(scheduled(client, max_retries=2).generate_code("prompt"))
+    assert len(client.calls) == 3
+
+
+def test_still_throttled_after_max_retries_raises_rate_limit_error():
+    client = FakeAiClient(failures=[429] * 3)
+    with pytest.raises(RateLimitError):
+        asyncio.run(scheduled(client, max_retries=2).generate_code("prompt"))
+    assert len(client.calls) == 3
+
+
+def test_retries_connection_errors():
+    request = httpx.Request("POST", "https://api.example.com")
+    assert is_retryable(httpx.ConnectError("refused", request=request))
+    assert is_retryable(httpx.ReadTimeout("timed out", request=request))
+    assert is_retryable(asyncio.TimeoutError())
+    assert not is_retryable(ValueError())
+
+
+def test_backoff_is_jittered_below_exponential_ceiling():
+    limits = ProviderLimits(base_delay_seconds=1, max_delay_seconds=8)
+    error = ProviderError(503)
+    for attempt in range(6):
+        ceiling = min(8, 2**attempt)
+        delays = [
+            AiScheduler._backoff(limits, attempt, error) for _ in range(50)
+        ]
+        assert all(0 <= delay <= ceiling for delay in delays)
+        assert len(set(delays)) > 1
+
+
+def test_backoff_honours_retry_after():
+    limits = ProviderLimits(base_delay_seconds=0.1, max_delay_seconds=0.1)
+    error = ProviderError(429)
+    error.retry_after = 5
+    assert AiScheduler._backoff(limits, 0, error) == 5
+
+
+def test_request_larger_than_token_budget_is_rejected():
+    client = FakeAiClient()
+    with pytest.raises(RateLimitError):
+        asyncio.run(
+            scheduled(client,
+                      tokens_per_minute=10).generate_code("word " * 20))
+    assert client.calls == []
+
+
+def test_exhausted_token_budget_raises_rate_limit_error():
+    client = scheduled(FakeAiClient(),
+                       tokens_per_minute=30,
+                       max_wait_seconds=0.1)
+
+    async def run():
+        await client.generate_code("word " * 20)
+        await client.generate_code("word " * 20)
+
+    with pytest.raises(RateLimitError):
+        asyncio.run(run())
+
+
+def test_limits_concurrency():
+    client = scheduled(FakeAiClient(latency=0.05), max_concurrency=2)
+
+    async def run():
+        await asyncio.gather(*(client.generate_code("prompt")
+                               for _ in range(6)))
+
+    started = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - started >= 0.15
+
+
+def test_hedges_slow_calls():
+    client = FakeAiClient(default="code", latencies=[5])
+    started = time.monotonic()
+    result = asyncio.run(
+        scheduled(client, hedge_after_seconds=0.05).generate_code("prompt"))
+    assert result == "code"
+    assert time.monotonic() - started < 1
+    assert len(client.calls) == 2
+
+
+def test_does_not_hedge_beyond_request_budget():
+    client = FakeAiClient(latencies=[0.2])
+    scheduled_client = scheduled(client,
+                                 requests_per_minute=1,
+                                 hedge_after_seconds=0.05)
+    started = time.monotonic()
+    asyncio.run(scheduled_client.generate_code("prompt"))
+    assert time.monotonic() - started >= 0.2
+    assert len(client.calls) == 1
+
+
+def test_retries_stream_before_first_chunk():
+    client = FakeAiClient(default="code", failures=[503])
+
+    async def run():
+        return [chunk async for chunk in scheduled(client).stream_code("p")]
+
+    assert asyncio.run(run()) == ["code"]
+    assert len(client.calls) == 2
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from tools.ai_codegen.crud_api import cli
+from tools.ai_codegen.crud_api.cli import BatchSpec, load_batch_specs
+
+
+def batch_file(tmp_path, *lines: str) -> str:
+    path = os.path.join(str(tmp_path), "batch.jsonl")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def test_loads_batch_specs(tmp_path):
+    path = batch_file(tmp_path, '{"spec": "Books", "project_name": "books"}',
+                      "", '{"spec": "Events"}')
+    assert load_batch_specs(path) == [
+        BatchSpec("books", "Books"),
+        BatchSpec("project_3", "Events")
+    ]
+
+
+@pytest.mark.parametrize("lines, message", [
+    (['{"spec": "Books"'], "Line 1 of .* isn't valid JSON"),
+    (['{"spec": "Books"}', '["Events"]'], "Line 2 of .* has no spec"),
+    (['{"spec": "Books", "project_name": "../x"}'], "invalid project_name"),
+    ([
+        '{"spec": "A", "project_name": "a"}',
+        '{"spec": "B", "project_name": "a"}'
+    ], "Duplicate project names"),
+])
+def test_rejects_invalid_batch_files(tmp_path, lines, message):
+    with pytest.raises(ValueError, match=message):
+        load_batch_specs(batch_file(tmp_path, *lines))
+
+
+@pytest.mark.parametrize("lines", [
+    ['{"spec": "Books", "project_name": "../x"}'],
+    ['not json'],
+    None,
+])
+def test_main_reports_batch_errors_before_connecting(tmp_path, monkeypatch,
+                                                     capsys, lines):
+    path = (batch_file(tmp_path, *lines) if lines is not None else
+            os.path.join(str(tmp_path), "missing.jsonl"))
+
+    def get_ai_client(*args):
+        raise AssertionError("The AI client was built")
+
+    monkeypatch.setattr(cli, "get_ai_client", get_ai_client)
+    monkeypatch.setattr(sys, "argv", ["cli", "--batch", path])
+    with pytest.raises(SystemExit) as exit_info:
+        asyncio.run(cli.main())
+    assert exit_info.value.code == 2
+    assert "error: --batch: " in capsys.readouterr().err
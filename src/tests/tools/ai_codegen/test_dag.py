@@ -0,0 +1,96 @@
+import asyncio
+from typing import Dict, List
+
+import pytest
+
+from tools.ai_codegen.dag import Artifact, ArtifactGraph
+
+DELAYS = {"a": 0.05, "b": 0.02, "c": 0.1, "d": 0.01}
+
+
+def artifact(name: str, *inputs: str) -> Artifact:
+    return Artifact(name, f"{name}.py", lambda _: name, inputs)
+
+
+def diamond() -> List[Artifact]:
+    # d waits for b and c, which both wait for a.
+    return [
+        artifact("d", "b", "c"),
+        artifact("c", "a"),
+        artifact("b", "a"),
+        artifact("a"),
+    ]
+
+
+def test_orders_artifacts_after_their_inputs():
+    assert ArtifactGraph(diamond()).order == ["a", "b", "c", "d"]
+
+
+@pytest.mark.parametrize("artifacts", [
+    [artifact("a", "b"), artifact("b", "a")],
+    [artifact("a", "a")],
+    [artifact("a", "missing")],
+])
+def test_rejects_cycles_and_unknown_inputs(artifacts):
+    with pytest.raises(ValueError):
+        ArtifactGraph(artifacts)
+
+
+def test_runs_independent_artifacts_concurrently():
+    running: List[str] = []
+    overlapped = set()
+
+    async def produce(artifact: Artifact, inputs: Dict[str, str]) -> str:
+        running.append(artifact.name)
+        overlapped.update(running if len(running) > 1 else ())
+        await asyncio.sleep(DELAYS[artifact.name])
+        running.remove(artifact.name)
+        return artifact.name + "".join(inputs.values())
+
+    run = asyncio.run(ArtifactGraph(diamond()).run(produce))
+    assert run.outputs == {"a": "a", "b": "ba", "c": "ca", "d": "dbaca"}
+    assert overlapped == {"b", "c"}
+    timings = run.timings
+    assert timings["b"].started >= timings["a"].finished
+    assert timings["d"].started >= timings["c"].finished
+    # b and c overlap, so the run takes about a + c + d rather than the sum.
+    assert run.seconds < sum(DELAYS.values())
+
+
+def test_critical_path_follows_the_inputs_that_finished_last():
+
+    async def produce(artifact: Artifact, inputs: Dict[str, str]) -> str:
+        await asyncio.sleep(DELAYS[artifact.name])
+        return artifact.name
+
+    run = asyncio.run(ArtifactGraph(diamond()).run(produce))
+    assert run.critical_path() == ["a", "c", "d"]
+    assert run.critical_path("b") == ["a", "b"]
+    assert run.timings["d"].critical_input == "c"
+    assert run.timings["a"].critical_input is None
+
+
+def test_first_failure_cancels_the_remaining_artifacts():
+    started: List[str] = []
+    cancelled: List[str] = []
+
+    async def produce(artifact: Artifact, inputs: Dict[str, str]) -> str:
+        started.append(artifact.name)
+        if artifact.name == "b":
+            raise RuntimeError("b failed")
+        try:
+            await asyncio.sleep(DELAYS[artifact.name])
+        except asyncio.CancelledError:
+            cancelled.append(artifact.name)
+            raise
+        return artifact.name
+
+    async def run():
+        with pytest.raises(RuntimeError, match="b failed"):
+            await ArtifactGraph(diamond()).run(produce)
+        # Let the cancelled tasks run to their end.
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert started == ["a", "b", "c"]
+    assert cancelled == ["c"]
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+
+from tools.ai_client.fake import FakeAiClient
+from tools.ai_codegen.crud_api import generator
+from tools.ai_codegen.crud_api.cli import stream_to_files
+from tools.ai_codegen.crud_api.generator import CrudApiCodeGen
+from tools.ai_codegen.manifest import MANIFEST_FILENAME
+
+SPEC = "A CRUD API for a library's books."
+ALL = {"datamodels", "router", "service", "main"}
+
+
+def fake_client(datamodels: str = "class Book: ...") -> FakeAiClient:
+    # Keyed on the instructions of each prompt.
+    return FakeAiClient({
+        "data models using Pydantic": datamodels,
+        "FastAPI router": "router = APIRouter()",
+        "service layer": "class BookService: ...",
+        "main API file": "app = FastAPI()",
+    })
+
+
+def generate(folder: str,
+             ai_client: FakeAiClient,
+             incremental: bool = True) -> set:
+    """
+    Generates the project into folder, returning the artifacts that were
+    generated rather than reused.
+    """
+    code_gen = CrudApiCodeGen(SPEC, ai_client)
+    asyncio.run(
+        stream_to_files(code_gen,
+                        folder,
+                        verbose=False,
+                        incremental=incremental))
+    return {
+        name
+        for name, timing in code_gen.last_run.timings.items()
+        if not timing.reused
+    }
+
+
+def read(folder: str, filename: str) -> str:
+    with open(os.path.join(folder, filename)) as f:
+        return f.read()
+
+
+def project(tmp_path) -> str:
+    folder = os.path.join(str(tmp_path), "library")
+    os.makedirs(folder)
+    return folder
+
+
+def test_unchanged_inputs_are_reused(tmp_path):
+    folder = project(tmp_path)
+    assert generate(folder, fake_client()) == ALL
+
+    ai_client = fake_client()
+    assert generate(folder, ai_client) == set()
+    assert ai_client.calls == []
+    assert read(folder, "router.py") == "router = APIRouter()"
+
+
+def test_edited_template_regenerates_its_artifact(tmp_path, monkeypatch):
+    folder = project(tmp_path)
+    generate(folder, fake_client())
+
+    monkeypatch.setattr(generator, "router_template",
+                        generator.router_template + "\n# Paginate lists.\n")
+    assert generate(folder, fake_client()) == {"router"}
+
+
+def test_edited_or_deleted_output_is_regenerated(tmp_path):
+    folder = project(tmp_path)
+    generate(folder, fake_client())
+
+    with open(os.path.join(folder, "main.py"), "a") as f:
+        f.write("# edited by hand\n")
+    os.remove(os.path.join(folder, "service.py"))
+    assert generate(folder, fake_client()) == {"main", "service"}
+    assert read(folder, "main.py") == "app = FastAPI()"
+    assert read(folder, "service.py") == "class BookService: ..."
+
+
+def test_dependents_regenerate_when_upstream_code_changes(tmp_path):
+    folder = project(tmp_path)
+    generate(folder, fake_client())
+
+    # The datamodels are regenerated into different code, which the router
+    # and service prompts include.
+    os.remove(os.path.join(folder, "datamodels.py"))
+    ai_client = fake_client("class Book: isbn: str")
+    assert generate(folder, ai_client) == {"datamodels", "router", "service"}
+
+    # Regenerating into the same code leaves the dependents as they are.
+    os.remove(os.path.join(folder, "datamodels.py"))
+    assert generate(folder, ai_client) == {"datamodels"}
+
+
+def test_forced_run_regenerates_everything_and_still_records(tmp_path):
+    folder = project(tmp_path)
+    generate(folder, fake_client())
+    with open(os.path.join(folder, MANIFEST_FILENAME)) as f:
+        recorded = json.load(f)
+
+    ai_client = fake_client("class Book: isbn: str")
+    assert generate(folder, ai_client, incremental=False) == ALL
+    with open(os.path.join(folder, MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+    assert set(manifest) == ALL
+    assert (manifest["datamodels"]["output_hash"]
+            != recorded["datamodels"]["output_hash"])
+    assert manifest["main"] == recorded["main"]
+
+    assert generate(folder, ai_client) == set()
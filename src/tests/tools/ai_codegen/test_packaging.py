@@ -0,0 +1,74 @@
+import io
+import os
+import stat
+import zipfile
+
+import pytest
+
+from tools.ai_codegen.crud_api.cli import ProjectZip
+from tools.ai_codegen.dag import Artifact
+from tools.ai_codegen.packaging import StreamingZip, ZipOptions
+
+FILES = {"datamodels.py": "class Book: ...\n" * 50, "main.py": "app = 1\n"}
+
+
+def build(archive: StreamingZip) -> zipfile.ZipFile:
+    chunks = [archive.add(name, code) for name, code in FILES.items()]
+    assert all(chunks)
+    chunks.append(archive.close())
+    return zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+
+
+@pytest.mark.parametrize("options, compression", [
+    (None, zipfile.ZIP_DEFLATED),
+    (ZipOptions(compresslevel=9), zipfile.ZIP_DEFLATED),
+    (ZipOptions(store=True), zipfile.ZIP_STORED),
+])
+def test_streaming_zip_chunks_form_a_valid_archive(options, compression):
+    archive = build(StreamingZip("library", options))
+    assert archive.testzip() is None
+    assert archive.namelist() == ["library/datamodels.py", "library/main.py"]
+    for info in archive.infolist():
+        assert info.compress_type == compression
+    assert archive.read("library/main.py").decode() == FILES["main.py"]
+
+
+def test_streaming_zip_without_root():
+    assert build(StreamingZip()).namelist() == list(FILES)
+
+
+def test_aborted_streaming_zip_writes_nothing_more():
+    archive = StreamingZip("library")
+    archive.add("main.py", FILES["main.py"])
+    archive.abort()
+    assert archive._sink.take() == b""
+
+
+def artifact(filename: str) -> Artifact:
+    return Artifact(filename.split(".")[0], filename, lambda _: "")
+
+
+def test_project_zip_gets_the_permissions_of_a_new_file(tmp_path):
+    folder = os.path.join(str(tmp_path), "library")
+    previous = os.umask(0o027)
+    try:
+        project_zip = ProjectZip(folder)
+        project_zip.add(artifact("main.py"), FILES["main.py"])
+        path = project_zip.close()
+    finally:
+        os.umask(previous)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    assert zipfile.ZipFile(path).namelist() == ["library/main.py"]
+
+
+def test_aborted_project_zip_keeps_the_previous_zip(tmp_path):
+    folder = os.path.join(str(tmp_path), "library")
+    project_zip = ProjectZip(folder)
+    project_zip.add(artifact("main.py"), FILES["main.py"])
+    path = project_zip.close()
+
+    project_zip = ProjectZip(folder)
+    project_zip.add(artifact("datamodels.py"), FILES["datamodels.py"])
+    project_zip.abort()
+    assert os.listdir(str(tmp_path)) == ["library.zip"]
+    assert zipfile.ZipFile(path).namelist() == ["library/main.py"]
@@ -0,0 +1,117 @@
+import pytest
+
+from tools.ai_client.tokens import count_tokens
+from tools.ai_codegen.prompts import (TRUNCATION_MARKER, PromptSection,
+                                      build_prompt, summarize_code,
+                                      truncate_to_tokens)
+
+MODELS = '''
+from enum import Enum
+from pydantic import BaseModel
+
+MAX_TITLE_LENGTH = 200
+
+
+class Genre(str, Enum):
+    """The genres a book can have."""
+    FICTION = "fiction"
+    SCIENCE = "science"
+
+
+class Book(BaseModel):
+    """A book of the library."""
+    title: str
+    genre: Genre
+
+    def describe(self) -> str:
+        words = [self.title, "is", "a", self.genre.value, "book"]
+        return " ".join(word.strip() for word in words if word)
+
+    def short(self): return self.title[:10]
+'''.strip()
+
+OUTLINE = '''
+from enum import Enum
+from pydantic import BaseModel
+MAX_TITLE_LENGTH = 200
+class Genre(str, Enum):
+    FICTION = "fiction"
+    SCIENCE = "science"
+class Book(BaseModel):
+    title: str
+    genre: Genre
+    def describe(self) -> str:
+        ...
+    def short(self): return self.title[:10]
+'''.strip()
+
+
+def sections(models: str = MODELS) -> list:
+    return [
+        PromptSection("Specification", "A CRUD API for books."),
+        PromptSection("Data Models", models, trimmable=True),
+        PromptSection("Instructions", "Generate the router."),
+    ]
+
+
+def render(models: str) -> str:
+    return (f"# Specification:\nA CRUD API for books.\n\n"
+            f"# Data Models:\n{models}\n\n"
+            f"# Instructions:\nGenerate the router.")
+
+
+def test_summarize_code_keeps_the_outline():
+    assert summarize_code(MODELS) == OUTLINE
+
+
+def test_summarize_code_keeps_outline_lines_of_invalid_code():
+    code = "import os\nclass Book(BaseModel:\n    title: str\n    x == 1"
+    outline = "import os\nclass Book(BaseModel:\n    title: str"
+    assert summarize_code(code) == outline
+
+
+LINES = "\n".join(["aaaa"] * 10)  # 10 one-token lines, 19 tokens
+
+
+def test_truncate_to_tokens_keeps_text_that_fits():
+    assert truncate_to_tokens(LINES, count_tokens(LINES)) == LINES
+
+
+@pytest.mark.parametrize(
+    "max_tokens", range(count_tokens(TRUNCATION_MARKER), count_tokens(LINES)))
+def test_truncate_to_tokens_keeps_every_line_that_fits(max_tokens):
+    truncated = truncate_to_tokens(LINES, max_tokens)
+    kept = truncated.splitlines()
+    assert kept[-1] == TRUNCATION_MARKER
+    assert count_tokens(truncated) <= max_tokens
+    # One more line, and its newline, wouldn't have fit.
+    assert count_tokens(truncated) + 2 > max_tokens
+    assert kept[:-1] == ["aaaa"] * (len(kept) - 1)
+
+
+def test_build_prompt_returns_sections_that_fit_as_they_are():
+    prompt = render(MODELS)
+    assert build_prompt(sections(), count_tokens(prompt)) == prompt
+
+
+def test_build_prompt_summarizes_then_truncates_then_fails():
+    full = count_tokens(render(MODELS))
+    summarized = count_tokens(render(OUTLINE))
+    assert summarized < full
+
+    # Summarizing is enough.
+    assert build_prompt(sections(), full - 1) == render(OUTLINE)
+    assert build_prompt(sections(), summarized) == render(OUTLINE)
+
+    # The summary is truncated as well.
+    prompt = build_prompt(sections(), summarized - 10)
+    assert count_tokens(prompt) <= summarized - 10
+    assert TRUNCATION_MARKER in prompt
+    assert prompt.startswith("# Specification:\nA CRUD API for books.\n\n"
+                             "# Data Models:\nfrom enum import Enum\n")
+    assert prompt.endswith("\n\n# Instructions:\nGenerate the router.")
+
+    # The sections that can't be trimmed don't fit on their own.
+    fixed = count_tokens(render(""))
+    with pytest.raises(ValueError):
+        build_prompt(sections(), fixed - 1)
@@ -0,0 +1,229 @@
+from collections import OrderedDict
+from enum import Enum
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+from tools.ai_client.interface import AiClient
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = ".ai_cache"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class CacheMode(str, Enum):
+    OFF = "off"
+    # Serve hits from the cache and store the responses of misses.
+    READ_WRITE = "read_write"
+    # Serve hits from the cache and raise CacheMissError on a miss, without
+    # ever calling the model. Meant for deterministic offline runs.
+    REPLAY = "replay"
+
+
+class CacheMissError(LookupError):
+    """
+    Raise when a replay-only cache has no response for a request
+    """
+
+
+def cache_key(request: Dict[str, Any]) -> str:
+    """
+    Returns the content address of a request: the SHA-256 of its canonical
+    JSON form.
+    """
+    canonical = json.dumps(request,
+                           sort_keys=True,
+                           separators=(",", ":"),
+                           default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Stores model responses on disk, one JSON file per request, named after
+    the request's content address. Once the files exceed max_bytes, the least
+    recently used ones are deleted. Entries older than ttl_seconds are
+    treated as missing.
+    """
+
+    def __init__(self,
+                 directory: str = DEFAULT_CACHE_DIR,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 ttl_seconds: Optional[float] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(directory, exist_ok=True)
+        # Key -> file size, least recently used first. The access time of an
+        # entry is the modification time of its file, so that the order
+        # survives restarts.
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._load()
+
+    def get(self, key: str) -> Optional[str]:
+        if key not in self._entries:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Dropping unreadable AI cache entry {path}")
+            self._delete(key)
+            return None
+        if (self.ttl_seconds is not None
+                and time.time() - entry["created_at"] > self.ttl_seconds):
+            self._delete(key)
+            return None
+        os.utime(path)
+        self._entries.move_to_end(key)
+        return entry["response"]
+
+    def set(self, key: str, response: str, request: Dict[str, Any]):
+        entry = {
+            "created_at": time.time(),
+            "request": request,
+            "response": response
+        }
+        # Written to a temporary file first so that readers never see a
+        # partial entry.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f, default=str)
+        os.replace(temp_path, self._path(key))
+        if key in self._entries:
+            self._size -= self._entries.pop(key)
+        self._entries[key] = os.path.getsize(self._path(key))
+        self._size += self._entries[key]
+        self._evict()
+
+    def clear(self):
+        for key in list(self._entries):
+            self._delete(key)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load(self):
+        files = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.directory, filename))
+            files.append((stat.st_mtime, filename[:-len(".json")],
+                          stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            self._delete(next(iter(self._entries)))
+
+    def _delete(self, key: str):
+        self._size -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class CachedAiClient(AiClient):
+    """
+    Wraps an AiClient to answer repeated requests from a ResponseCache. A
+    request is identified by the provider, model and generation config of
+    the client along with the method, prompt and system prompt.
+    """
+
+    def __init__(self,
+                 client: AiClient,
+                 cache: ResponseCache,
+                 mode: CacheMode = CacheMode.READ_WRITE):
+        self.client = client
+        self.cache = cache
+        self.mode = mode
+        self.name = client.name
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+    async def send_json_chat(self, prompt: str, sys_prompt: str) -> str:
+        return await self._cached(
+            "send_json_chat", prompt, sys_prompt,
+            lambda: self.client.send_json_chat(prompt, sys_prompt))
+
+    async def generate_code(self,
+                            prompt: str,
+                            system_prompt: Optional[str] = None) -> str:
+        return await self._cached(
+            "generate_code", prompt, system_prompt,
+            lambda: self.client.generate_code(prompt, system_prompt))
+
+    def request(self, method: str, prompt: str,
+                sys_prompt: Optional[str]) -> Dict[str, Any]:
+        return {
+            "provider": self.client.name,
+            "model": getattr(self.client, "model", None),
+            "generation_config": getattr(self.client, "generation_config",
+                                         None),
+            "method": method,
+            "prompt": prompt,
+            "system_prompt": sys_prompt,
+        }
+
+    async def stream_code(
+            self,
+            prompt: str,
+            system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        if self.mode == CacheMode.OFF:
+            async for chunk in self.client.stream_code(prompt, system_prompt):
+                yield chunk
+            return
+        # Shares its entries with generate_code, which returns the same text.
+        request = self.request("generate_code", prompt, system_prompt)
+        key, response = self._lookup(request)
+        if response is not None:
+            yield response
+            return
+        chunks = []
+        async for chunk in self.client.stream_code(prompt, system_prompt):
+            chunks.append(chunk)
+            yield chunk
+        self.cache.set(key, "".join(chunks), request)
+
+    async def _cached(self, method: str, prompt: str,
+                      sys_prompt: Optional[str],
+                      call: Callable[[], Awaitable[str]]) -> str:
+        if self.mode == CacheMode.OFF:
+            return await call()
+        request = self.request(method, prompt, sys_prompt)
+        key, response = self._lookup(request)
+        if response is None:
+            response = await call()
+            self.cache.set(key, response, request)
+        return response
+
+    def _lookup(self, request: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+        key = cache_key(request)
+        response = self.cache.get(key)
+        if response is not None:
+            self.hits += 1
+            return key, response
+        self.misses += 1
+        if self.mode == CacheMode.REPLAY:
+            raise CacheMissError(
+                f"No cached {request['provider']} response for "
+                f"{request['method']} request {key}")
+        return key, None
@@ -1,35 +1,151 @@
+import hashlib
 import os
-from typing import Optional
+from typing import Dict, Optional, Tuple
+import httpx
 from tools.ai_client.interface import AiClient
-from tools.ai_client.gpt import GPTAiClient
-from tools.ai_client.gemini import GeminiAiClient
+from tools.ai_client.cache import (DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES,
+                                   CachedAiClient, CacheMode, ResponseCache)
+from tools.ai_client.scheduler import ScheduledAiClient
 
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE = 20
+DEFAULT_KEEPALIVE_SECONDS = 60.0
+# Completions of long files can take minutes.
+DEFAULT_TIMEOUT_SECONDS = 600.0
+CONNECT_TIMEOUT_SECONDS = 10.0
 
-def get_ai_client(client_name: Optional[str] = None) -> AiClient:
+# Provider clients by provider and credential fingerprint.
+_clients: Dict[Tuple[str, str], AiClient] = {}
+_response_caches: Dict[Tuple[str, int, Optional[float]], ResponseCache] = {}
+
+
+def get_ai_client(client_name: Optional[str] = None,
+                  cache_mode: Optional[str] = None) -> AiClient:
     """
     Factory function to create and return an AI client based on the client name provided.
     Args:
         client_name (Optional[str]): The name of the AI client to create.
+        cache_mode (Optional[str]): "off", "read_write" or "replay". Defaults to
+            the AI_CACHE_MODE environment variable, then "off".
     Returns:
-        AiClient: An instance of the AI client.
+        AiClient: An instance of the AI client. The provider client is shared by
+            every call with the same provider and credentials, along with its
+            connection pool, until close_ai_clients. Its requests go through the
+            process-wide scheduler, which bounds concurrency and rate per provider.
     Raises:
         ValueError: If the client name is not supported or no API key or credentials are found.
     """
+    client = ScheduledAiClient(_pooled_ai_client(client_name))
+    # Cache hits are answered without taking any rate budget.
+    return with_response_cache(client, cache_mode)
+
+
+def with_response_cache(client: AiClient,
+                        cache_mode: Optional[str] = None) -> AiClient:
+    """
+    Wraps the client with the on-disk response cache configured by the
+    AI_CACHE_DIR, AI_CACHE_MAX_BYTES and AI_CACHE_TTL_SECONDS environment
+    variables, unless the cache mode is "off".
+    """
+    mode = CacheMode(cache_mode or os.getenv("AI_CACHE_MODE", CacheMode.OFF))
+    if mode == CacheMode.OFF:
+        return client
+    ttl_seconds = os.getenv("AI_CACHE_TTL_SECONDS")
+    key = (os.getenv("AI_CACHE_DIR", DEFAULT_CACHE_DIR),
+           int(os.getenv("AI_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+           float(ttl_seconds) if ttl_seconds else None)
+    # Loading a cache lists its directory, so each one is only loaded once.
+    if key not in _response_caches:
+        directory, max_bytes, ttl = key
+        _response_caches[key] = ResponseCache(directory,
+                                              max_bytes=max_bytes,
+                                              ttl_seconds=ttl)
+    return CachedAiClient(client, _response_caches[key], mode)
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Returns an HTTP client whose keep-alive connections are reused across
+    requests, sized by the AI_HTTP_MAX_CONNECTIONS, AI_HTTP_MAX_KEEPALIVE,
+    AI_HTTP_KEEPALIVE_SECONDS and AI_HTTP_TIMEOUT_SECONDS environment
+    variables.
+    """
+    max_connections = os.getenv("AI_HTTP_MAX_CONNECTIONS",
+                                DEFAULT_MAX_CONNECTIONS)
+    max_keepalive = os.getenv("AI_HTTP_MAX_KEEPALIVE", DEFAULT_MAX_KEEPALIVE)
+    keepalive_seconds = os.getenv("AI_HTTP_KEEPALIVE_SECONDS",
+                                  DEFAULT_KEEPALIVE_SECONDS)
+    timeout = os.getenv("AI_HTTP_TIMEOUT_SECONDS", DEFAULT_TIMEOUT_SECONDS)
+    limits = httpx.Limits(max_connections=int(max_connections),
+                          max_keepalive_connections=int(max_keepalive),
+                          keepalive_expiry=float(keepalive_seconds))
+    return httpx.AsyncClient(limits=limits,
+                             timeout=httpx.Timeout(
+                                 float(timeout),
+                                 connect=CONNECT_TIMEOUT_SECONDS))
+
+
+async def close_ai_clients():
+    """
+    Closes the pooled provider clients and their connections. The next
+    get_ai_client call creates new ones.
+    """
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.close()
+
 
+def _pooled_ai_client(client_name: Optional[str]) -> AiClient:
+    provider, credential = _resolve_provider(client_name)
+    # Credentials are only kept hashed in the pool key.
+    fingerprint = hashlib.sha256((credential or "").encode()).hexdigest()
+    key = (provider, fingerprint)
+    if key not in _clients:
+        _clients[key] = _create_ai_client(provider, credential)
+    return _clients[key]
+
+
+def _resolve_provider(client_name: Optional[str]) -> Tuple[str, Optional[str]]:
+    """
+    Returns the provider to use and its credential: the OpenAI API key or the
+    path of the Google application credentials.
+    """
+    open_api_key = os.getenv("OPENAI_API_KEY")
+    google_app_cred_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
     if not client_name:
-        open_api_key = os.getenv("OPENAI_API_KEY")
-        google_app_cred_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
         if google_app_cred_path:
             print("Using Gemini AI client with Google credentials: ",
                   google_app_cred_path)
-            return GeminiAiClient()
+            return "gemini", google_app_cred_path
         elif open_api_key:
-            return GPTAiClient(open_api_key)
+            return "gpt", open_api_key
         else:
             raise ValueError("No API key or credentials found for AI client.")
     if client_name.lower() == "gpt":
-        return GPTAiClient()
+        if not open_api_key:
+            raise ValueError("No API key found for the GPT AI client.")
+        return "gpt", open_api_key
     elif client_name.lower() == "gemini":
-        return GeminiAiClient()
+        return "gemini", google_app_cred_path
+    elif client_name.lower() == "fake":
+        return "fake", None
     else:
         raise ValueError(f"Unsupported AI client: {client_name}")
+
+
+def _create_ai_client(provider: str, credential: Optional[str]) -> AiClient:
+    # Provider SDKs are imported on demand so that a missing one only breaks
+    # the client that needs it.
+    if provider == "gpt":
+        from tools.ai_client.gpt import GPTAiClient
+        # Retries are left to the scheduler, which knows the rate budget.
+        return GPTAiClient(credential,
+                           http_client=create_http_client(),
+                           max_retries=0)
+    elif provider == "gemini":
+        from tools.ai_client.gemini import GeminiAiClient
+        return GeminiAiClient()
+    else:
+        from tools.ai_client.fake import FakeAiClient
+        return FakeAiClient()
@@ -0,0 +1,54 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from tools.ai_client.interface import AiClient
+from tools.ai_client.scheduler import ProviderError
+
+
+class FakeAiClient(AiClient):
+    """
+    Answers without calling a model, for tests and offline runs. The
+    response to a prompt is the value of the first key of responses found in
+    the prompt, or default. Every call is recorded in calls. Each call takes
+    latency seconds, or for the first len(latencies) calls the given ones,
+    e.g. [5] to exercise hedging. The first len(failures) calls fail with the
+    given status codes, e.g. [429, 503], to exercise retries.
+    """
+
+    def __init__(self,
+                 responses: Optional[Dict[str, str]] = None,
+                 default: str = "",
+                 latency: float = 0,
+                 failures: Optional[List[int]] = None,
+                 latencies: Optional[List[float]] = None):
+        self.name = "fake"
+        self.model = "fake"
+        self.generation_config: Dict = {}
+        self.context_window = 128000
+        self.responses = responses or {}
+        self.default = default
+        self.latency = latency
+        self.failures = list(failures or [])
+        self.latencies = list(latencies or [])
+        self.calls: List[Tuple[str, str, Optional[str]]] = []
+
+    async def send_json_chat(self, prompt: str, sys_prompt: str) -> str:
+        self.calls.append(("send_json_chat", prompt, sys_prompt))
+        return await self._respond(prompt)
+
+    async def generate_code(self,
+                            prompt: str,
+                            system_prompt: Optional[str] = None) -> str:
+        self.calls.append(("generate_code", prompt, system_prompt))
+        return await self._respond(prompt)
+
+    async def _respond(self, prompt: str) -> str:
+        latency = self.latencies.pop(0) if self.latencies else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+        if self.failures:
+            raise ProviderError(self.failures.pop(0))
+        for fragment, response in self.responses.items():
+            if fragment in prompt:
+                return response
+        return self.default
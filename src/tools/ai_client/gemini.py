@@ -1,5 +1,5 @@
 import logging
-from typing import Any
+from typing import Any, AsyncIterator, Optional
 
 import vertexai
 from vertexai.preview.generative_models import GenerativeModel
@@ -17,18 +17,21 @@ class GeminiAiClient(AiClient):
             project="projectameoba",
             location="us-central1",
         )
-        self.ai_client = GenerativeModel("gemini-pro-vision")
+        self.model = "gemini-pro-vision"
+        self.generation_config = {
+            "max_output_tokens": 2048,
+            "temperature": 0.9,
+            "top_p": 1,
+            "top_k": 32,
+        }
+        self.context_window = 16384
+        self.ai_client = GenerativeModel(self.model)
 
     async def send_json_chat(self, prompt: Any, sys_propmt: Any) -> str:
         chat_msg = f"\n**system_prompt**\n {sys_propmt} \n**user_prompt**\n {prompt}\n\n make sure response is a single valid string"
         response = await self.ai_client.generate_content_async(
             chat_msg,
-            generation_config={
-                "max_output_tokens": 2048,
-                "temperature": 0.9,
-                "top_p": 1,
-                "top_k": 32,
-            },
+            generation_config=self.generation_config,
         )
         res_string = str(response.text)  # type: ignore
         json_string = ""
@@ -45,16 +48,37 @@ class GeminiAiClient(AiClient):
         await self.log_req_res_to_file(chat_msg, json_string)
         return json_string
 
-    async def generate_code(self, prompt: str) -> str:
+    async def generate_code(self,
+                            prompt: str,
+                            system_prompt: Optional[str] = None) -> str:
+        prompt = self._with_system_prompt(prompt, system_prompt)
         _res = await self.ai_client.generate_content_async(
             prompt,
-            generation_config={
-                "max_output_tokens": 2048,
-                "temperature": 0.9,
-                "top_p": 1,
-                "top_k": 32,
-            },
+            generation_config=self.generation_config,
         )
         res = str(_res.text)
         await self.log_req_res_to_file(prompt, res)
         return res
+
+    async def stream_code(
+            self,
+            prompt: str,
+            system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        prompt = self._with_system_prompt(prompt, system_prompt)
+        responses = await self.ai_client.generate_content_async(
+            prompt,
+            generation_config=self.generation_config,
+            stream=True,
+        )
+        chunks = []
+        async for response in responses:
+            text = str(response.text)
+            chunks.append(text)
+            yield text
+        await self.log_req_res_to_file(prompt, "".join(chunks))
+
+    @staticmethod
+    def _with_system_prompt(prompt: str, system_prompt: Optional[str]) -> str:
+        # gemini-pro-vision takes no system instructions, so they lead the
+        # prompt instead.
+        return f"{system_prompt}\n\n{prompt}" if system_prompt else prompt
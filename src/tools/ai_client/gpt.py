@@ -1,6 +1,7 @@
 import logging
-from typing import Any
+from typing import Any, AsyncIterator, List, Optional
 
+import httpx
 from openai import AsyncOpenAI as OpenAI
 from openai.types.chat import ChatCompletionMessageParam
 
@@ -12,9 +13,17 @@ logger = logging.getLogger(__name__)
 
 class GPTAiClient(AiClient):
 
-    def __init__(self, openai_api_key: str):
-        self.ai_client = OpenAI(api_key=openai_api_key)
+    def __init__(self,
+                 openai_api_key: str,
+                 http_client: Optional[httpx.AsyncClient] = None,
+                 max_retries: int = 2):
+        self.name = "gpt"
+        self.ai_client = OpenAI(api_key=openai_api_key,
+                                http_client=http_client,
+                                max_retries=max_retries)
         self.model = "gpt-4-0125-preview"
+        self.generation_config = {"temperature": 0.9}
+        self.context_window = 128000
 
     async def send_json_chat(self, prompt: Any, sys_propmt: Any) -> str:
         msg: ChatCompletionMessageParam = {"role": "user", "content": prompt}
@@ -22,7 +31,7 @@ class GPTAiClient(AiClient):
         completion = await self.ai_client.chat.completions.create(
             model=self.model,
             messages=messages,
-            temperature=0.9,
+            **self.generation_config,
         )
         json_string = completion.choices[0].message.content
         if not json_string:
@@ -31,15 +40,51 @@ class GPTAiClient(AiClient):
         await self.log_req_res_to_file(prompt, json_string)
         return json_string
 
-    async def generate_code(self, prompt: str) -> str:
+    async def close(self):
+        await self.ai_client.close()
+
+    async def generate_code(self,
+                            prompt: str,
+                            system_prompt: Optional[str] = None) -> str:
         completion = await self.ai_client.chat.completions.create(
             model=self.model,
-            messages=[{
-                "role": "user",
-                "content": prompt
-            }],
-            temperature=0.9,
+            messages=self._code_messages(prompt, system_prompt),
+            **self.generation_config,
         )
         res = completion.choices[0].message.content
         await self.log_req_res_to_file(prompt, res)
         return res
+
+    async def stream_code(
+            self,
+            prompt: str,
+            system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        stream = await self.ai_client.chat.completions.create(
+            model=self.model,
+            messages=self._code_messages(prompt, system_prompt),
+            stream=True,
+            **self.generation_config,
+        )
+        chunks = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                chunks.append(text)
+                yield text
+        await self.log_req_res_to_file(prompt, "".join(chunks))
+
+    @staticmethod
+    def _code_messages(
+            prompt: str,
+            system_prompt: Optional[str]) -> List[ChatCompletionMessageParam]:
+        """
+        Sends the system prompt first, in a message of its own, so that the
+        prompts sharing it share a prefix OpenAI can cache.
+        """
+        messages: List[ChatCompletionMessageParam] = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": prompt})
+        return messages
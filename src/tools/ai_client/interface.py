@@ -1,27 +1,55 @@
-import os
 from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Optional
+
+from tools.ai_client.log_writer import get_log_writer
 
 
 class AiClient:
     name: str
     system_msg: str
+    model: str
+    # Sampling parameters sent with every request.
+    generation_config: Dict[str, Any]
+    # Most tokens the model reads and writes in a request.
+    context_window: int
 
     async def send_json_chat(self, prompt: str, sys_prompt: str) -> str:
         raise NotImplementedError
 
-    async def generate_code(self, prompt: str) -> str:
+    async def generate_code(self,
+                            prompt: str,
+                            system_prompt: Optional[str] = None) -> str:
+        """
+        Generates code for the prompt. system_prompt holds the instructions
+        shared by every prompt of a generator, sent apart from the prompt
+        where the provider supports it so that it can cache them.
+        """
         raise NotImplementedError
 
+    async def stream_code(
+            self,
+            prompt: str,
+            system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Yields the generated code in chunks as the model produces them.
+        Clients without a streaming mode yield the whole response at once.
+        """
+        yield await self.generate_code(prompt, system_prompt)
+
+    async def close(self):
+        """
+        Releases the connections of the client.
+        """
+
     async def log_req_res_to_file(self, prompt: str, response: str):
-        log_dir = f"ai_logs"
-        os.makedirs(log_dir, exist_ok=True)
-        log_file = f"{log_dir}/{self.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        with open(log_file, 'a') as file:
-            try:
-                file.write(
-                    f"Request:\n{prompt}\n\n<<<<<>>>>>\n\nResponse:\n{response}\n\n"
-                )
-            except FileNotFoundError as e:
-                print(f"Failed to log request and response to file: {e}")
-
-        print(f"Request and response logged to {log_file}")
+        """
+        Queues the request and response for the background log writer. It
+        returns right away, whatever the state of the disk.
+        """
+        get_log_writer().submit({
+            "timestamp": datetime.now().isoformat(),
+            "client": self.name,
+            "model": getattr(self, "model", None),
+            "prompt": prompt,
+            "response": response,
+        })
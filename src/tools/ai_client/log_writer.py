@@ -0,0 +1,150 @@
+import asyncio
+from datetime import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_DIR = "ai_logs"
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_QUEUE_SIZE = 10000
+# Most records written to disk in one go.
+BATCH_SIZE = 256
+SEGMENT_PREFIX = "ai"
+
+
+class AiLogWriter:
+    """
+    Appends AI request/response records to a JSONL segment from a background
+    task, so that logging never waits on the disk. Records are queued by
+    submit, which never blocks: when the queue is full the record is dropped
+    and counted in dropped. The active segment, ai.jsonl, is rotated to a
+    gzipped ai.<timestamp>.jsonl.gz once it reaches segment_bytes, keeping at
+    most max_segments of them.
+    """
+
+    def __init__(self,
+                 directory: str = DEFAULT_LOG_DIR,
+                 segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 compress: bool = True,
+                 max_segments: Optional[int] = None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.queue_size = queue_size
+        self.compress = compress
+        self.max_segments = max_segments
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Future] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._rotations = 0
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}.jsonl")
+
+    def submit(self, record: Dict[str, Any]):
+        """
+        Queues a record for writing. Must be called from a running event loop.
+        """
+        queue = self._ensure_started()
+        try:
+            queue.put_nowait(record)
+        except asyncio.QueueFull:
+            if not self.dropped:
+                logger.warning("AI log queue is full, dropping records")
+            self.dropped += 1
+
+    async def flush(self):
+        """
+        Waits until every submitted record is on disk.
+        """
+        running = asyncio.get_running_loop()
+        if self._queue is not None and self._loop is running:
+            await self._queue.join()
+
+    async def close(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+        self._queue = self._task = self._loop = None
+
+    def _ensure_started(self) -> asyncio.Queue:
+        # The queue and task belong to the loop that created them, so they
+        # are recreated when the writer is used from a new loop.
+        loop = asyncio.get_running_loop()
+        if self._queue is None or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue(self.queue_size)
+            self._task = asyncio.ensure_future(self._run(self._queue))
+        return self._queue
+
+    async def _run(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            lines = [json.dumps(record, default=str) for record in batch]
+            try:
+                await loop.run_in_executor(None, self._write, lines)
+            except Exception:
+                logger.exception(
+                    f"Failed to write {len(lines)} AI log records")
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def _write(self, lines: List[str]):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write("\n".join(lines) + "\n")
+            size = f.tell()
+        if size >= self.segment_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._rotations += 1
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # The rotation count keeps names unique within a second.
+        rotated = os.path.join(
+            self.directory,
+            f"{SEGMENT_PREFIX}.{timestamp}.{self._rotations}.jsonl")
+        os.replace(self.path, rotated)
+        if self.compress:
+            with open(rotated, "rb") as src:
+                with gzip.open(f"{rotated}.gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        if self.max_segments is not None:
+            pattern = os.path.join(self.directory,
+                                   f"{SEGMENT_PREFIX}.*.jsonl*")
+            segments = sorted(glob.glob(pattern), key=os.path.getmtime)
+            excess = len(segments) - self.max_segments
+            for segment in segments[:max(0, excess)]:
+                os.remove(segment)
+
+
+_log_writer: Optional[AiLogWriter] = None
+
+
+def get_log_writer() -> AiLogWriter:
+    """
+    Returns the process-wide log writer, configured by the AI_LOG_DIR,
+    AI_LOG_SEGMENT_BYTES and AI_LOG_MAX_SEGMENTS environment variables.
+    """
+    global _log_writer
+    if _log_writer is None:
+        max_segments = os.getenv("AI_LOG_MAX_SEGMENTS")
+        _log_writer = AiLogWriter(
+            os.getenv("AI_LOG_DIR", DEFAULT_LOG_DIR),
+            segment_bytes=int(
+                os.getenv("AI_LOG_SEGMENT_BYTES", DEFAULT_SEGMENT_BYTES)),
+            max_segments=int(max_segments) if max_segments else None)
+    return _log_writer
@@ -0,0 +1,347 @@
+import asyncio
+from dataclasses import dataclass
+import logging
+import os
+import random
+import sys
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from errors import RateLimitError
+from tools.ai_client.interface import AiClient
+from tools.ai_client.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Limits read from AI_<FIELD> environment variables, e.g. AI_MAX_RETRIES.
+ENV_LIMITS = ("max_concurrency", "requests_per_minute", "tokens_per_minute",
+              "max_wait_seconds", "max_retries")
+# Timeouts and dropped connections, raised before any response arrives.
+CONNECTION_ERRORS = (asyncio.TimeoutError, ConnectionError,
+                     httpx.TransportError)
+
+
+class ProviderError(Exception):
+    """
+    Raise for an error response from an AI provider. The fake provider raises
+    it; real SDK errors are recognised by their status_code or code.
+    """
+
+    def __init__(self, status_code: int, message: str = ""):
+        super().__init__(message or f"Provider returned {status_code}")
+        self.status_code = status_code
+
+
+@dataclass
+class ProviderLimits:
+    """
+    The scheduling budget of one provider, shared by every client of the
+    process talking to it.
+    """
+
+    max_concurrency: int = 4
+    requests_per_minute: float = 60.0
+    tokens_per_minute: float = 90000.0
+    # Longest time a request waits for rate budget before RateLimitError.
+    max_wait_seconds: float = 60.0
+    max_retries: int = 4
+    base_delay_seconds: float = 1.0
+    max_delay_seconds: float = 30.0
+    # Sends a second copy of a request still unanswered after this long and
+    # keeps whichever answers first. None disables hedging.
+    hedge_after_seconds: Optional[float] = None
+
+    @classmethod
+    def from_env(cls) -> "ProviderLimits":
+        limits = cls()
+        for field in ENV_LIMITS:
+            value = os.getenv(f"AI_{field.upper()}")
+            if value:
+                setattr(limits, field, type(getattr(limits, field))(value))
+        hedge_after = os.getenv("AI_HEDGE_AFTER_SECONDS")
+        if hedge_after:
+            limits.hedge_after_seconds = float(hedge_after)
+        return limits
+
+
+def estimate_tokens(*texts: Optional[str]) -> int:
+    return max(1, sum(count_tokens(text) for text in texts if text))
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Throttling (429), server errors (5xx), timeouts and dropped connections
+    are worth retrying; anything else would fail again.
+    """
+    if _is_connection_error(error):
+        return True
+    status = _status(error)
+    return isinstance(status, int) and (status == 429 or 500 <= status < 600)
+
+
+def _is_connection_error(error: BaseException) -> bool:
+    if isinstance(error, CONNECTION_ERRORS):
+        return True
+    # openai wraps transport errors in APIConnectionError, which
+    # APITimeoutError extends. The SDK is only loaded along with the GPT
+    # client, and its errors can't be raised before.
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, openai.APIConnectionError)
+
+
+def is_throttled(error: BaseException) -> bool:
+    return _status(error) == 429
+
+
+def _status(error: BaseException) -> Any:
+    # openai errors carry status_code, google.api_core ones code.
+    return getattr(error, "status_code", None) or getattr(error, "code", None)
+
+
+class TokenBucket:
+    """
+    Refills at rate units per second up to capacity. Waiters are served in
+    arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def try_acquire(self, amount: float) -> bool:
+        self._refill()
+        if self._lock.locked() or self._tokens < amount:
+            return False
+        self._tokens -= amount
+        return True
+
+    async def acquire(self, amount: float, max_wait: float):
+        if amount > self.capacity:
+            raise RateLimitError(
+                f"Request needs {amount} units of a budget of {self.capacity}")
+        deadline = time.monotonic() + max_wait
+        try:
+            await asyncio.wait_for(self._lock.acquire(), max_wait)
+        except asyncio.TimeoutError:
+            raise RateLimitError("Rate limit budget exhausted") from None
+        try:
+            self._refill()
+            wait = max(0.0, (amount - self._tokens) / self.rate)
+            if time.monotonic() + wait > deadline:
+                raise RateLimitError("Rate limit budget exhausted")
+            if wait:
+                await asyncio.sleep(wait)
+                self._refill()
+            self._tokens -= amount
+        finally:
+            self._lock.release()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class _ProviderState:
+
+    def __init__(self, limits: ProviderLimits):
+        self.limits = limits
+        self.semaphore = asyncio.Semaphore(limits.max_concurrency)
+        self.requests = TokenBucket(limits.requests_per_minute / 60,
+                                    limits.requests_per_minute)
+        self.tokens = TokenBucket(limits.tokens_per_minute / 60,
+                                  limits.tokens_per_minute)
+
+
+class AiScheduler:
+    """
+    Runs AI provider calls within per-provider concurrency and rate limits,
+    retrying throttled and failed calls with jittered exponential backoff and
+    optionally hedging slow ones.
+    """
+
+    def __init__(self, default_limits: Optional[ProviderLimits] = None):
+        self.default_limits = default_limits or ProviderLimits()
+        self._limits: Dict[str, ProviderLimits] = {}
+        self._states: Dict[str, _ProviderState] = {}
+
+    def configure(self, provider: str, limits: ProviderLimits):
+        self._limits[provider] = limits
+        self._states.pop(provider, None)
+
+    async def run(self,
+                  provider: str,
+                  call: Callable[[], Awaitable[Any]],
+                  tokens: int = 1) -> Any:
+        """
+        Awaits call(), which must start a new request every time it is
+        called, charging tokens against the provider's token budget.
+        """
+        state = self._state(provider)
+        async with state.semaphore:
+            attempt = 0
+            while True:
+                await self._acquire(state, tokens)
+                try:
+                    return await self._hedged(state, call, tokens)
+                except Exception as e:
+                    delay = self._retry_delay(provider, state.limits, attempt,
+                                              e)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def stream(self,
+                     provider: str,
+                     call: Callable[[], AsyncIterator[str]],
+                     tokens: int = 1) -> AsyncIterator[str]:
+        """
+        Yields the chunks of call(), like run. A failed stream is only
+        retried until its first chunk is out, and streams are never hedged.
+        """
+        state = self._state(provider)
+        async with state.semaphore:
+            attempt = 0
+            while True:
+                await self._acquire(state, tokens)
+                started = False
+                try:
+                    async for chunk in call():
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started:
+                        raise
+                    delay = self._retry_delay(provider, state.limits, attempt,
+                                              e)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _acquire(state: _ProviderState, tokens: int):
+        await state.requests.acquire(1, state.limits.max_wait_seconds)
+        await state.tokens.acquire(tokens, state.limits.max_wait_seconds)
+
+    def _retry_delay(self, provider: str, limits: ProviderLimits, attempt: int,
+                     error: Exception) -> float:
+        """
+        Returns how long to wait before retrying a failed call, or raises
+        when it should not be retried.
+        """
+        if not is_retryable(error):
+            raise error
+        if attempt >= limits.max_retries:
+            if is_throttled(error):
+                raise RateLimitError(f"{provider} is still throttling after "
+                                     f"{attempt} retries") from error
+            raise error
+        delay = self._backoff(limits, attempt, error)
+        logger.warning(f"{provider} call failed ({error}), retry "
+                       f"{attempt + 1} of {limits.max_retries} in "
+                       f"{delay:.2f}s")
+        return delay
+
+    async def _hedged(self, state: _ProviderState,
+                      call: Callable[[], Awaitable[Any]], tokens: int) -> Any:
+        hedge_after = state.limits.hedge_after_seconds
+        if hedge_after is None:
+            return await call()
+        primary = asyncio.ensure_future(call())
+        done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+        # The hedge only goes out when it fits in the budget right away.
+        if (done or not state.requests.try_acquire(1)
+                or not state.tokens.try_acquire(tokens)):
+            return await primary
+        hedge = asyncio.ensure_future(call())
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None or not pending:
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _backoff(limits: ProviderLimits, attempt: int,
+                 error: BaseException) -> float:
+        # Full jitter keeps clients throttled together from retrying in
+        # lockstep. A Retry-After from the provider is a lower bound.
+        ceiling = min(limits.max_delay_seconds,
+                      limits.base_delay_seconds * 2**attempt)
+        delay = random.uniform(0, ceiling)
+        retry_after = getattr(error, "retry_after", None)
+        if isinstance(retry_after, (int, float)):
+            delay = max(delay, retry_after)
+        return delay
+
+    def _state(self, provider: str) -> _ProviderState:
+        if provider not in self._states:
+            limits = self._limits.get(provider, self.default_limits)
+            self._states[provider] = _ProviderState(limits)
+        return self._states[provider]
+
+
+_scheduler: Optional[AiScheduler] = None
+
+
+def get_scheduler() -> AiScheduler:
+    """
+    Returns the process-wide scheduler, so that every client of a provider
+    shares its limits. The defaults come from AI_* environment variables,
+    e.g. AI_REQUESTS_PER_MINUTE.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = AiScheduler(ProviderLimits.from_env())
+    return _scheduler
+
+
+class ScheduledAiClient(AiClient):
+    """
+    Wraps an AiClient to send its requests through an AiScheduler.
+    """
+
+    def __init__(self,
+                 client: AiClient,
+                 scheduler: Optional[AiScheduler] = None):
+        self.client = client
+        self.scheduler = scheduler or get_scheduler()
+        self.name = client.name
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+    async def send_json_chat(self, prompt: str, sys_prompt: str) -> str:
+        return await self.scheduler.run(
+            self.client.name,
+            lambda: self.client.send_json_chat(prompt, sys_prompt),
+            estimate_tokens(prompt, sys_prompt))
+
+    async def generate_code(self,
+                            prompt: str,
+                            system_prompt: Optional[str] = None) -> str:
+        return await self.scheduler.run(
+            self.client.name,
+            lambda: self.client.generate_code(prompt, system_prompt),
+            estimate_tokens(prompt, system_prompt))
+
+    async def stream_code(
+            self,
+            prompt: str,
+            system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        tokens = estimate_tokens(prompt, system_prompt)
+        async for chunk in self.scheduler.stream(
+                self.client.name,
+                lambda: self.client.stream_code(prompt, system_prompt),
+                tokens):
+            yield chunk
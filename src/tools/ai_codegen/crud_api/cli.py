@@ -1,11 +1,34 @@
 import argparse
 import asyncio
+from dataclasses import dataclass, replace
+import json
+import logging
 import os
-import zipfile
+import re
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, TextIO
+from tools.ai_client.cache import CacheMode
+from tools.ai_client.factory import close_ai_clients, get_ai_client
+from tools.ai_client.interface import AiClient
+from tools.ai_client.log_writer import get_log_writer
+from tools.ai_client.scheduler import get_scheduler
 from tools.ai_codegen.crud_api.generator import CrudApiCodeGen
+from tools.ai_codegen.dag import Artifact
+from tools.ai_codegen.manifest import Manifest
+from tools.ai_codegen.packaging import (PROJECT_NAME_PATTERN, StreamingZip,
+                                        ZipOptions)
+from tools.ai_codegen.prompts import format_usage
 
 DEFAULT_PROJECT_NAME = "MyAPIProject"
 DEFAULT_SPEC = "A simple CRUD API for an event management system."
+DEFAULT_BATCH_CONCURRENCY = 4
+# Options overriding the ProviderLimits field of the same name.
+RATE_BUDGET_OPTIONS = ("max_concurrency", "requests_per_minute",
+                       "tokens_per_minute")
+
+logger = logging.getLogger(__name__)
 
 
 def write_to_file(folder_path: str, filename: str, content: str):
@@ -13,16 +36,226 @@ def write_to_file(folder_path: str, filename: str, content: str):
         file.write(content)
 
 
-def zip_project_folder(folder_path):
-    zip_filename = f"{folder_path}.zip"
-    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                zipf.write(
-                    os.path.join(root, file),
-                    os.path.relpath(os.path.join(root, file),
-                                    os.path.join(folder_path, '..')))
-    return zip_filename
+def _umask() -> int:
+    # The umask can only be read by setting it.
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+class ProjectZip:
+    """
+    Writes <folder_path>.zip one file at a time, straight from memory. The
+    archive is written to a temporary file that only replaces the zip once
+    closed, so a failed run leaves the previous zip as it was.
+    """
+
+    def __init__(self, folder_path: str, options: Optional[ZipOptions] = None):
+        self.path = f"{folder_path}.zip"
+        self._archive = StreamingZip(os.path.basename(folder_path), options)
+        folder = os.path.dirname(self.path) or "."
+        fd, self._temp_path = tempfile.mkstemp(dir=folder, suffix=".zip.tmp")
+        self._file = os.fdopen(fd, 'wb')
+
+    def add(self, artifact: Artifact, code: str):
+        self._file.write(self._archive.add(artifact.filename, code))
+
+    def close(self) -> str:
+        self._file.write(self._archive.close())
+        self._file.close()
+        # mkstemp creates the file readable by its owner only, give the zip
+        # the permissions open() would have.
+        os.chmod(self._temp_path, 0o666 & ~_umask())
+        os.replace(self._temp_path, self.path)
+        return self.path
+
+    def abort(self):
+        self._archive.abort()
+        self._file.close()
+        os.remove(self._temp_path)
+
+
+async def stream_to_files(code_gen: CrudApiCodeGen,
+                          folder_path: str,
+                          verbose: bool = True,
+                          incremental: bool = True,
+                          zip_options: Optional[ZipOptions] = None) -> str:
+    """
+    Writes every generated artifact to its file in the folder, flushing each
+    chunk so that the files fill up while the model is still generating.
+    When incremental, the files whose inputs are unchanged since the last run
+    in the folder are left as they are. Either way the manifest of the folder
+    is updated. Every artifact is also added to <folder_path>.zip as soon as
+    it is complete; the path of the zip is returned.
+    """
+    manifest = Manifest(folder_path, reuse=incremental)
+    filenames = {
+        artifact.name: artifact.filename
+        for artifact in code_gen.artifacts()
+    }
+    files: Dict[str, TextIO] = {}
+    project_zip = ProjectZip(folder_path, zip_options)
+    try:
+        async for component, chunk in code_gen.stream_all(
+                manifest, project_zip.add):
+            if component not in files:
+                filename = filenames[component]
+                if verbose:
+                    print(f"Writing {filename}...")
+                files[component] = open(os.path.join(folder_path, filename),
+                                        'w')
+            files[component].write(chunk)
+            files[component].flush()
+    except BaseException:
+        project_zip.abort()
+        raise
+    finally:
+        for file in files.values():
+            file.close()
+    return project_zip.close()
+
+
+@dataclass
+class BatchSpec:
+    project_name: str
+    spec: str
+
+
+@dataclass
+class ProjectResult:
+    project_name: str
+    seconds: float = 0
+    zip_path: Optional[str] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class BatchReport:
+    results: List[ProjectResult]
+    seconds: float
+
+    def summary(self) -> str:
+        done = [result for result in self.results if result.error is None]
+        failed = [
+            result for result in self.results if result.error is not None
+        ]
+        per_minute = len(done) / self.seconds * 60 if self.seconds else 0
+        lines = [
+            f"{len(done)} of {len(self.results)} projects generated in "
+            f"{self.seconds:.1f}s ({per_minute:.1f} projects/minute)"
+        ]
+        if done:
+            latencies = sorted(result.seconds for result in done)
+            p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            lines.append(f"Latency: p50 {statistics.median(latencies):.1f}s, "
+                         f"p95 {p95:.1f}s, max {latencies[-1]:.1f}s")
+        for result in failed:
+            lines.append(f"Failed {result.project_name}: {result.error}")
+        return "\n".join(lines)
+
+
+def is_valid_project_name(project_name: Any) -> bool:
+    return isinstance(project_name, str) and bool(
+        re.fullmatch(PROJECT_NAME_PATTERN, project_name))
+
+
+def load_batch_specs(path: str) -> List[BatchSpec]:
+    """
+    Reads one {"spec": ..., "project_name": ...} object per line of a JSONL
+    file. project_name defaults to project_<line number>.
+    """
+    specs = []
+    with open(path) as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"Line {number} of {path} isn't valid JSON: "
+                                 f"{e}")
+            if not isinstance(entry, dict) or not entry.get("spec"):
+                raise ValueError(f"Line {number} of {path} has no spec")
+            name = entry.get("project_name") or f"project_{number}"
+            if not is_valid_project_name(name):
+                raise ValueError(f"Line {number} of {path} has an invalid "
+                                 f"project_name {name!r}")
+            specs.append(BatchSpec(name, entry["spec"]))
+    names = [spec.project_name for spec in specs]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate project names: {sorted(duplicates)}")
+    return specs
+
+
+async def generate_project(spec: BatchSpec,
+                           output_dir: str,
+                           ai_client: AiClient,
+                           incremental: bool = True,
+                           zip_options: Optional[ZipOptions] = None) -> str:
+    """
+    Generates a project into output_dir and returns the path of its zip.
+    """
+    project_folder = os.path.join(output_dir, spec.project_name)
+    os.makedirs(project_folder, exist_ok=True)
+    code_gen = CrudApiCodeGen(spec.spec, ai_client)
+    return await stream_to_files(code_gen,
+                                 project_folder,
+                                 verbose=False,
+                                 incremental=incremental,
+                                 zip_options=zip_options)
+
+
+async def run_batch(specs: List[BatchSpec],
+                    output_dir: str,
+                    ai_client: AiClient,
+                    concurrency: int = DEFAULT_BATCH_CONCURRENCY,
+                    incremental: bool = True,
+                    zip_options: Optional[ZipOptions] = None) -> BatchReport:
+    """
+    Generates the projects, at most concurrency at a time, writing and
+    zipping each one as soon as it is complete. Failed projects are reported
+    without stopping the others.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+    completed = 0
+
+    async def run(spec: BatchSpec) -> ProjectResult:
+        nonlocal completed
+        async with semaphore:
+            result = ProjectResult(spec.project_name)
+            started = time.perf_counter()
+            try:
+                result.zip_path = await generate_project(
+                    spec, output_dir, ai_client, incremental, zip_options)
+            except Exception as e:
+                logger.exception(f"Failed to generate {spec.project_name}")
+                result.error = str(e) or type(e).__name__
+            result.seconds = time.perf_counter() - started
+        completed += 1
+        outcome = result.zip_path or f"failed: {result.error}"
+        print(f"[{completed}/{len(specs)}] {spec.project_name} "
+              f"({result.seconds:.1f}s): {outcome}")
+        return result
+
+    results = await asyncio.gather(*(run(spec) for spec in specs))
+    return BatchReport(list(results), time.perf_counter() - start)
+
+
+def configure_rate_budget(ai_client: AiClient, args: argparse.Namespace):
+    """
+    Applies the rate budget options to the scheduler shared by every
+    pipeline of the batch.
+    """
+    overrides = {
+        field: getattr(args, field)
+        for field in RATE_BUDGET_OPTIONS if getattr(args, field) is not None
+    }
+    if overrides:
+        scheduler = get_scheduler()
+        limits = replace(scheduler.default_limits, **overrides)
+        scheduler.configure(ai_client.name, limits)
 
 
 async def main():
@@ -40,30 +273,123 @@ async def main():
         help=
         f"The specification of the API in natural language (default: {DEFAULT_SPEC})"
     )
+    parser.add_argument(
+        "--client",
+        type=str,
+        default=None,
+        help="The AI client to use: gpt, gemini or fake (default: from env)")
+    parser.add_argument(
+        "--cache",
+        type=str,
+        choices=[mode.value for mode in CacheMode],
+        default=os.getenv("AI_CACHE_MODE", CacheMode.READ_WRITE.value),
+        help=
+        "Reuse the AI responses of identical earlier requests; replay never calls the model (default: read_write)"
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        default=None,
+        help=
+        "Generate every project of a JSONL file of {\"spec\": ..., \"project_name\": ...} lines instead of --spec"
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=os.getcwd(),
+        help="The folder the projects are written to (default: current folder)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_BATCH_CONCURRENCY,
+        help=
+        f"Projects generated at the same time in batch mode (default: {DEFAULT_BATCH_CONCURRENCY})"
+    )
+    parser.add_argument("--max_concurrency",
+                        type=int,
+                        default=None,
+                        help="Most AI requests in flight across all projects")
+    parser.add_argument("--requests_per_minute",
+                        type=float,
+                        default=None,
+                        help="AI request budget shared by all projects")
+    parser.add_argument("--tokens_per_minute",
+                        type=float,
+                        default=None,
+                        help="AI prompt token budget shared by all projects")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help=
+        "Regenerate every file, even those whose spec, template and inputs are unchanged since the last run"
+    )
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        choices=range(10),
+        default=None,
+        help="The zlib level the zips are compressed at (default: zlib's)")
+    parser.add_argument("--store",
+                        action="store_true",
+                        help="Store the files in the zips uncompressed")
     args = parser.parse_args()
+    if not args.batch and not is_valid_project_name(args.project_name):
+        parser.error("--project_name may only contain letters, digits, _ "
+                     "and -")
+    specs: List[BatchSpec] = []
+    if args.batch:
+        # Checked before connecting to the model, so that a bad line fails
+        # fast and without a traceback.
+        try:
+            specs = load_batch_specs(args.batch)
+        except (OSError, ValueError) as e:
+            parser.error(f"--batch: {e}")
 
-    project_name = args.project_name
-    spec = args.spec
+    zip_options = ZipOptions(args.compression_level, args.store)
+    ai_client = get_ai_client(args.client, args.cache)
+    configure_rate_budget(ai_client, args)
+    try:
+        if args.batch:
+            report = await run_batch(specs, args.output_dir, ai_client,
+                                     args.concurrency, not args.force,
+                                     zip_options)
+            print(report.summary())
+        else:
+            await generate_single(args.project_name, args.spec,
+                                  args.output_dir, ai_client, not args.force,
+                                  zip_options)
+    finally:
+        # Close the pooled AI connections and let the background writer
+        # finish the AI request logs
+        await close_ai_clients()
+        await get_log_writer().close()
 
-    # Generate code
-    code_gen = CrudApiCodeGen(spec)
-    generated_components = await code_gen.generate_all()
 
+async def generate_single(project_name: str,
+                          spec: str,
+                          output_dir: str,
+                          ai_client: AiClient,
+                          incremental: bool = True,
+                          zip_options: Optional[ZipOptions] = None):
+    """
+    Generates a project into output_dir, writing its files as they stream
+    in and adding each one to its zip as soon as it is complete.
+    """
     # Create project folder
-    project_folder = os.path.join(os.getcwd(), project_name)
+    project_folder = os.path.join(output_dir, project_name)
     os.makedirs(project_folder, exist_ok=True)
 
-    # Write generated code to files
-    write_to_file(project_folder, "datamodels.py",
-                  generated_components["datamodels"])
-    write_to_file(project_folder, "router.py", generated_components["router"])
-    write_to_file(project_folder, "service.py",
-                  generated_components["service"])
-    write_to_file(project_folder, "main.py",
-                  generated_components["main"])  # New: Write the main file
-
-    # Zip the project folder
-    zip_path = zip_project_folder(project_folder)
+    # Generate code, writing each file as its chunks arrive
+    code_gen = CrudApiCodeGen(spec, ai_client)
+    zip_path = await stream_to_files(code_gen,
+                                     project_folder,
+                                     incremental=incremental,
+                                     zip_options=zip_options)
+    if code_gen.last_run is not None:
+        print(code_gen.last_run.summary())
+    if code_gen.usage:
+        print(format_usage(code_gen.usage))
 
     # Output the path to the zip file
     print(f"Project zipped at: {zip_path}")
@@ -1,6 +1,7 @@
 import asyncio
 # Assuming the CrudApiCodeGen and AiClient are defined in crud_api_code_gen.py
 from tools.ai_codegen.crud_api.generator import CrudApiCodeGen
+from tools.ai_codegen.prompts import format_usage
 
 # Unified specification for the Book Management System
 specification = """
@@ -19,18 +20,19 @@ async def test_crud_api_codegen():
     # Create an instance of the CrudApiCodeGen with the unified specification
     code_generator = CrudApiCodeGen(specification)
 
-    # Generate code based on the provided specification
-    datamodels_code = await code_generator.generate_datamodels()
-    router_code = await code_generator.generate_router()
-    service_code = await code_generator.generate_service()
+    # Generate every artifact, each one as soon as its inputs are ready
+    run = await code_generator.run_all()
 
     # Output the generated code for review
-    print("=== Data Models Code ===")
-    print(datamodels_code, "\n")
-    print("=== Router Code ===")
-    print(router_code, "\n")
-    print("=== Service Code ===")
-    print(service_code, "\n")
+    for artifact in code_generator.artifacts():
+        print(f"=== {artifact.filename} ===")
+        print(run.outputs[artifact.name], "\n")
+
+    # Output when each artifact was generated
+    print(run.summary())
+
+    # Output the tokens each artifact used
+    print(format_usage(code_generator.usage))
 
 
 if __name__ == "__main__":
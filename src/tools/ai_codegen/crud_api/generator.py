@@ -1,149 +1,314 @@
 import asyncio
+import logging
+from typing import (Any, AsyncIterator, Callable, Dict, List, Optional, Set,
+                    Tuple)
 from tools.ai_client.factory import get_ai_client
+from tools.ai_client.interface import AiClient
+from tools.ai_client.tokens import count_tokens
 from tools.ai_codegen.crud_api.templates.service import template as service_template
 from tools.ai_codegen.crud_api.templates.router import template as router_template
 from tools.ai_codegen.crud_api.templates.datamodels import template as datamodels_template
 from tools.ai_codegen.crud_api.templates.main import template as main_template
+from tools.ai_codegen.dag import Artifact, ArtifactGraph, GraphRun, Produce
+from tools.ai_codegen.manifest import Manifest, input_hash
+from tools.ai_codegen.prompts import (SYSTEM_PROMPT, PromptSection, TokenUsage,
+                                      build_prompt, compact, compact_template,
+                                      prompt_budget)
+
+CodeStream = AsyncIterator[str]
+OnComplete = Callable[[Artifact, str], None]
+
+logger = logging.getLogger(__name__)
 
 
 class CrudApiCodeGen:
 
-    def __init__(self, spec: str):
+    def __init__(self, spec: str, ai_client: Optional[AiClient] = None):
         """
         Initializes the CRUD API code generator with a specific set of specifications.
         
         :param spec: A string containing a natural language description of the entire API.
+        :param ai_client: The client used to generate code, get_ai_client() by default.
         """
-        self.spec = f"""{spec}. Make sure to only include source code in your response. 
-        The string from your response will be written to a file for execution, 
-        so you must not include any additional comments or instructions.
-        Also ensure to not include any formatting or markdown syntax (such as ```python) in your response.
-        The outputted string should be valid Python code that is executable as is.
-        """
+        # The instructions on the form of the response are in SYSTEM_PROMPT,
+        # shared by every prompt.
+        self.spec = spec.strip()
         self._datamodel = ""
         self._service = ""
-        self.ai_client = get_ai_client()
+        # Outputs and timings of the last run_all or stream_all.
+        self.last_run: Optional[GraphRun] = None
+        # Tokens used by each artifact generated since the last run started.
+        self.usage: Dict[str, TokenUsage] = {}
+        self.ai_client = ai_client or get_ai_client()
+        self.max_prompt_tokens = prompt_budget(self.ai_client)
 
-    async def generate_datamodels(self) -> str:
+    def _datamodels_prompt(self) -> str:
         """
-        Generates the content for the datamodels.py file based on a natural language spec,
+        Builds the prompt for the datamodels.py file based on a natural language spec,
         combining detailed instructions with a template for code generation.
         """
-        prompt = f"""
-        # Specification:
-        {self.spec}
+        return self._prompt(
+            datamodels_template, """
+            Generate Python code for data models using Pydantic. The code should include necessary imports.
+            Define enums and models based on the specification above, using the template above as a guideline.
+            """)
 
-        # Template:
-        {datamodels_template}
-
-        # Instructions:
-        Generate Python code for data models using Pydantic. The code should include necessary imports. 
-        Define enums and models based on the specification above, using the following template as a guideline.
+    def _router_prompt(self, datamodels: str) -> str:
         """
-        # Additional template and example details would be included here.
-        generated_code = await self._send_prompt(prompt)
-        self._datamodel = generated_code
-        return generated_code
+        Builds the prompt for the router.py file based on a natural language spec,
+        combining detailed instructions with a template for code generation.
+        """
+        return self._prompt(
+            router_template, """
+            Generate Python code for FastAPI router including necessary imports and route decorators.
+            """, datamodels)
 
-    async def generate_router(self) -> str:
+    def _service_prompt(self, datamodels: str) -> str:
         """
-        Generates the content for the router.py file based on a natural language spec,
+        Builds the prompt for the service.py file based on a natural language spec,
         combining detailed instructions with a template for code generation.
         """
-        prompt = f"""
-        # Specification:
-        {self.spec}
+        return self._prompt(
+            service_template, """
+            Generate Python code for the service layer, including necessary functions and business logic.
+            The service layer interacts with the database or external services to perform CRUD operations,
+            including retrieving a specific item by ID.
+            Your code should replace the YourService class methods with specifics from the specification,
+            including details for the method to get an item by ID.
+            """, datamodels)
 
-        # Template:
-        {router_template}
+    def _main_prompt(self) -> str:
+        """
+        Builds the prompt for the api.py file based on a natural language spec,
+        combining detailed instructions with a template for code generation.
+        """
+        return self._prompt(
+            main_template, """
+            Generate Python code for the main API file, including the FastAPI app setup,
+            importing routers and defining the main entry point for the API.
+            """)
 
-        # Data Models:
-        {self._datamodel}
+    def _prompt(self,
+                template: str,
+                instructions: str,
+                datamodels: Optional[str] = None) -> str:
+        """
+        Builds a prompt from the spec, a template, the generated data models
+        if given and instructions, within the prompt budget of the client.
+        The data models are summarized when the prompt would exceed it.
+        """
+        sections = [
+            PromptSection("Specification", self.spec),
+            PromptSection("Template", compact_template(template)),
+        ]
+        if datamodels is not None:
+            sections.append(
+                PromptSection("Data Models", datamodels, trimmable=True))
+        sections.append(PromptSection("Instructions", compact(instructions)))
+        return build_prompt(sections, self.max_prompt_tokens)
 
-        # Instructions:
-        Generate Python code for FastAPI router including necessary imports and route decorators. 
+    async def generate_datamodels(self) -> str:
         """
-        # Additional template and example details would be included here.
-        generated_code = await self._send_prompt(prompt)
+        Generates the content for the datamodels.py file. The router and
+        service prompts include it.
+        """
+        generated_code = await self._send_prompt("datamodels",
+                                                 self._datamodels_prompt())
+        self._datamodel = generated_code
         return generated_code
 
+    async def generate_router(self) -> str:
+        return await self._send_prompt("router",
+                                       self._router_prompt(self._datamodel))
+
     async def generate_service(self) -> str:
+        return await self._send_prompt("service",
+                                       self._service_prompt(self._datamodel))
+
+    async def generate_main(self) -> str:
+        return await self._send_prompt("main", self._main_prompt())
+
+    def artifacts(self) -> List[Artifact]:
         """
-        Generates the content for the service.py file based on a natural language spec,
-        combining detailed instructions with a template for code generation.
+        The files of the generated API. Each one is generated as soon as the
+        artifacts named in its inputs are, so the main file doesn't wait for
+        the datamodels.
         """
-        prompt = f"""
-        # Specification:
-        {self.spec}
+        return [
+            Artifact("datamodels", "datamodels.py",
+                     lambda _: self._datamodels_prompt()),
+            Artifact("router",
+                     "router.py",
+                     lambda inputs: self._router_prompt(inputs["datamodels"]),
+                     inputs=("datamodels", )),
+            Artifact("service",
+                     "service.py",
+                     lambda inputs: self._service_prompt(inputs["datamodels"]),
+                     inputs=("datamodels", )),
+            Artifact("main", "main.py", lambda _: self._main_prompt()),
+        ]
 
-        # Template:
-        {service_template}
-        
-        # Data Models:
-        {self._datamodel}
+    async def run_all(self, manifest: Optional[Manifest] = None) -> GraphRun:
+        """
+        Generates every artifact and returns their code along with when each
+        one was generated. With a manifest, artifacts whose inputs haven't
+        changed since they were recorded in it are reused instead.
+        """
 
+        async def produce(artifact: Artifact, inputs: Dict[str, str]) -> str:
+            return await self._send_prompt(artifact.name,
+                                           artifact.prompt(inputs))
 
-        # Instructions:
-        Generate Python code for the service layer, including necessary functions and business logic. 
-        The service layer interacts with the database or external services to perform CRUD operations, 
-        including retrieving a specific item by ID.
+        reused: Set[str] = set()
+        self.usage = {}
+        graph = ArtifactGraph(self.artifacts())
+        run = await graph.run(self._incremental(produce, manifest, reused))
+        return self._finish(run, reused)
 
+    async def generate_all(self) -> dict:
+        """
+        Generates all the code components for the CRUD API based on the natural language spec.
+        """
+        return (await self.run_all()).outputs
 
-        # Your code should replace the YourService class methods with specifics from the specification,
-        # including details for the method to get an item by ID.
+    async def stream_all(
+        self,
+        manifest: Optional[Manifest] = None,
+        on_complete: Optional[OnComplete] = None
+    ) -> AsyncIterator[Tuple[str, str]]:
         """
-        # Additional template and example details would be included here.
-        generated_code = await self._send_prompt(prompt)
-        return generated_code
+        Generates the same components as generate_all, yielding (component, chunk)
+        pairs as the model produces them. Components generated concurrently
+        interleave their chunks. The timings are in last_run once the stream
+        is exhausted. Artifacts reused from the manifest yield no chunks.
+        on_complete is called with every artifact and its code as soon as it
+        is complete, reused ones included.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
 
-    async def generate_main(self) -> str:
+        async def produce(artifact: Artifact, inputs: Dict[str, str]) -> str:
+            chunks = []
+            prompt = artifact.prompt(inputs)
+            async for chunk in self._stream_prompt(artifact.name, prompt):
+                chunks.append(chunk)
+                queue.put_nowait((artifact.name, chunk))
+            return "".join(chunks)
+
+        async for item in self._run_queued(produce, manifest, queue,
+                                           on_complete):
+            yield item
+
+    async def iter_artifacts(
+        self,
+        manifest: Optional[Manifest] = None
+    ) -> AsyncIterator[Tuple[Artifact, str]]:
         """
-        Generates the content for the api.py file based on a natural language spec,
-        combining detailed instructions with a template for code generation.
+        Generates the same components as generate_all, yielding each artifact
+        with its code as soon as it is complete, reused ones included.
         """
-        prompt = f"""
-        # Specification:
-        {self.spec}
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def produce(artifact: Artifact, inputs: Dict[str, str]) -> str:
+            return await self._send_prompt(artifact.name,
+                                           artifact.prompt(inputs))
 
-        # Template:
-        {main_template}
+        def emit(artifact: Artifact, code: str):
+            queue.put_nowait((artifact, code))
 
-        # Instructions:
-        Generate Python code for the main API file, including the FastAPI app setup, 
-        importing routers and defining the main entry point for the API.
+        async for item in self._run_queued(produce, manifest, queue, emit):
+            yield item
+
+    async def _run_queued(
+            self,
+            produce: Produce,
+            manifest: Optional[Manifest],
+            queue: asyncio.Queue,
+            on_complete: Optional[OnComplete] = None) -> AsyncIterator[Any]:
         """
-        # Additional template and example details would be included here.
-        generated_code = await self._send_prompt(prompt)
-        return generated_code
+        Runs the artifact graph in the background, yielding what produce puts
+        on the queue until the run ends, and calling on_complete as each
+        artifact completes.
+        """
+        done = object()
+        reused: Set[str] = set()
+        self.usage = {}
+        incremental = self._incremental(produce, manifest, reused)
 
-    async def generate_all(self) -> dict:
+        async def produce_and_complete(artifact: Artifact,
+                                       inputs: Dict[str, str]) -> str:
+            code = await incremental(artifact, inputs)
+            if on_complete is not None:
+                on_complete(artifact, code)
+            return code
+
+        graph = ArtifactGraph(self.artifacts())
+        run = asyncio.ensure_future(graph.run(produce_and_complete))
+        run.add_done_callback(lambda _: queue.put_nowait(done))
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                yield item
+            self._finish(run.result(), reused)
+        finally:
+            run.cancel()
+
+    def _incremental(self, produce: Produce, manifest: Optional[Manifest],
+                     reused: Set[str]) -> Produce:
         """
-        Generates all the code components for the CRUD API based on the natural language spec.
+        Wraps produce to return the code recorded in the manifest for
+        artifacts whose inputs are unchanged, adding their names to reused,
+        and to record the others once generated. An artifact whose upstream
+        code changed has a different prompt, so dependents are regenerated
+        too.
         """
-        datamodels_code = await self.generate_datamodels()
-        router_code_gen_task = self.generate_router()
-        service_code_gen_task = self.generate_service()
-        main_code_gen_task = self.generate_main()
+        if manifest is None:
+            return produce
+
+        async def reuse(artifact: Artifact, inputs: Dict[str, str]) -> str:
+            inputs_hash = input_hash(artifact.prompt(inputs), self.ai_client,
+                                     SYSTEM_PROMPT)
+            code = manifest.reusable(artifact, inputs_hash)
+            if code is not None:
+                reused.add(artifact.name)
+                return code
+            code = await produce(artifact, inputs)
+            manifest.record(artifact, inputs_hash, code)
+            return code
+
+        return reuse
 
-        router_code, service_code, main_code = await asyncio.gather(
-            router_code_gen_task, service_code_gen_task, main_code_gen_task)
-        return {
-            "datamodels": datamodels_code,
-            "router": router_code,
-            "service": service_code,
-            "main": main_code
-        }
+    def _finish(self, run: GraphRun, reused: Set[str]) -> GraphRun:
+        for name in reused:
+            run.timings[name].reused = True
+        self.last_run = run
+        self._datamodel = run.outputs.get("datamodels", "")
+        return run
 
-    async def _send_prompt(self, prompt: str) -> str:
+    async def _send_prompt(self, name: str, prompt: str) -> str:
         """
         Sends a prompt to the AI model to generate code based on the given prompt.
         
+        :param name: The artifact the code is for, under which its token usage is recorded.
         :param prompt: The prompt for generating code.
         :return: The generated code.
         """
-        prompt = f"""
-        {prompt}. 
-        Make sure that all methods are implemented and do not contain "pass", 
-        blank space or placeholder comments.
-        """
-        return await self.ai_client.generate_code(prompt)
+        code = await self.ai_client.generate_code(prompt, SYSTEM_PROMPT)
+        self._record_usage(name, prompt, code)
+        return code
+
+    async def _stream_prompt(self, name: str, prompt: str) -> CodeStream:
+        chunks = []
+        async for chunk in self.ai_client.stream_code(prompt, SYSTEM_PROMPT):
+            chunks.append(chunk)
+            yield chunk
+        self._record_usage(name, prompt, "".join(chunks))
+
+    def _record_usage(self, name: str, prompt: str, code: str):
+        usage = TokenUsage(
+            count_tokens(SYSTEM_PROMPT) + count_tokens(prompt),
+            count_tokens(code))
+        self.usage[name] = usage
+        logger.info(f"Generated {name}: {usage.prompt_tokens} prompt + "
+                    f"{usage.completion_tokens} completion tokens")
@@ -51,13 +51,14 @@ See some examples below:
         return datasource.id
 
     async def get_datasources(
-        self, page: int = 1, page_size: int = 0
+        self, page: int = 1, page_size: int = 0, cursor: Optional[str] = None
     ) -> PaginatedResult[DataSource]:
         page_size = page_size or self.default_limit
         query = self.datastore.get_query_builder()
         query.sort_by("created_at", SortOrder.DESCENDING)
         query.set_limit(page_size)
         query.set_offset((page - 1) * page_size)
+        query.set_cursor(cursor)
         result_data = await self.datastore.get_paginated(self.db_collection, query)
         result = PaginatedResult[DataSource](
             total=result_data.total,
@@ -65,6 +66,7 @@ See some examples below:
             page=result_data.page,
             pages=result_data.pages,
             page_size=result_data.page_size,
+            next_cursor=result_data.next_cursor,
         )
         result.items = [DataSource(**datasource) for datasource in result_data.items]
         logger.info(f"Found {len(result.items)} datasources")
@@ -0,0 +1,149 @@
+"""
+Runs the generation of artifacts that depend on each other's output, each
+one as soon as its inputs are ready.
+"""
+import asyncio
+from dataclasses import dataclass, field
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+@dataclass
+class Artifact:
+    """
+    A generated file. prompt builds the prompt of the artifact from the
+    output of the artifacts named by inputs.
+    """
+
+    name: str
+    filename: str
+    prompt: Callable[[Dict[str, str]], str]
+    inputs: Tuple[str, ...] = ()
+
+
+@dataclass
+class ArtifactTiming:
+    """
+    When an artifact was generated, in seconds since the start of the run.
+    critical_input is the input that finished last, i.e. the one that held
+    the artifact back. reused is set when the artifact was reused from an
+    earlier run instead of generated.
+    """
+
+    name: str
+    started: float
+    finished: float
+    critical_input: Optional[str] = None
+    reused: bool = False
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+@dataclass
+class GraphRun:
+    outputs: Dict[str, str] = field(default_factory=dict)
+    timings: Dict[str, ArtifactTiming] = field(default_factory=dict)
+    seconds: float = 0
+
+    def critical_path(self, name: Optional[str] = None) -> List[str]:
+        """
+        Returns the chain of artifacts that determined when name finished,
+        first to last. Defaults to the artifact that finished last, whose
+        chain sets the wall-clock time of the run.
+        """
+        if name is None:
+            if not self.timings:
+                return []
+            name = max(self.timings.values(), key=lambda t: t.finished).name
+        path = []
+        current: Optional[str] = name
+        while current is not None:
+            path.append(current)
+            current = self.timings[current].critical_input
+        return path[::-1]
+
+    def summary(self) -> str:
+        timings = sorted(self.timings.values(), key=lambda t: t.started)
+        lines = [
+            f"{t.name:<12} {t.started:7.2f}s -> {t.finished:7.2f}s "
+            f"({'reused' if t.reused else f'{t.duration:.2f}s'})"
+            for t in timings
+        ]
+        path = " -> ".join(self.critical_path())
+        lines.append(f"Critical path: {path} ({self.seconds:.2f}s)")
+        return "\n".join(lines)
+
+
+Produce = Callable[[Artifact, Dict[str, str]], Awaitable[str]]
+
+
+class ArtifactGraph:
+
+    def __init__(self, artifacts: List[Artifact]):
+        self.artifacts = {artifact.name: artifact for artifact in artifacts}
+        self.order = self._sort()
+
+    async def run(self, produce: Produce) -> GraphRun:
+        """
+        Calls produce(artifact, inputs) for every artifact, where inputs maps
+        the artifact's inputs to their output, and returns the outputs with
+        their timings. Artifacts with no path between them run concurrently.
+        The first failure cancels the rest of the run.
+        """
+        result = GraphRun()
+        start = time.perf_counter()
+
+        async def build(artifact: Artifact) -> str:
+            inputs = {name: await tasks[name] for name in artifact.inputs}
+            started = time.perf_counter() - start
+            output = await produce(artifact, inputs)
+            critical_input = max(
+                artifact.inputs,
+                key=lambda name: result.timings[name].finished,
+                default=None)
+            result.timings[artifact.name] = ArtifactTiming(
+                artifact.name, started,
+                time.perf_counter() - start, critical_input)
+            result.outputs[artifact.name] = output
+            return output
+
+        # No task starts before they are all created, so each one can await
+        # the tasks of its inputs.
+        tasks: Dict[str, asyncio.Future] = {}
+        for name in self.order:
+            tasks[name] = asyncio.ensure_future(build(self.artifacts[name]))
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def _sort(self) -> List[str]:
+        """
+        Returns the artifact names with every artifact after its inputs.
+        Raises ValueError for unknown inputs and cycles.
+        """
+        order: List[str] = []
+        visiting = set()
+
+        def visit(name: str):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(
+                    f"Artifact {name} is part of a dependency cycle")
+            if name not in self.artifacts:
+                raise ValueError(f"Unknown artifact input {name}")
+            visiting.add(name)
+            for input_name in self.artifacts[name].inputs:
+                visit(input_name)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.artifacts:
+            visit(name)
+        return order
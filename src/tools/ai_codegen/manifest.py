@@ -0,0 +1,92 @@
+"""
+Records what every generated file was generated from, so that a re-run only
+regenerates the files whose inputs changed.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+from tools.ai_client.interface import AiClient
+from tools.ai_codegen.dag import Artifact
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = ".codegen_manifest.json"
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def input_hash(prompt: str,
+               ai_client: AiClient,
+               system_prompt: Optional[str] = None) -> str:
+    """
+    Hashes everything an artifact's output depends on. The prompt already
+    holds the spec, the template and the output of the upstream artifacts.
+    """
+    inputs = {
+        "prompt": prompt,
+        "system_prompt": system_prompt,
+        "provider": ai_client.name,
+        "model": getattr(ai_client, "model", None),
+        "generation_config": getattr(ai_client, "generation_config", None),
+    }
+    return _sha256(json.dumps(inputs, sort_keys=True, default=str))
+
+
+class Manifest:
+    """
+    The input and output hashes of the artifacts generated in a project
+    folder, stored in its .codegen_manifest.json. Without reuse, nothing is
+    reused but every artifact is still recorded, so that a forced run leaves
+    the manifest up to date for the next one.
+    """
+
+    def __init__(self, folder_path: str, reuse: bool = True):
+        self.folder_path = folder_path
+        self.reuse = reuse
+        self.path = os.path.join(folder_path, MANIFEST_FILENAME)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logger.warning(f"Ignoring unreadable manifest {self.path}")
+
+    def reusable(self, artifact: Artifact, inputs_hash: str) -> Optional[str]:
+        """
+        Returns the code of the artifact when it was last generated from the
+        same inputs and its file is still as generated, None otherwise.
+        """
+        entry = self.entries.get(artifact.name) if self.reuse else None
+        if entry is None or entry.get("input_hash") != inputs_hash:
+            return None
+        try:
+            with open(os.path.join(self.folder_path, artifact.filename)) as f:
+                code = f.read()
+        except FileNotFoundError:
+            return None
+        if _sha256(code) != entry.get("output_hash"):
+            return None
+        return code
+
+    def record(self, artifact: Artifact, inputs_hash: str, code: str):
+        """
+        Records a generated artifact. The manifest is saved right away so
+        that a failed run keeps the artifacts it completed.
+        """
+        self.entries[artifact.name] = {
+            "filename": artifact.filename,
+            "input_hash": inputs_hash,
+            "output_hash": _sha256(code),
+        }
+        os.makedirs(self.folder_path, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.folder_path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,82 @@
+"""
+Packages generated projects as zip archives in memory.
+"""
+from dataclasses import dataclass
+import io
+from typing import List, Optional
+import zipfile
+
+# Project names are used as folder and archive names, so they are kept to
+# characters that can't leave the output folder.
+PROJECT_NAME_PATTERN = r"^[\w-]+$"
+
+
+@dataclass
+class ZipOptions:
+    # zlib level from 0 to 9, zlib's default when None.
+    compresslevel: Optional[int] = None
+    # Stores the files uncompressed, which is fastest.
+    store: bool = False
+
+
+class _Sink(io.RawIOBase):
+    """
+    An unseekable file collecting what is written to it until taken. Since
+    it can't seek, zipfile writes every entry once, in order.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class StreamingZip:
+    """
+    Builds a zip archive one file at a time without touching disk. add and
+    close return the bytes of the archive produced since the previous call,
+    so the archive can be sent while later files are still being generated.
+    Files are put under root, if given.
+    """
+
+    def __init__(self, root: str = "", options: Optional[ZipOptions] = None):
+        options = options or ZipOptions()
+        self.root = root
+        self._sink = _Sink()
+        compression = (zipfile.ZIP_STORED
+                       if options.store else zipfile.ZIP_DEFLATED)
+        self._zip = zipfile.ZipFile(self._sink,
+                                    "w",
+                                    compression,
+                                    compresslevel=options.compresslevel)
+
+    def add(self, filename: str, content: str) -> bytes:
+        arcname = f"{self.root}/{filename}" if self.root else filename
+        self._zip.writestr(arcname, content)
+        return self._sink.take()
+
+    def close(self) -> bytes:
+        """
+        Writes the central directory, which ends the archive.
+        """
+        self._zip.close()
+        return self._sink.take()
+
+    def abort(self):
+        """
+        Ends an archive that won't be sent any further. Left open, the
+        ZipFile would write its central directory when garbage collected,
+        into a sink closed by then.
+        """
+        self._zip.close()
+        self._sink.take()
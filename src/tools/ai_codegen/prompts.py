@@ -0,0 +1,227 @@
+"""
+Builds the prompts of the code generators within the context window of the
+model, and accounts for the tokens every call uses.
+"""
+import ast
+from dataclasses import dataclass, replace
+from functools import lru_cache
+import logging
+import os
+import re
+from typing import Dict, List
+
+from tools.ai_client.interface import AiClient
+from tools.ai_client.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# The instructions shared by every prompt. They are sent as the system
+# prompt, once per call instead of repeated inside each prompt, and being
+# identical across calls they form a prefix the provider can cache.
+SYSTEM_PROMPT = (
+    "You write Python source code. Respond with source code only: your "
+    "response is written to a file and executed as is, so it must be valid "
+    "Python without comments or instructions addressed to the reader and "
+    "without formatting or markdown syntax such as ```python. Implement "
+    "every method, without \"pass\", blank bodies or placeholder comments.")
+# Used for clients that don't declare their context window or output limit.
+DEFAULT_CONTEXT_WINDOW = 16384
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+TRUNCATION_MARKER = "# ... truncated to fit the prompt"
+
+_BLANK_LINES = re.compile(r"\n{3,}")
+# Lines worth keeping from code that doesn't parse.
+_OUTLINE_LINE = re.compile(
+    r"^\s*(import |from |class |def |async def |@|\w+\s*(:|=[^=]))")
+# Statements summarize_code keeps whole.
+_KEPT_STATEMENTS = (ast.Import, ast.ImportFrom, ast.Assign, ast.AnnAssign)
+
+
+def compact(text: str) -> str:
+    """
+    Removes the indentation shared by every line, trailing whitespace and
+    repeated blank lines, which cost tokens without telling the model
+    anything.
+    """
+    lines = [line.rstrip() for line in text.splitlines()]
+    indents = [len(line) - len(line.lstrip()) for line in lines if line]
+    indent = min(indents, default=0)
+    text = "\n".join(line[indent:] for line in lines)
+    return _BLANK_LINES.sub("\n\n", text).strip("\n")
+
+
+@lru_cache(maxsize=None)
+def compact_template(template: str) -> str:
+    """
+    Compacts a template once, however many prompts include it.
+    """
+    return compact(template)
+
+
+def summarize_code(code: str) -> str:
+    """
+    Reduces Python code to its outline: imports, assignments, fields and the
+    signatures of classes and functions, with the bodies of functions
+    replaced by "...". This keeps what the code of other files refers to.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return "\n".join(line for line in code.splitlines()
+                         if _OUTLINE_LINE.match(line))
+    lines = code.splitlines()
+    outline: List[str] = []
+
+    def header(node: ast.stmt) -> bool:
+        """
+        Adds the decorators and signature of a class or function, returning
+        whether its body is on lines of its own.
+        """
+        decorators = getattr(node, "decorator_list", [])
+        start = min([node.lineno] + [d.lineno for d in decorators])
+        body_start = node.body[0].lineno  # type: ignore
+        if body_start == node.lineno:
+            # A one-liner such as def get(self): return self.value
+            outline.extend(lines[start - 1:node.lineno])
+            return False
+        outline.extend(lines[start - 1:body_start - 1])
+        return True
+
+    def visit(nodes: List[ast.stmt]):
+        for node in nodes:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                if header(node):
+                    outline.append(" " * (node.col_offset + 4) + "...")
+            elif isinstance(node, ast.ClassDef):
+                if header(node):
+                    body = _without_docstring(node.body)
+                    visit(body)
+                    if not body:
+                        outline.append(" " * (node.col_offset + 4) + "...")
+            elif isinstance(node, _KEPT_STATEMENTS):
+                outline.extend(lines[node.lineno - 1:node.end_lineno])
+
+    visit(tree.body)
+    return "\n".join(outline)
+
+
+def _without_docstring(body: List[ast.stmt]) -> List[ast.stmt]:
+    first = body[0] if body else None
+    if (isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant)
+            and isinstance(first.value.value, str)):
+        return body[1:]
+    return body
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Keeps the lines of text that fit in max_tokens, marking the cut.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Every kept line is followed by a newline, the last one by the marker's.
+    budget = max_tokens - count_tokens(TRUNCATION_MARKER)
+    kept: List[str] = []
+    for line in text.splitlines():
+        budget -= count_tokens(line) + 1
+        if budget < 0:
+            kept.append(TRUNCATION_MARKER)
+            break
+        kept.append(line)
+    return "\n".join(kept)
+
+
+def prompt_budget(ai_client: AiClient,
+                  system_prompt: str = SYSTEM_PROMPT) -> int:
+    """
+    The most tokens a prompt may take: what the context window of the client
+    leaves once the system prompt and the longest response are counted.
+    AI_MAX_PROMPT_TOKENS overrides it.
+    """
+    override = os.getenv("AI_MAX_PROMPT_TOKENS")
+    if override:
+        return int(override)
+    context_window = getattr(ai_client, "context_window",
+                             DEFAULT_CONTEXT_WINDOW)
+    generation_config = getattr(ai_client, "generation_config", None) or {}
+    max_output = generation_config.get("max_output_tokens",
+                                       DEFAULT_MAX_OUTPUT_TOKENS)
+    return context_window - max_output - count_tokens(system_prompt)
+
+
+@dataclass
+class PromptSection:
+    """
+    A titled part of a prompt. The body of a trimmable section, such as the
+    code of another file, may be summarized or truncated to fit the budget.
+    """
+
+    title: str
+    body: str
+    trimmable: bool = False
+
+    def render(self) -> str:
+        return f"# {self.title}:\n{self.body}"
+
+
+@dataclass
+class TokenUsage:
+    prompt_tokens: int
+    completion_tokens: int
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+def build_prompt(sections: List[PromptSection], max_tokens: int) -> str:
+    """
+    Joins the sections into a prompt of at most max_tokens. When they don't
+    fit, the trimmable sections are summarized, then truncated, largest
+    first. Raises ValueError when the other sections alone don't fit.
+    """
+    prompt = _render(sections)
+    if count_tokens(prompt) <= max_tokens:
+        return prompt
+    titles = [section.title for section in sections if section.trimmable]
+    sections = [
+        replace(section, body=summarize_code(section.body))
+        if section.trimmable else section for section in sections
+    ]
+    prompt = _render(sections)
+    excess = count_tokens(prompt) - max_tokens
+    sizes = {
+        index: count_tokens(section.body)
+        for index, section in enumerate(sections) if section.trimmable
+    }
+    for index in sorted(sizes, key=sizes.get, reverse=True):
+        if excess <= 0:
+            break
+        body = truncate_to_tokens(sections[index].body,
+                                  max(0, sizes[index] - excess))
+        sections[index] = replace(sections[index], body=body)
+        excess -= sizes[index] - count_tokens(body)
+    prompt = _render(sections)
+    tokens = count_tokens(prompt)
+    if tokens > max_tokens:
+        raise ValueError(f"The prompt takes {tokens} tokens, more than the "
+                         f"{max_tokens} the model allows")
+    logger.info(f"Trimmed {', '.join(titles)} to fit the prompt in "
+                f"{max_tokens} tokens")
+    return prompt
+
+
+def _render(sections: List[PromptSection]) -> str:
+    return "\n\n".join(section.render() for section in sections)
+
+
+def format_usage(usage: Dict[str, TokenUsage]) -> str:
+    lines = [
+        f"{name:<12} {u.prompt_tokens:6} prompt + "
+        f"{u.completion_tokens:6} completion" for name, u in usage.items()
+    ]
+    prompt_tokens = sum(u.prompt_tokens for u in usage.values())
+    completion_tokens = sum(u.completion_tokens for u in usage.values())
+    lines.append(f"Tokens: {prompt_tokens} prompt + {completion_tokens} "
+                 f"completion = {prompt_tokens + completion_tokens}")
+    return "\n".join(lines)
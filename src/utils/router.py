@@ -13,6 +13,7 @@ from errors import (
     FileTooLargeError,
     UnsupportedMediaTypeError,
     RateLimitError,
+    QueryTimeoutError,
 )
 
 logger = logging.getLogger(__name__)
@@ -31,7 +32,7 @@ def error_handler(route_function):
 
         except ValidationError as validation_error:
             logger.exception(validation_error)
-            raise HTTPException(status_code=status.HTTP_422_BAD_REQUEST,
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                                 detail=str(validation_error))
 
         except ConflictError as conflict_error:
@@ -87,6 +88,13 @@ def error_handler(route_function):
                 detail=str(rate_limit_error),
             )
 
+        except QueryTimeoutError as query_timeout_error:
+            logger.exception(query_timeout_error)
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=str(query_timeout_error),
+            )
+
         except HTTPException as http_exc:
             # Here you could add additional logging if needed
             print("re-raising HTTP exception")